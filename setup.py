@@ -12,8 +12,7 @@ INSTALL_REQUIRES = [
     'coloredlogs',
     'cryptography',
     'hashfs',
-    'python-dateutil',
-    'worq'
+    'python-dateutil'
 ]
 
 SCHEDULER_REQUIRES = [
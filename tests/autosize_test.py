@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import stat
+
+import tlscanary.tools.autosize as autosize
+
+
+MB = 1024 * 1024
+
+
+def test_choose():
+    """Auto-sizing picks worker count and requests per worker"""
+
+    assert autosize.choose(4) == (4, 50), "picks traditional defaults for four cores and unknown memory"
+    assert autosize.choose(16, memory=64000 * MB, worker_rss=100 * MB, max_rss=1500 * MB) == (16, 50), \
+        "picks one worker per core with plenty of memory"
+
+    num_workers, requests_per_worker = autosize.choose(16, memory=2000 * MB, worker_rss=100 * MB, max_rss=1500 * MB)
+    assert num_workers == 3, "limits workers to available memory"
+    assert requests_per_worker == 200, "raises requests per worker when memory limits workers"
+
+    assert autosize.choose(2, memory=100 * MB, worker_rss=400 * MB)[0] == 1, "picks at least one worker"
+    assert autosize.choose(64)[1] == 50, "spreads requests across workers"
+
+
+def test_auto_size(fake_app):
+    """Auto-sizing probes the machine and a worker"""
+
+    assert autosize.cpu_count() >= 1, "detects CPU cores"
+    info = autosize.auto_size(fake_app, max_rss=1500 * MB)
+    assert info["worker_startup_time"] > 0, "measures worker start-up time"
+    assert info["parallel"] >= 1, "picks worker count"
+    assert info["requestsperworker"] >= autosize.min_requests_per_worker, "picks requests per worker"
+
+
+def test_auto_size_broken_worker(tmpdir):
+    """Auto-sizing falls back to defaults when the probe worker hangs or fails"""
+
+    class HangingApp(object):
+        exe = str(tmpdir.join("hanging_xpcshell"))
+        gredir = browser = str(tmpdir)
+
+    with open(HangingApp.exe, "w") as f:
+        f.write("#!/bin/sh\nexec sleep 60\n")
+    os.chmod(HangingApp.exe, stat.S_IRWXU)
+
+    assert autosize.probe_worker(HangingApp, timeout=1) == (None, None), "gives up on workers that don't answer"
+
+    HangingApp.exe = str(tmpdir.join("missing_xpcshell"))
+    info = autosize.auto_size(HangingApp)
+    assert info["worker_startup_time"] is None, "reports failed probe"
+    assert (info["parallel"], info["requestsperworker"]) == \
+        (autosize.default_workers, autosize.default_requests_per_worker), "falls back to defaults"
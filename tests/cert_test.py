@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
 import os
 import pkg_resources as pkgr
 
@@ -35,3 +36,22 @@ def test_cert_instance_with_pem():
     assert der.signature_hash_algorithm() == "sha256", "SIGNATURE_HASH_ALGORITHM extracts fine"
     assert der.subject_alt_name() == "mozilla.org,www.mozilla.org", "SUBJECT_ALTERNATIVE_NAME OID extracts fine"
     assert der.ext_key_usage() == "serverAuth,clientAuth", "EXTENDED_KEY_USAGE OID extracts fine"
+
+
+def test_decode_chain():
+    """Certificate chains are decoded from base64 and legacy int list transport"""
+
+    der_cert_file = pkgr.resource_filename(__name__, "files/mozilla.org.der")
+    with open(der_cert_file, "rb") as f:
+        der_data = f.read()
+
+    info = {"certificate_chain": [base64.b64encode(der_data).decode("ascii")],
+            "certificate_chain_encoding": "base64"}
+    chain = cert.decode_chain(info)
+    assert chain == [der_data], "base64 chain decodes to DER bytes"
+    assert cert.Cert(chain[0]).as_der() == der_data, "decoded chain element is a valid certificate"
+
+    legacy_info = {"certificate_chain": [list(der_data), {"sha1Fingerprint": "00"}]}
+    assert cert.decode_chain(legacy_info) == [der_data, None], "legacy int list chain decodes to DER bytes"
+
+    assert cert.decode_chain({"certificate_chain": None}) is None, "missing chain decodes to None"
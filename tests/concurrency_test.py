@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import tlscanary.tools.concurrency as cc
+
+
+def test_aimd_controller():
+    """AIMDController grows additively and shrinks multiplicatively"""
+
+    controller = cc.AIMDController(10, maximum=20, timeout=10)
+    assert controller.limit == 10, "controller starts at initial window"
+
+    for _ in range(10):
+        controller.record("ok", 0.2)
+    assert controller.limit == 11, "healthy round increases window by one"
+
+    for _ in range(11):
+        controller.record("error", 0.2)
+    assert controller.limit == 12, "plain errors do not signal congestion"
+
+    for i in range(12):
+        controller.record("timeout" if i < 1 else "ok", 0.2)
+    assert controller.limit == 13, "timeouts of the first rounds set the baseline"
+
+    for i in range(13):
+        controller.record("timeout" if i < 1 else "ok", 0.2)
+    assert controller.limit == 14, "timeouts at the baseline rate do not signal congestion"
+
+    for i in range(14):
+        controller.record("timeout" if i < 4 else "ok", 0.2)
+    assert controller.limit == 7, "timeouts above the baseline halve the window"
+
+    for _ in range(7):
+        controller.record("ok", 8.0)
+    assert controller.limit == 3, "response times close to timeout halve the window"
+
+    for _ in range(100):
+        controller.record("timeout", 10.0)
+    assert controller.limit == 1, "window does not shrink below minimum"
+
+    for _ in range(1000):
+        controller.record("ok", 0.1)
+    assert controller.limit == 20, "window does not grow beyond maximum"
+
+    stats = controller.stats()
+    assert stats["window"] == 20, "stats report current window"
+    assert stats["p50"] == 0.1, "stats report response time percentiles"
+
+
+def test_aimd_controller_dead_hosts():
+    """AIMDController keeps its window when a steady share of hosts is dead"""
+
+    controller = cc.AIMDController(10, maximum=40, timeout=10)
+    for i in range(5000):
+        controller.record("timeout" if i % 10 == 0 else "ok", 0.2)
+    assert controller.limit == 40, "window grows despite 10% dead hosts"
+    assert abs(controller.stats()["timeout_baseline"] - 0.1) < 0.03, "baseline follows the dead host rate"
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import pytest
 from subprocess import check_output
 
@@ -216,3 +217,21 @@ def release_linux_app(tmpdir_factory, release_linux_archive):
 def esr_linux_app(tmpdir_factory, esr_linux_archive):
     """A Firefox ESR app for Linux fixture"""
     return fe.extract(esr_linux_archive, tmpdir_factory.mktemp("esr_linux_app"))
+
+
+class FakeApp(object):
+    """Minimal FirefoxApp stand-in that runs the fake XPCShell worker"""
+
+    def __init__(self, directory):
+        self.exe = os.path.join(os.path.dirname(__file__), "files", "fake_xpcshell.py")
+        self.gredir = str(directory)
+        self.browser = str(directory)
+        self.package_origin = None
+        self.build_spec = "fake"
+        self.application_ini = {"buildid": "20190101000000"}
+
+
+@pytest.fixture(scope="session")
+def fake_app(tmpdir_factory):
+    """An app fixture whose XPCShell worker answers scans offline"""
+    return FakeApp(tmpdir_factory.mktemp("fake_app"))
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import io
+import pytest
+import sys
+import zipfile
+
+import tlscanary.distributed as dist
+import tlscanary.worker_pool as wp
+
+
+def test_parse_address():
+    """Agent addresses are parsed from `host:port`"""
+
+    assert dist.parse_address("localhost:8765") == ("localhost", 8765), "address is parsed"
+    with pytest.raises(ValueError):
+        dist.parse_address("localhost")
+
+
+def test_distributed_scans(fake_app, tmpdir):
+    """Coordinator collects results from agents and takes over from failed ones"""
+
+    profile_dir = tmpdir.mkdir("profile")
+    profile_dir.join("prefs.js").write("// empty")
+    agent_dir = tmpdir.mkdir("agent")
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(1, 51)]
+    progress = []
+
+    async def scan():
+        agent = dist.AgentServer(lambda build: fake_app, str(agent_dir), "secret")
+        server = await asyncio.start_server(agent.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        # The second agent does not exist, so its batches are scanned by the first
+        agents = [("127.0.0.1", port), ("127.0.0.1", 1)]
+        try:
+            return await dist.scan_hosts(agents, fake_app, targets, profile=str(profile_dir), num_workers=2,
+                                         targets_per_worker=5, timeout=2, progress_callback=progress.append,
+                                         batch_size=10, secret="secret")
+        finally:
+            server.close()
+
+    results = wp.run_in_loop(scan())
+    assert len(results) == len(targets), "every host yields a result"
+    assert results["host1.example.com"].success, "results are restored from agent messages"
+    assert sum(progress) == len(targets), "progress is reported for every host"
+    assert len(agent_dir.listdir()) == 1, "agent unpacked the profile"
+
+
+def test_agent_authentication(fake_app, tmpdir):
+    """Agents only serve coordinators that know the shared secret"""
+
+    profile_dir = tmpdir.mkdir("profile")
+    profile_dir.join("prefs.js").write("// empty")
+    agent_dir = tmpdir.mkdir("agent")
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(1, 11)]
+
+    async def scan():
+        agent = dist.AgentServer(lambda build: fake_app, str(agent_dir), "secret")
+        server = await asyncio.start_server(agent.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await dist.scan_hosts([("127.0.0.1", port)], fake_app, targets, profile=str(profile_dir),
+                                         num_workers=1, targets_per_worker=5, timeout=2, secret="wrong")
+        finally:
+            server.close()
+
+    results = wp.run_in_loop(scan())
+    assert len(results) == len(targets), "hosts are scanned locally when the agent refuses"
+    assert len(agent_dir.listdir()) == 0, "agent does not unpack profiles for unauthenticated coordinators"
+
+
+def test_agent_bad_build(fake_app, tmpdir):
+    """Agents refuse unknown builds and keep serving"""
+
+    profile_dir = tmpdir.mkdir("profile")
+    profile_dir.join("prefs.js").write("// empty")
+    agent_dir = tmpdir.mkdir("agent")
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(1, 11)]
+
+    def resolve_app(build):
+        # Like BaseMode.get_test_candidate() with an unknown build
+        sys.exit(5)
+
+    async def scan():
+        agent = dist.AgentServer(resolve_app, str(agent_dir), "secret")
+        server = await asyncio.start_server(agent.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            results = []
+            for _ in range(2):
+                results.append(await dist.scan_hosts([("127.0.0.1", port)], fake_app, targets,
+                                                     profile=str(profile_dir), num_workers=1, targets_per_worker=5,
+                                                     timeout=2, secret="secret"))
+            return results
+        finally:
+            server.close()
+
+    for results in wp.run_in_loop(scan()):
+        assert len(results) == len(targets), "hosts are scanned locally when the agent can't get the build"
+
+
+def test_zip_members():
+    """Profile archives with members outside the profile directory are refused"""
+
+    for name in ("../evil.js", "/etc/evil.js", "sub/../../evil.js", "C:/evil.js"):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as z:
+            z.writestr(name, "evil")
+        with zipfile.ZipFile(buffer) as z:
+            with pytest.raises(Exception):
+                dist.check_zip_members(z)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("security_state/data.safe.bin", "data")
+    with zipfile.ZipFile(buffer) as z:
+        dist.check_zip_members(z)
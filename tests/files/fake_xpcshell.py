@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Stand-in for `firefox -xpcshell` running scan_worker.js. It speaks the same
+JSON line protocol, but answers scans without touching the network:
+
+  - hosts starting with `error` fail with a certificate error
+  - hosts starting with `slow` answer after half a second
+  - hosts starting with `crash` make the worker exit immediately
+  - hosts starting with `regress` fail like `error` hosts, but only with the
+    pref `tlscanary.fake.regress` set, which marks a test build
+
+Every host presents the mozilla.org certificate from the test files.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+worker_id = random.randint(0, 2 ** 53)
+print_lock = threading.Lock()
+compact_responses = False
+known_certificates = set()
+prefs = {}
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mozilla.org.der"), "rb") as f:
+    certificate = f.read()
+
+
+def send_response(cmd, success, result):
+    message = {
+        "id": cmd.get("id"),
+        "worker_id": worker_id,
+        "success": success,
+        "result": result,
+        "command_time": int(time.time() * 1000),
+        "response_time": int(time.time() * 1000),
+    }
+    if not compact_responses:
+        message["original_cmd"] = cmd
+    with print_lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+
+def scan(cmd):
+    host = cmd["args"]["host"]
+    if host.startswith("slow"):
+        time.sleep(0.5)
+    info = {"status": 0, "original_uri": "https://%s/" % host, "uri": "https://%s/" % host,
+            "short_error_message": None, "certificate_chain": None}
+    if cmd["args"].get("include_certificates"):
+        if cmd["args"].get("certificate_fingerprints"):
+            fingerprint = hashlib.sha256(certificate).hexdigest()
+            info["certificate_data"] = {}
+            with print_lock:
+                if fingerprint not in known_certificates:
+                    info["certificate_data"][fingerprint] = base64.b64encode(certificate).decode("ascii")
+                    known_certificates.add(fingerprint)
+            info["certificate_chain"] = [fingerprint]
+            info["certificate_chain_encoding"] = "sha256"
+        else:
+            info["certificate_chain"] = [base64.b64encode(certificate).decode("ascii")]
+            info["certificate_chain_encoding"] = "base64"
+    info["timing"] = {"domain_lookup_start": 0.5, "domain_lookup_end": 2.0, "connect_start": 2.0,
+                      "secure_connection_start": 5.0, "connect_end": 25.0, "request_start": 25.5,
+                      "response_start": 40.0}
+    if host.startswith("error") or host.startswith("regress") and "tlscanary.fake.regress" in prefs:
+        info["timing"].update(connect_end=None, request_start=None, response_start=None)
+        info["status"] = 0x805a1ff3
+        info["short_error_message"] = "SEC_ERROR_UNKNOWN_ISSUER"
+        send_response(cmd, False, {"origin": "error_handler", "info": info})
+    else:
+        send_response(cmd, True, {"origin": "load_handler", "info": info})
+
+
+def main():
+    global compact_responses
+
+    for line in iter(sys.stdin.readline, ""):
+        cmd = json.loads(line)
+        mode = cmd["mode"]
+        if mode == "hello":
+            compact_responses = cmd["args"].get("compact_responses") is True
+            send_response(cmd, True, {"async_input": True, "compact_responses": compact_responses})
+        elif mode == "info":
+            send_response(cmd, True, {"nssInfo": {}, "appConstants": {}})
+        elif mode == "setprefs":
+            prefs.update(pref.split(";", 1) for pref in cmd["args"]["prefs"])
+            send_response(cmd, True, "ACK")
+        elif mode in ("useprofile", "wakeup"):
+            send_response(cmd, True, "ACK")
+        elif mode == "quit":
+            send_response(cmd, True, "ACK")
+            return
+        elif mode == "knowncerts":
+            with print_lock:
+                known_certificates.update(cmd["args"]["fingerprints"])
+            send_response(cmd, True, {"known_certificates": len(known_certificates)})
+            send_response(cmd, True, "ACK")
+        elif mode == "trustroots":
+            send_response(cmd, True, {"trusted_roots": len(cmd["args"]["certificates"])})
+            send_response(cmd, True, "ACK")
+        elif mode == "scan":
+            if cmd["args"]["host"].startswith("crash"):
+                sys.exit(1)
+            send_response(cmd, True, "ACK")
+            threading.Thread(target=scan, args=(cmd,), daemon=True).start()
+        else:
+            send_response(cmd, False, "Unknown command mode: " + mode)
+
+
+if __name__ == "__main__":
+    main()
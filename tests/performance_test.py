@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from array import array
+import math
+
+from tlscanary.modes import performance as perf
+import tlscanary.worker_pool as wp
+
+
+def test_timing_aggregation():
+    """Performance timings are aggregated per host across scans"""
+
+    samples = [array("d", [100, 200, math.nan]),
+               array("d", [300, 200, math.nan]),
+               array("d", [500, math.nan, math.nan])]
+
+    means = perf.column_means(samples)
+    assert list(means[:2]) == [300, 200], "means are computed per host, ignoring missing samples"
+    assert math.isnan(means[2]), "host without samples has no mean"
+
+    assert len(perf.new_samples(100000)) == 100000, "sample arrays are preallocated"
+
+
+def test_handshake_timing(fake_app):
+    """Performance mode measures the TLS handshake from channel timing info"""
+
+    results = wp.run_scans(fake_app, [(1, "host1.example.com"), (2, "error2.example.com")], num_workers=1,
+                           targets_per_worker=2, timeout=2)
+
+    durations = results["host1.example.com"].phase_durations()
+    assert durations == {"dns": 1.5, "tcp_connect": 3.0, "tls_handshake": 20.0, "first_byte": 14.5}, \
+        "phase durations are computed from channel timestamps"
+    assert perf.PerformanceMode.connection_speed(results["host1.example.com"]) == 20.0, \
+        "connection speed is the handshake time"
+    assert math.isnan(perf.PerformanceMode.connection_speed(results["error2.example.com"])), \
+        "failed handshakes have no connection speed"
+
+    del results["host1.example.com"].response.result["info"]["timing"]
+    assert results["host1.example.com"].phase_durations() is None, "timing info is optional"
+    assert math.isnan(perf.PerformanceMode.connection_speed(results["host1.example.com"])), \
+        "scans without timing info have no connection speed"
+    assert perf.PerformanceMode.response_time(results["host1.example.com"]) >= 0, \
+        "response time is measured without timing info"
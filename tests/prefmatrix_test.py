@@ -0,0 +1,22 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import pytest
+
+from tlscanary.modes import prefmatrix
+
+
+def test_parse_pref_set():
+    """Pref set arguments are parsed into names and pref lists"""
+
+    assert prefmatrix.parse_pref_set("distrust=security.pki.distrust_ca_policy;2") == \
+        ("distrust", ["security.pki.distrust_ca_policy;2"]), "parses single pref"
+    assert prefmatrix.parse_pref_set("legacy=security.tls.version.min;1,security.tls.version.max;4") == \
+        ("legacy", ["security.tls.version.min;1", "security.tls.version.max;4"]), "parses multiple prefs"
+    assert prefmatrix.parse_pref_set("default=") == ("default", []), "parses empty pref set"
+    with pytest.raises(argparse.ArgumentTypeError):
+        prefmatrix.parse_pref_set("security.tls.version.min;1")
+    with pytest.raises(argparse.ArgumentTypeError):
+        prefmatrix.parse_pref_set("broken=security.tls.version.min")
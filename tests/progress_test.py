@@ -41,3 +41,35 @@ def test_progress_logger_instance():
     progress.stop_reporting()
     time.sleep(1.1)
     assert not thread.is_alive(), "monitor thread can be terminated"
+
+
+def test_progress_events():
+    """ProgressTracker counts scan events"""
+
+    progress = pr.ProgressTracker(100, unit="hosts")
+    assert "in flight" not in str(progress), "no event summary without events"
+
+    progress.log_event("dispatched", 10)
+    progress.log_event("ok", 3)
+    progress.log_event("error")
+    progress.log_event("timeout", 2)
+    progress.log_event("retry")
+    progress.log_completed(6)
+
+    status = str(progress)
+    assert progress.in_flight() == 3, "counts requests in flight"
+    assert "3 in flight" in status, "reports requests in flight"
+    assert "2 timeouts" in status, "reports timeouts"
+    assert "1 errors" in status, "reports errors"
+    assert "1 retries" in status, "reports retries"
+
+
+def test_progress_log_pruning():
+    """ProgressTracker prunes log entries outside the averaging window"""
+
+    progress = pr.ProgressTracker(100000, average=60.0)
+    now = time.time()
+    progress.log = [(now - 3600.0 + i * 0.1, 1, 0) for i in range(5000)]
+    progress.log_completed(1)
+    assert len(progress.log) == 1, "keeps only the entry inside the window"
+    assert len(progress.log_window(60.0)) == 1, "window contains only recent entries"
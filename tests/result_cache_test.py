@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+
+import tlscanary.tools.result_cache as rc
+
+
+class AppMock(object):
+    def __init__(self, buildid):
+        self.application_ini = {"buildid": buildid, "version": "99.0"}
+
+
+def test_config_key(tmpdir):
+    """Result cache configuration keys depend on build, prefs, and profile contents"""
+
+    profile = os.path.join(tmpdir, "profile")
+    os.makedirs(os.path.join(profile, "security_state"))
+    with open(os.path.join(profile, "security_state", "data.safe.bin"), "wb") as f:
+        f.write(b"revocations")
+
+    key = rc.config_key(AppMock("20200101000000"), ["a;1", "b;2"], profile)
+    assert key == rc.config_key(AppMock("20200101000000"), ["b;2", "a;1"], profile), "pref order does not matter"
+    assert key != rc.config_key(AppMock("20200102000000"), ["a;1", "b;2"], profile), "build ID matters"
+    assert key != rc.config_key(AppMock("20200101000000"), ["a;1"], profile), "prefs matter"
+
+    with open(os.path.join(profile, "security_state", "data.safe.bin"), "wb") as f:
+        f.write(b"other revocations")
+    assert key != rc.config_key(AppMock("20200101000000"), ["a;1", "b;2"], profile), "OneCRL data matters"
+
+
+def test_result_cache(tmpdir):
+    """Result cache returns fresh outcomes of earlier runs"""
+
+    db_file = os.path.join(tmpdir, "results.sqlite")
+    cache = rc.ResultCache(db_file, "config", maximum_age=60)
+    assert cache.get("good.example.com") is None, "empty cache has no outcomes"
+    cache.put("good.example.com", True)
+    cache.put("bad.example.com", False)
+    assert cache.get("good.example.com") is None, "outcomes of the current run are not returned"
+    cache.close()
+
+    time.sleep(0.01)
+    cache = rc.ResultCache(db_file, "config", maximum_age=60)
+    assert cache.get("good.example.com") is True, "successful outcome is cached"
+    assert cache.get("bad.example.com") is False, "failed outcome is cached"
+    assert cache.get("new.example.com") is None, "unknown host is a miss"
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1, "cache counts hits and misses"
+    cache.close()
+
+    cache = rc.ResultCache(db_file, "other config", maximum_age=60)
+    assert cache.get("good.example.com") is None, "outcomes are kept per configuration"
+    cache.close()
+
+    time.sleep(0.01)
+    cache = rc.ResultCache(db_file, "config", maximum_age=0.001)
+    assert cache.get("good.example.com") is None, "stale outcomes are ignored"
+    cache.close()
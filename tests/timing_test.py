@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+import os
+import random
+
+from tlscanary.tools import timing
+
+
+def test_sample_store(tmpdir):
+    """Sample store keeps timings per build and scan and survives a round trip to disk"""
+
+    hosts = [(1, "one.example.com"), (2, "two.example.com"), (3, "three.example.com")]
+    store = timing.SampleStore(hosts, ["test", "base"], 3)
+    for scan, value in enumerate([100, 300, 200]):
+        store.add("test", scan, "one.example.com", value)
+    store.add("base", 0, "two.example.com", 50)
+
+    assert store.samples("test", 0) == [100, 300, 200], "samples are kept per scan"
+    assert store.samples("test", 2) == [], "missing samples are skipped"
+    medians = store.medians("test")
+    assert medians[0] == 200, "median is computed per host"
+    assert math.isnan(medians[1]), "host without samples has no median"
+
+    file_name = os.path.join(tmpdir, "timings.bin")
+    with open(file_name, "wb") as f:
+        store.write(f)
+    assert os.path.getsize(file_name) < 1024, "samples are stored compactly"
+    with open(file_name, "rb") as f:
+        restored = timing.SampleStore.read(f)
+    assert restored.hosts == hosts, "hosts are restored"
+    assert restored.samples("test", 0) == [100, 300, 200], "samples are restored"
+    assert restored.samples("base", 1) == [50], "samples of every build are restored"
+
+
+def test_paired_changes():
+    """Changes between builds are computed from samples of the same round"""
+
+    hosts = [(1, "one.example.com"), (2, "two.example.com"), (3, "three.example.com")]
+    store = timing.SampleStore(hosts, ["test", "base"], 3)
+    # Network gets slower with every round, but test is always 10% slower than base
+    for scan, value in enumerate([100, 200, 400]):
+        store.add("test", scan, "one.example.com", value * 1.1)
+        store.add("base", scan, "one.example.com", value)
+    store.add("test", 0, "two.example.com", 100)
+    store.add("base", 1, "two.example.com", 100)
+    store.add("test", 0, "three.example.com", 150)
+    store.add("base", 0, "three.example.com", 100)
+    store.add("test", 1, "three.example.com", 80)
+
+    changes = store.paired_changes("test", "base")
+    assert abs(changes[0] - 10) < 1e-3, "drift between rounds cancels out"
+    assert math.isnan(changes[1]), "samples of different rounds are not paired"
+    assert changes[2] == 50, "incomplete pairs are skipped"
+
+
+def test_summarize():
+    """Timing summaries report percentiles with confidence intervals"""
+
+    assert timing.percentile([1, 2, 3, 4], 50) == 2.5, "percentiles interpolate"
+    assert timing.percentile([1, 2, 3, 4], 100) == 4, "maximum is the 100th percentile"
+
+    rng = random.Random(42)
+    values = [rng.gauss(100, 10) for _ in range(2000)] + [math.nan]
+    summary = timing.summarize(values, rng=rng)
+    assert summary["count"] == 2000, "missing values are skipped"
+    assert summary["p50"] < summary["p90"] < summary["p99"], "percentiles are ordered"
+    for p in timing.percentiles:
+        lower, upper = summary["p%d_ci" % p]
+        assert lower <= summary["p%d" % p] <= upper, "confidence interval contains the estimate"
+    assert 95 < summary["p50_ci"][0] and summary["p50_ci"][1] < 105, "confidence interval is tight for many samples"
+
+    empty = timing.summarize([])
+    assert empty["count"] == 0 and empty["p50"] is None and empty["p50_ci"] is None, "empty summary has no values"
+
+
+def test_bootstrap_ci_width():
+    """Bootstrap confidence intervals match the analytic standard error of the median"""
+
+    rng = random.Random(7)
+    for n in (2000, 4 * timing.bootstrap_sample_limit):
+        values = [rng.gauss(0, 10) for _ in range(n)]
+        lower, upper = timing.bootstrap_ci(values, 50, rng=rng)
+        # Standard error of the median of a normal distribution is sqrt(pi / 2) * sigma / sqrt(n)
+        expected_width = 2 * 1.96 * math.sqrt(math.pi / 2) * 10 / math.sqrt(n)
+        assert 0.75 < (upper - lower) / expected_width < 1.25, \
+            "confidence interval of %d samples has the analytic width" % n
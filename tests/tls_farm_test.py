@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import pytest
+import socket
+import ssl
+
+from cryptography import x509
+from cryptography.hazmat import backends
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from tlscanary.modes import handshake
+from tlscanary.tools import tls_farm
+
+
+def test_tls_farm(tmpdir):
+    """TLS server farm serves certificates by SNI name"""
+
+    farm = tls_farm.TLSServerFarm(tmpdir, key_types=["ecdsa256", "rsa2048"], chain_lengths=[2, 4],
+                                  hosts_per_config=2, timeout=2)
+    port = farm.start()
+    try:
+        assert len(farm.names) == 8, "there are host names for every key type and chain length"
+        assert farm.hosts()[0] == (1, "%s:%d" % (farm.names[0], port)), "scan targets include the farm port"
+        assert "network.dns.localDomains;%s" % ",".join(farm.names) in farm.prefs(), \
+            "prefs map farm host names to localhost"
+
+        context = ssl.create_default_context()
+        for der in farm.root_certificates():
+            context.load_verify_locations(cadata=der)
+
+        for name in farm.names:
+            with socket.create_connection(("127.0.0.1", port), timeout=2) as sock:
+                with context.wrap_socket(sock, server_hostname=name) as tls:
+                    tls.sendall(("HEAD / HTTP/1.1\r\nHost: %s\r\n\r\n" % name).encode("ascii"))
+                    response = tls.recv(4096)
+                    leaf = x509.load_der_x509_certificate(tls.getpeercert(binary_form=True),
+                                                          backends.default_backend())
+            assert response.startswith(b"HTTP/1.1 200 OK"), "farm answers requests"
+            assert leaf.subject.get_attributes_for_oid(x509.oid.NameOID.COMMON_NAME)[0].value == name, \
+                "farm serves the certificate of the requested name"
+            key_type, chain_length = farm.configs[name]
+            expected_key = ec.EllipticCurvePublicKey if key_type == "ecdsa256" else rsa.RSAPublicKey
+            assert isinstance(leaf.public_key(), expected_key), "leaf certificate has the configured key type"
+
+        with open(tmpdir.join("%s.pem" % farm.names[-1]), "rb") as f:
+            assert f.read().count(b"BEGIN CERTIFICATE") == 3, "server sends chain without root"
+    finally:
+        farm.stop()
+
+    with pytest.raises(ValueError):
+        tls_farm.TLSServerFarm(tmpdir, chain_lengths=[1])
+
+
+def test_handshake_args():
+    """Handshake mode validates key types and chain lengths"""
+
+    assert handshake.parse_key_types("rsa2048,ecdsa384") == ["rsa2048", "ecdsa384"]
+    assert handshake.parse_chain_lengths("2,3,5") == [2, 3, 5]
+    for parser, arg in ((handshake.parse_key_types, "dsa1024"), (handshake.parse_chain_lengths, "1"),
+                        (handshake.parse_chain_lengths, "two")):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parser(arg)
+
+
+def test_trust_farm_roots(fake_app, tmpdir):
+    """Handshake mode adds farm roots to profiles and fails cleanly if the worker does"""
+
+    class FarmMock(object):
+        @staticmethod
+        def root_certificates():
+            return [b"root"]
+
+    mode = handshake.HandshakeMode.__new__(handshake.HandshakeMode)
+    mode.farm = FarmMock()
+    mode.args = argparse.Namespace(cache=True)
+    mode.trust_farm_roots(fake_app, str(tmpdir))
+
+    class BrokenApp(object):
+        exe = str(tmpdir.join("missing_xpcshell"))
+        gredir = browser = str(tmpdir)
+
+    with pytest.raises(SystemExit):
+        mode.trust_farm_roots(BrokenApp, str(tmpdir))
@@ -0,0 +1,347 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import base64
+import hashlib
+import os
+import pkg_resources as pkgr
+import random
+import time
+
+from tests import ArgsMock
+import tlscanary.runlog as rl
+from tlscanary.tools import cert
+import tlscanary.tools.result_cache as rc
+import tlscanary.worker_pool as wp
+import tlscanary.tools.worker_benchmark as wb
+
+
+def test_run_scans(fake_app):
+    """Worker pool scans all hosts and evaluates results"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(1, 101)]
+    targets += [(101, "error101.example.com")]
+    progress = []
+    results = wp.run_scans(fake_app, targets, num_workers=2, targets_per_worker=10, timeout=2,
+                           progress_callback=progress.append)
+
+    assert len(results) == len(targets), "every host yields a result"
+    assert results["host1.example.com"].success, "working host is evaluated as success"
+    assert results["host1.example.com"].rank == 1, "result carries host rank"
+    assert not results["error101.example.com"].success, "broken host is evaluated as error"
+    assert sum(progress) == len(targets), "progress is reported for every host"
+    assert len(wp.live_workers) == 0, "persistent workers are stopped after the run"
+
+
+def test_persistent_worker_recycling(fake_app):
+    """Persistent workers are recycled when they reach their request limit"""
+
+    loop = wp.new_event_loop()
+    try:
+        worker = wp.PersistentWorker(fake_app, max_requests=20)
+        assert loop.run_until_complete(worker.start()), "worker can be started"
+        worker.requests = 10
+        assert not worker.needs_recycling(), "healthy worker is reused"
+        worker.requests = 20
+        assert worker.needs_recycling(), "worker needs recycling at its request limit"
+        loop.run_until_complete(worker.stop())
+        assert not worker.xpcw.is_running(), "worker is stopped"
+        assert worker not in wp.live_workers, "stopped worker is not tracked anymore"
+    finally:
+        loop.close()
+
+
+def test_sliding_window(fake_app):
+    """Slow hosts do not stall the requests queued behind them"""
+
+    targets = [(rank, "%s%d.example.com" % ("slow" if rank % 10 == 0 else "host", rank)) for rank in range(40)]
+    start_time = time.time()
+    results = wp.run_scans(fake_app, targets, num_workers=1, targets_per_worker=4, timeout=2)
+    elapsed = time.time() - start_time
+
+    assert len(results) == len(targets), "every host yields a result"
+    # Scanning chunks of four would wait for four stragglers in sequence
+    assert elapsed < 1.5, "slow hosts are scanned concurrently"
+
+
+def test_adaptive_run_scans(fake_app):
+    """Worker pool scans all hosts with adaptive concurrency"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(200)]
+    results = wp.run_scans(fake_app, targets, num_workers=2, targets_per_worker=5, timeout=2, adaptive=True)
+    assert len(results) == len(targets), "every host yields a result"
+
+
+def test_iter_scans(fake_app):
+    """Worker pool yields results while the scan is still running"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(50)]
+    targets += [(50, "slow50.example.com")]
+    results = wp.iter_scans(fake_app, targets, num_workers=1, targets_per_worker=10, timeout=2)
+
+    first_result = next(results)
+    assert isinstance(first_result, wp.ScanResult), "generator yields scan results"
+    assert first_result.host != "slow50.example.com", "results are yielded as they arrive"
+    hosts = set([first_result.host] + [result.host for result in results])
+    assert hosts == set(host for _, host in targets), "every host yields a result"
+    assert len(wp.live_workers) == 0, "persistent workers are stopped after the run"
+
+    # Abandoning the generator early winds down the workers
+    results = wp.iter_scans(fake_app, targets, num_workers=1, targets_per_worker=10, timeout=2)
+    next(results)
+    results.close()
+    assert len(wp.live_workers) == 0, "persistent workers are stopped when the consumer stops early"
+
+
+def test_crash_recovery(fake_app):
+    """Hosts in flight during a worker crash are scanned again by a respawned worker"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(30)]
+    targets.insert(15, (100, "crash100.example.com"))
+    progress = []
+    events = []
+    results = wp.run_scans(fake_app, targets, num_workers=1, targets_per_worker=10, timeout=2, retries=2,
+                           progress_callback=progress.append, event_callback=events.append)
+
+    assert "crash100.example.com" not in results, "host that keeps crashing workers is given up on"
+    assert len(results) == len(targets) - 1, "no other host is lost in the crashes"
+    assert sum(progress) == len(targets), "progress is reported for every host, including the lost one"
+    assert events.count("lost") == 1, "lost host is reported"
+    assert events.count("retry") >= 2, "retries are reported"
+    assert events.count("dispatched") == len(events) - events.count("dispatched"), "every request is concluded"
+    assert len(wp.live_workers) == 0, "respawned workers are stopped after the run"
+
+
+def test_certificate_negotiation(fake_app, tmpdir):
+    """Certificates are stored in the CertDB and referenced by fingerprint"""
+
+    cert_db = rl.CertDB(ArgsMock(workdir=str(tmpdir)))
+    der_cert_file = pkgr.resource_filename(__name__, "files/mozilla.org.der")
+    with open(der_cert_file, "rb") as f:
+        der_data = f.read()
+    fingerprint = hashlib.sha256(der_data).hexdigest()
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(20)]
+    for _ in range(2):
+        # Second run starts with workers that are told about the known certificate
+        results = wp.run_scans(fake_app, targets, num_workers=2, targets_per_worker=5, timeout=2,
+                               get_certs=True, cert_db=cert_db)
+        assert len(results) == len(targets), "every host yields a result"
+        for result in results.values():
+            info = result.response.result["info"]
+            assert info["certificate_chain"] == [fingerprint], "chain is referenced by fingerprint"
+            assert "certificate_data" not in info, "certificate data is moved out of the result"
+            assert cert.decode_chain(info, cert_db=cert_db) == [der_data], "chain resolves through the CertDB"
+
+    assert cert_db.known == {fingerprint}, "certificate is known to the CertDB"
+    assert cert_db.get(fingerprint) == der_data, "certificate is stored in the CertDB"
+    assert cert_db.issuers == set(), "leaf certificates are not counted as issuers"
+
+    result = {"info": {"certificate_chain": ["leaf", fingerprint],
+                       "certificate_data": {fingerprint: base64.b64encode(der_data).decode("ascii")}}}
+    wp.store_certificates(cert_db, result)
+    assert cert_db.issuers == {fingerprint}, "issuers are remembered for new workers"
+
+
+def test_spare_pool(fake_app):
+    """Spare workers are kept between scans and handed out to the next scan"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(40)]
+    try:
+        results = wp.run_scans(fake_app, targets, num_workers=2, targets_per_worker=10, timeout=2, spare_workers=2)
+        assert len(results) == len(targets), "every host yields a result"
+        spares = [worker for spares in wp.spare_pool.spares.values() for worker in spares]
+        assert len(spares) == 2, "workers are kept as spares after the scan"
+        assert all(worker.xpcw.is_running() for worker in spares), "spare workers are running"
+
+        results = wp.run_scans(fake_app, targets, num_workers=2, targets_per_worker=10, timeout=2, spare_workers=2)
+        assert len(results) == len(targets), "every host yields a result with spare workers"
+        assert any(worker.requests > len(targets) // 2 for worker in spares), "spare workers are reused"
+    finally:
+        wp.shutdown()
+    assert len(wp.live_workers) == 0, "spare workers are stopped on shutdown"
+
+
+def test_worker_benchmark(fake_app):
+    """Worker benchmark measures per-chunk latency"""
+
+    chunks = [[(rank, "host%d.example.com" % rank) for rank in range(start, start + 20)] for start in (0, 20, 40)]
+    latencies = wb.benchmark_chunks(fake_app, chunks, spare_workers=2, num_workers=2, targets_per_worker=10,
+                                    timeout=2)
+    assert len(latencies) == len(chunks), "measures every chunk"
+    assert all(latency > 0 for latency in latencies), "latencies are positive"
+    assert len(wp.live_workers) == 0, "benchmark stops its workers"
+
+
+def test_confirm_regressions(fake_app):
+    """Regression confirmation drops hosts as soon as their results rule them out"""
+
+    targets = [(rank, "%s%d.example.com" % ("error" if rank % 10 == 0 else "regress" if rank % 10 == 1 else "host",
+                                            rank)) for rank in range(100)]
+    regressions = set(target for target in targets if target[1].startswith("regress"))
+    num_errors = len([target for target in targets if target[1].startswith("error")])
+    progress = []
+    overhead = []
+    results = []
+    confirmed = wp.run_in_loop(wp.confirm_regressions(fake_app, fake_app, targets, results.append,
+                                                      test_prefs=["tlscanary.fake.regress;true"], scans=3,
+                                                      num_workers=4, targets_per_worker=5, timeout=2, get_certs=True,
+                                                      info_workers=2, info_requests_per_worker=3,
+                                                      progress_callback=progress.append,
+                                                      overhead_callback=overhead.append))
+
+    assert confirmed == regressions, "only hosts that fail with the test build alone are confirmed"
+    assert set((result.rank, result.host) for result in results) == regressions, "every regression is reported"
+    assert all(result.response.result["info"]["certificate_chain"] is not None for result in results), \
+        "final scan collects certificates"
+    assert sum(progress) == len(targets), "first test scan reports progress for every host"
+    # Error hosts drop out after one base scan, regressions go through 3 base scans, 2 test rescans and an info scan
+    assert sum(overhead) == num_errors + len(regressions) * 6, "hosts drop out as soon as they are ruled out"
+    assert len(wp.live_workers) == 0, "workers of all stages are stopped after the run"
+
+    assert wp.run_in_loop(wp.confirm_regressions(fake_app, fake_app, [], results.append)) == set(), \
+        "empty target list is confirmed without workers"
+
+
+def test_confirm_regressions_worker_budget(fake_app):
+    """Regression confirmation keeps all stages within the worker budget"""
+
+    targets = [(rank, "%s%d.example.com" % ("error" if rank % 3 == 0 else "regress", rank)) for rank in range(30)]
+    for num_workers in (1, 2, 4):
+        peak = []
+
+        def sample(_):
+            peak.append(len(wp.live_workers))
+
+        confirmed = wp.run_in_loop(wp.confirm_regressions(fake_app, fake_app, targets, lambda _: None,
+                                                          test_prefs=["tlscanary.fake.regress;true"], scans=2,
+                                                          num_workers=num_workers, targets_per_worker=5, timeout=2,
+                                                          info_workers=2, progress_callback=sample,
+                                                          overhead_callback=sample))
+        assert len(confirmed) == 20, "all regressions are confirmed with %d workers" % num_workers
+        assert max(peak) <= num_workers, "no more than %d workers run at a time" % num_workers
+        assert len(wp.live_workers) == 0, "workers are stopped after the run"
+
+
+def test_confirm_regressions_with_base_cache(fake_app, tmpdir):
+    """Regression confirmation takes base outcomes from the result cache"""
+
+    targets = [(rank, "%s%d.example.com" % ("error" if rank % 2 == 0 else "regress", rank)) for rank in range(20)]
+    db_file = os.path.join(tmpdir, "base_results.sqlite")
+    for run in range(2):
+        base_cache = rc.ResultCache(db_file, "config")
+        overhead = []
+        confirmed = wp.run_in_loop(wp.confirm_regressions(fake_app, fake_app, targets, lambda _: None,
+                                                          test_prefs=["tlscanary.fake.regress;true"], scans=2,
+                                                          num_workers=2, targets_per_worker=5, timeout=2,
+                                                          overhead_callback=overhead.append, base_cache=base_cache))
+        base_cache.close()
+        assert len(confirmed) == 10, "cache does not change the outcome"
+        if run == 0:
+            assert base_cache.hits == 0, "first run has no cached outcomes"
+            # 10 base scans of error hosts, 2 base scans, 1 test rescan, and an info scan of regressions
+            assert sum(overhead) == 10 + 10 * 4, "first run scans all hosts with the base build"
+        else:
+            assert base_cache.hits == 20, "second run takes successful base outcomes from the cache"
+            assert base_cache.misses == 10, "base failures are not cached"
+            # Error hosts are scanned with the base build again, regressions skip their base scans
+            assert sum(overhead) == 10 + 10 * 2, "second run only rescans base failures"
+
+
+def test_target_queue():
+    """Target queue hands out targets until it is closed"""
+
+    loop = wp.new_event_loop()
+    try:
+        queue = wp.TargetQueue()
+        waiter = loop.create_task(queue.wait())
+        loop.run_until_complete(asyncio.sleep(0))
+        assert not waiter.done(), "empty queue makes consumers wait"
+        queue.put((1, "host1.example.com"))
+        loop.run_until_complete(waiter)
+        assert next(queue) == (1, "host1.example.com"), "queue hands out targets"
+        assert next(queue, None) is None, "empty queue has no targets for now"
+        assert not queue.exhausted(), "open queue is not exhausted"
+        queue.close()
+        loop.run_until_complete(queue.wait())
+        assert queue.exhausted(), "closed empty queue is exhausted"
+    finally:
+        loop.close()
+
+
+def test_scan_matrix(fake_app):
+    """Pref matrix scans every host once per pref set"""
+
+    targets = [(rank, "%s%d.example.com" % ("regress" if rank % 5 == 0 else "host", rank)) for rank in range(50)]
+    pref_sets = [("plain", []), ("marked", ["tlscanary.fake.regress;true"])]
+    results = {"plain": {}, "marked": {}}
+
+    def collect(name, result):
+        results[name][result.host] = result
+
+    counts = wp.run_in_loop(wp.scan_matrix(fake_app, targets, pref_sets, collect, num_workers=4,
+                                           targets_per_worker=5, timeout=2))
+
+    assert counts == {"plain": len(targets), "marked": len(targets)}, "every pref set scans every host"
+    assert all(result.success for result in results["plain"].values()), "hosts work without marker pref"
+    assert len([result for result in results["marked"].values() if not result.success]) == 10, \
+        "pref set prefs are applied to its workers"
+    assert len(wp.live_workers) == 0, "workers are stopped after the run"
+
+
+def test_scan_pairs(fake_app):
+    """Paired scans sample every host once per round with both builds"""
+
+    targets = [(rank, "%s%d.example.com" % ("error" if rank % 10 == 0 else "host", rank)) for rank in range(40)]
+    results = []
+
+    def collect(build, scan, result):
+        results.append((build, scan, result.host))
+
+    count = wp.run_in_loop(wp.scan_pairs(fake_app, fake_app, targets, collect, scans=3, num_workers=4,
+                                         targets_per_worker=2, timeout=2, rng=random.Random(1)))
+
+    assert count == 2 * 3 * len(targets), "every host is scanned once per build and round"
+    assert sorted(results) == sorted((build, scan, host) for build in ("test", "base") for scan in range(3)
+                                     for _, host in targets), "results are reported with build and round"
+    first = [host for build, scan, host in results if build == "test" and scan == 0]
+    assert first != [host for _, host in targets], "hosts are visited in random order"
+    # Pairs are released in lock-step, so one build never gets ahead by more than the pair window
+    lead = 0
+    for build, _, _ in results:
+        lead += 1 if build == "test" else -1
+        assert abs(lead) <= 2 * 2, "builds progress in lock-step"
+    assert len(wp.live_workers) == 0, "workers are stopped after the run"
+
+
+def test_scan_pairs_order(fake_app, monkeypatch):
+    """Paired scans send the request of the second build only after the first one"""
+
+    targets = [(rank, "host%d.example.com" % rank) for rank in range(20)]
+    first_sent = {}
+    second_sent = {}
+    first_builds = []
+    scan_host = wp.scan_host
+
+    async def recording_scan_host(worker, rank, host, sent_callback=None, **kwargs):
+        if sent_callback is None:
+            second_sent[host] = second_sent.get(host, 0) + 1
+            assert second_sent[host] <= first_sent.get(host, 0), "second request follows the first"
+            return await scan_host(worker, rank, host, **kwargs)
+
+        def on_sent():
+            first_sent[host] = first_sent.get(host, 0) + 1
+            first_builds.append(worker.prefs[0])
+            sent_callback()
+        return await scan_host(worker, rank, host, sent_callback=on_sent, **kwargs)
+
+    monkeypatch.setattr(wp, "scan_host", recording_scan_host)
+    count = wp.run_in_loop(wp.scan_pairs(fake_app, fake_app, targets, lambda *_: None, scans=2, num_workers=4,
+                                         targets_per_worker=5, timeout=2, test_prefs=["tlscanary.fake.build;test"],
+                                         base_prefs=["tlscanary.fake.build;base"], rng=random.Random(1)))
+
+    assert count == 2 * 2 * len(targets), "every host is scanned once per build and round"
+    assert sum(second_sent.values()) == 2 * len(targets), "every pair has a second request"
+    assert len(set(first_builds)) == 2, "either build may go first"
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
 import pytest
 from time import sleep
 
@@ -47,3 +48,35 @@ def test_xpcshell_worker(nightly_app):
 
     assert quit_response.id == 2, "Quit response has expected ID"
     assert info_response.success, "Quit command was successful"
+
+
+def test_async_xpcshell_worker(fake_app):
+    """Async XPCShell worker routes responses to their commands"""
+
+    async def exchange():
+        w = xw.AsyncXPCShellWorker(fake_app)
+        assert await w.spawn(), "worker can be spawned"
+        assert w.is_running(), "worker is running"
+        assert w.async_input, "worker reads commands asynchronously"
+        assert w.compact_responses, "worker agrees to compact responses"
+        scan = await w.send(xw.Command("scan", host="example.com", rank=1))
+        info_response = await w.request(xw.Command("info"))
+        ack = await scan.ack
+        scan_response = await scan.result
+        await w.quit()
+        return info_response, ack, scan_response, w
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        info_response, ack, scan_response, w = loop.run_until_complete(exchange())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    assert "appConstants" in info_response.result, "info request is answered"
+    assert ack.result == "ACK", "scan command is ACKed"
+    assert scan_response.success, "scan result is routed to scan command"
+    assert scan_response.original_cmd["args"]["host"] == "example.com", "scan result belongs to command"
+    assert scan_response.original_cmd["args"]["rank"] == 1, "compact response is completed from command table"
+    assert not w.is_running(), "worker quits"
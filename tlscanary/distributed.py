@@ -0,0 +1,438 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Distributed scanning across agent processes.
+
+A coordinator splits the target list into batches and hands them to agents
+over plain TCP connections. Each agent runs its own XPCShell workers and
+streams every ScanResult back as soon as it arrives, so the coordinator
+can write a single, merged run log.
+
+Messages are JSON objects, one per line. Every connection starts with a
+challenge from the agent, which the coordinator answers with an HMAC of the
+challenge under the secret they share. Then comes a `setup` message that
+tells the agent which build, profile and prefs to use, followed by any
+number of `scan` messages carrying batches of targets:
+
+    agent -> coordinator:  {"type": "challenge", "nonce": "..."}
+    coordinator -> agent:  {"type": "auth", "hmac": "..."}
+                           {"type": "setup", ...}
+                           {"type": "scan", "batch": 1, "targets": [[1, "a.com"], ...]}
+    agent -> coordinator:  {"type": "ready"}
+                           {"type": "result", "batch": 1, "result": {...}}
+                           {"type": "done", "batch": 1}
+"""
+
+import asyncio
+import base64
+from collections import deque
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import secrets
+import zipfile
+
+import tlscanary.worker_pool as wp
+from tlscanary.tools import xpcshell_worker as xw
+
+
+logger = logging.getLogger(__name__)
+
+# Number of batches an agent may work on at the same time. They share the worker budget.
+batches_per_agent = 2
+
+# Seconds between checks whether an agent can hand out more targets of a batch
+feed_interval = 0.1
+
+# Cache for zipped profiles, keyed by profile path
+profile_archives = {}
+
+
+def parse_address(address):
+    """
+    Convert `host:port` string to a (host, port) tuple
+
+    :param address: str
+    :return: (str, int)
+    """
+    host, _, port = address.strip().rpartition(":")
+    if host == "" or not port.isdigit():
+        raise ValueError("Invalid agent address `%s`, expected `host:port`" % address)
+    return host, int(port)
+
+
+def zip_profile(profile_path):
+    """
+    Return base64-encoded zip archive of a profile directory and its SHA-256 hash
+
+    :param profile_path: str
+    :return: (str, str)
+    """
+    global profile_archives
+
+    if profile_path not in profile_archives:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+            for root, _, files in os.walk(profile_path):
+                for f in sorted(files):
+                    file_name = os.path.join(root, f)
+                    z.write(file_name, os.path.relpath(file_name, profile_path))
+        data = buffer.getvalue()
+        profile_archives[profile_path] = (base64.b64encode(data).decode("ascii"), hashlib.sha256(data).hexdigest())
+    return profile_archives[profile_path]
+
+
+def auth_digest(secret, nonce):
+    """Return the answer to an agent's challenge"""
+    return hmac.new(secret.encode("utf-8"), nonce.encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def check_zip_members(z):
+    """Raise an exception if a zip archive has members that would be extracted outside its directory"""
+    for name in z.namelist():
+        parts = name.replace("\\", "/").split("/")
+        if name.startswith("/") or name.startswith("\\") or os.path.isabs(name) or ":" in parts[0] \
+                or ".." in parts:
+            raise Exception("Refusing to unpack profile member `%s`" % name)
+
+
+async def send_message(writer, message):
+    writer.write((json.dumps(message) + "\n").encode("utf-8"))
+    await writer.drain()
+
+
+async def read_message(reader):
+    """Return the next message, or None if the connection was closed"""
+    line = await reader.readline()
+    if line == b"":
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
+class AgentServer(object):
+    """
+    Agent side of distributed scanning. Serves setup and scan requests
+    from coordinators on connections accepted by asyncio.start_server().
+    """
+
+    def __init__(self, resolve_app, profile_dir, secret, protect_profile=None):
+        """
+        Constructor for AgentServer
+
+        :param resolve_app: function that returns a FirefoxApp for a build reference,
+                            may raise SystemExit for invalid references
+        :param profile_dir: str directory where received profiles are unpacked
+        :param secret: str secret shared with coordinators
+        :param protect_profile: optional function to make an unpacked profile read-only
+        """
+        if not secret:
+            raise ValueError("Agents require a shared secret")
+        self.resolve_app = resolve_app
+        self.profile_dir = profile_dir
+        self.secret = secret
+        self.protect_profile = protect_profile
+        self.apps = {}
+
+    def unpack_profile(self, profile):
+        """Unpack a received profile once per distinct archive and return its path"""
+        global logger
+
+        profile_path = os.path.join(self.profile_dir, profile["sha256"])
+        if not os.path.isdir(profile_path):
+            logger.debug("Unpacking profile `%s`" % profile["sha256"])
+            with zipfile.ZipFile(io.BytesIO(base64.b64decode(profile["zip"]))) as z:
+                check_zip_members(z)
+                z.extractall(profile_path)
+            if profile["read_only"] and self.protect_profile is not None:
+                self.protect_profile(profile_path)
+        return profile_path
+
+    def setup(self, message):
+        """Prepare app and profile for a coordinator's setup message"""
+        global logger
+
+        build = message["build"]
+        if build not in self.apps:
+            try:
+                self.apps[build] = self.resolve_app(build)
+            except SystemExit:
+                # Build resolution exits on unknown or broken builds, but the agent
+                # must keep serving other coordinators
+                raise Exception("Unable to get build `%s`" % build)
+        app = self.apps[build]
+
+        build_id = message.get("build_id")
+        if build_id is not None and app.application_ini.get("buildid") != build_id:
+            raise Exception("Build `%s` has ID `%s`, but coordinator uses ID `%s`"
+                            % (build, app.application_ini.get("buildid"), build_id))
+
+        profile = None
+        if message["profile"] is not None:
+            profile = self.unpack_profile(message["profile"])
+
+        return app, profile
+
+    async def handle_connection(self, reader, writer):
+        global logger
+
+        peer = writer.get_extra_info("peername")
+        logger.info("Coordinator %s connected" % str(peer))
+        batch_tasks = set()
+        try:
+            nonce = secrets.token_hex(32)
+            await send_message(writer, {"type": "challenge", "nonce": nonce})
+            message = await read_message(reader)
+            if message is None or message.get("type") != "auth" \
+                    or not hmac.compare_digest(str(message.get("hmac")), auth_digest(self.secret, nonce)):
+                raise Exception("Authentication failed")
+            message = await read_message(reader)
+            if message is None or message["type"] != "setup":
+                raise Exception("Expected setup message")
+            app, profile = self.setup(message)
+            prefs = message["prefs"]
+            options = message["options"]
+            await send_message(writer, {"type": "ready"})
+
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                if message["type"] != "scan":
+                    raise Exception("Unexpected `%s` message" % message["type"])
+                batch_tasks.add(asyncio.ensure_future(self.scan_batch(writer, message["batch"], message["targets"],
+                                                                      app, profile, prefs, options)))
+                batch_tasks = set(task for task in batch_tasks if not task.done())
+
+        except Exception as err:
+            logger.error("Error serving coordinator %s: %s" % (str(peer), err))
+            try:
+                await send_message(writer, {"type": "error", "message": str(err)})
+            except (IOError, ConnectionError):
+                pass
+
+        finally:
+            for task in batch_tasks:
+                task.cancel()
+            writer.close()
+            logger.info("Coordinator %s disconnected" % str(peer))
+
+    async def scan_batch(self, writer, batch, targets, app, profile, prefs, options):
+        global logger
+
+        logger.debug("Scanning batch %d of %d hosts" % (batch, len(targets)))
+
+        def send_result(result):
+            writer.write((json.dumps({"type": "result", "batch": batch, "result": result.as_dict()}) + "\n")
+                         .encode("utf-8"))
+
+        queue = wp.TargetQueue()
+        pending = deque(tuple(target) for target in targets)
+        window = options["num_workers"] * options["targets_per_worker"]
+
+        async def feed():
+            # Only hand out more targets while the coordinator keeps up with reading
+            # results, so unsent results can't pile up in memory
+            while len(pending) > 0:
+                await writer.drain()
+                while len(queue) < window and len(pending) > 0:
+                    queue.put(pending.popleft())
+                await asyncio.sleep(feed_interval)
+            queue.close()
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            await wp.scan_stream(app, queue, send_result, profile=profile,
+                                 prefs=prefs, num_workers=options["num_workers"],
+                                 targets_per_worker=options["targets_per_worker"], get_certs=options["get_certs"],
+                                 timeout=options["timeout"], max_requests=options["max_requests"],
+                                 max_rss=options["max_rss"], adaptive=options["adaptive"],
+                                 spare_workers=options["spare_workers"])
+            await send_message(writer, {"type": "done", "batch": batch})
+        except (IOError, ConnectionError) as err:
+            logger.debug("Unable to send results of batch %d: %s" % (batch, err))
+        except Exception as err:
+            logger.error("Error scanning batch %d: %s" % (batch, err))
+            await send_message(writer, {"type": "error", "message": str(err)})
+        finally:
+            feeder.cancel()
+
+
+class Coordinator(object):
+    """
+    Coordinator side of distributed scanning. Hands out batches of targets to
+    agents and collects their results. Batches of agents that fail are handed
+    to the remaining agents.
+    """
+
+    def __init__(self, agents, setup_message, batch_size, result_callback, secret=None,
+                 concurrent_batches=batches_per_agent):
+        self.agents = agents
+        self.setup_message = setup_message
+        self.batch_size = batch_size
+        self.result_callback = result_callback
+        self.secret = secret
+        self.concurrent_batches = concurrent_batches
+        self.queue = deque()
+        self.next_batch = 1
+        self.unfinished = 0
+        self.changed = asyncio.Event()
+
+    def enqueue(self, targets):
+        for i in range(0, len(targets), self.batch_size):
+            self.queue.append((self.next_batch, targets[i:i + self.batch_size]))
+            self.next_batch += 1
+            self.unfinished += 1
+
+    async def run(self):
+        await asyncio.gather(*[self.drive_agent(agent) for agent in self.agents])
+
+    async def drive_agent(self, agent):
+        global logger
+
+        in_flight = {}
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(agent[0], agent[1], limit=xw.max_message_size)
+            message = await read_message(reader)
+            if message is None or message["type"] != "challenge":
+                raise Exception("connection closed before authentication")
+            if not self.secret:
+                raise Exception("no agent secret given")
+            await send_message(writer, {"type": "auth", "hmac": auth_digest(self.secret, message["nonce"])})
+            await send_message(writer, self.setup_message)
+            message = await read_message(reader)
+            if message is None or message["type"] != "ready":
+                raise Exception(message["message"] if message is not None else "connection closed during setup")
+            logger.info("Agent %s:%d is ready" % agent)
+
+            while self.unfinished > 0:
+                # Keep the agent busy with a few batches at a time
+                while len(in_flight) < self.concurrent_batches and len(self.queue) > 0:
+                    batch, targets = self.queue.popleft()
+                    in_flight[batch] = dict((host, rank) for rank, host in targets)
+                    await send_message(writer, {"type": "scan", "batch": batch, "targets": targets})
+
+                if len(in_flight) == 0:
+                    # Wait for failing agents to return batches to the queue
+                    self.changed.clear()
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                message = await read_message(reader)
+                if message is None:
+                    raise Exception("connection closed")
+                if message["type"] == "result":
+                    result = wp.ScanResult.from_dict(message["result"])
+                    in_flight[message["batch"]].pop(result.host, None)
+                    self.result_callback(result)
+                elif message["type"] == "done":
+                    remaining = in_flight.pop(message["batch"])
+                    if len(remaining) > 0:
+                        logger.warning("Agent %s:%d dropped %d results" % (agent[0], agent[1], len(remaining)))
+                    self.unfinished -= 1
+                    self.changed.set()
+                elif message["type"] == "error":
+                    raise Exception(message["message"])
+
+        except Exception as err:
+            logger.error("Agent %s:%d failed: %s" % (agent[0], agent[1], err))
+            # Return unanswered targets to the queue
+            for batch, remaining in in_flight.items():
+                self.queue.append((batch, [(rank, host) for host, rank in remaining.items()]))
+            self.changed.set()
+
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def scan_stream(agents, app, target_list, result_callback, profile=None, prefs=None, num_workers=4,
+                      targets_per_worker=50, get_certs=False, timeout=10, progress_callback=None,
+                      max_requests=None, max_rss=None, adaptive=False, read_only_profile=True, batch_size=None,
+                      spare_workers=0, secret=None):
+    """
+    Coroutine that distributes scans across agents, falling back to local workers if all agents fail.
+    Every ScanResult is passed to `result_callback` as it arrives.
+
+    Every agent runs `num_workers` workers, split across the batches it works on at the same time.
+    `secret` is the secret shared with the agents.
+    """
+    global logger
+
+    def collect(result):
+        result_callback(result)
+        if progress_callback is not None:
+            progress_callback(1)
+
+    profile_message = None
+    if profile is not None:
+        profile_zip, profile_hash = zip_profile(profile)
+        profile_message = {"zip": profile_zip, "sha256": profile_hash, "read_only": read_only_profile}
+
+    concurrent_batches = max(1, min(batches_per_agent, num_workers))
+
+    setup_message = {
+        "type": "setup",
+        "build": app.build_spec,
+        "build_id": app.application_ini.get("buildid"),
+        "profile": profile_message,
+        "prefs": prefs,
+        "options": {
+            "num_workers": max(1, num_workers // concurrent_batches),
+            "targets_per_worker": targets_per_worker,
+            "get_certs": get_certs,
+            "timeout": timeout,
+            "max_requests": max_requests,
+            "max_rss": max_rss,
+            "adaptive": adaptive,
+            "spare_workers": spare_workers // concurrent_batches
+        }
+    }
+
+    if batch_size is None:
+        batch_size = 4 * num_workers * targets_per_worker
+
+    coordinator = Coordinator(agents, setup_message, batch_size, collect, secret=secret,
+                              concurrent_batches=concurrent_batches)
+    coordinator.enqueue(list(target_list))
+    await coordinator.run()
+
+    # Scan whatever the agents left behind locally
+    leftovers = [target for _, targets in coordinator.queue for target in targets]
+    if len(leftovers) > 0:
+        logger.warning("No agent left to scan %d hosts. Scanning them locally" % len(leftovers))
+        local_count = await wp.scan_stream(app, leftovers, collect, profile=profile, prefs=prefs,
+                                           num_workers=num_workers, targets_per_worker=targets_per_worker,
+                                           get_certs=get_certs, timeout=timeout,
+                                           max_requests=max_requests, max_rss=max_rss, adaptive=adaptive,
+                                           spare_workers=spare_workers)
+        logger.debug("Local fallback yielded %d results" % local_count)
+
+
+async def scan_hosts(agents, app, target_list, **kwargs):
+    """Coroutine variant of scan_stream() that returns a dict of all ScanResults by host"""
+    results = {}
+
+    def collect(result):
+        results[result.host] = result
+
+    await scan_stream(agents, app, target_list, collect, **kwargs)
+    return results
+
+
+def iter_scans(agents, app, target_list, **kwargs):
+    """Distributed variant of worker_pool.iter_scans() with a list of (host, port) agent addresses"""
+    return wp.iter_in_loop(lambda result_callback: scan_stream(agents, app, target_list, result_callback, **kwargs))
+
+
+def run_scans(agents, app, target_list, **kwargs):
+    """Distributed variant of worker_pool.run_scans() with a list of (host, port) agent addresses"""
+    return wp.run_in_loop(scan_hosts(agents, app, target_list, **kwargs))
@@ -4,6 +4,51 @@
 
 "use strict";
 
+// SHA-256 fingerprints of certificates that the Python world already has
+let known_certificates = new Set();
+
+function der_to_base64(cert) {
+    // Encode raw DER certificate data compactly for the JSON response
+    let der = cert.getRawDER({});
+    let binary = "";
+    for (let i = 0; i < der.length; i++) {
+        binary += String.fromCharCode(der[i]);
+    }
+    return btoa(binary);
+}
+
+// Channel timestamps reported in the timing info, in milliseconds since the request was opened
+const TIMING_FIELDS = {
+    domain_lookup_start: "domainLookupStartTime",
+    domain_lookup_end: "domainLookupEndTime",
+    connect_start: "connectStartTime",
+    secure_connection_start: "secureConnectionStartTime",
+    connect_end: "connectEndTime",
+    request_start: "requestStartTime",
+    response_start: "responseStartTime"
+};
+
+function collect_timing_info(channel) {
+    // Phase timestamps of the channel, taken by necko itself and thus free of
+    // the event loop latency of this worker. Timestamps that were not reached,
+    // for example on a reused connection, are null.
+    let timed_channel;
+    try {
+        timed_channel = channel.QueryInterface(Ci.nsITimedChannel);
+    } catch (e) {
+        return null;
+    }
+    if (!timed_channel.timingEnabled || timed_channel.asyncOpenTime === 0)
+        return null;
+    let timing = {};
+    for (let key in TIMING_FIELDS) {
+        let value = timed_channel[TIMING_FIELDS[key]];
+        // nsITimedChannel times are PRTime microseconds
+        timing[key] = value ? (value - timed_channel.asyncOpenTime) / 1000 : null;
+    }
+    return timing;
+}
+
 function collect_request_info(xhr, report_certs) {
     // This function copies and parses various properties of the connection state object
     // and wraps them into an info object to be returned with the command response.
@@ -22,6 +67,8 @@ function collect_request_info(xhr, report_certs) {
         info.error_class = null;
     }
 
+    info.timing = collect_timing_info(xhr.channel);
+
     info.security_info_status = false;
     info.security_state_status = false;
     info.security_state = null;
@@ -30,6 +77,7 @@ function collect_request_info(xhr, report_certs) {
     info.certified_usages = null;
     info.certificate_chain_length = null;
     info.certificate_chain = null;
+    info.certificate_chain_encoding = null;
     info.error_code = null;
     info.raw_error = null;
     info.short_error_message = null;
@@ -112,12 +160,14 @@ function collect_request_info(xhr, report_certs) {
         print("WARNING: securityInfo has no errorCode");
     }
 
-    // Extract certificate objects if requested
+    // Extract certificate objects if requested. `report_certs` is the chain encoding:
+    // "base64" sends DER data of every chain element, "sha256" sends fingerprints
+    // and adds DER data only for certificates that weren't sent before.
     if (info.ssl_status_status && report_certs) {
         let server_cert = info.ssl_status.serverCert;
-        let cert_chain = [];
+        let certs = [];
         if (server_cert.sha1Fingerprint) {
-            cert_chain.push(server_cert.getRawDER({}));
+            certs.push(server_cert);
             let chain = [];
             if (info.ssl_status.succeededCertChain != null) {
                 chain = info.ssl_status.succeededCertChain;
@@ -130,11 +180,26 @@ function collect_request_info(xhr, report_certs) {
             let cert_enumerator = XPCOMUtils.IterSimpleEnumerator ?
                 XPCOMUtils.IterSimpleEnumerator(enumerator, Ci.nsIX509Cert) : enumerator;
             for (let cert of cert_enumerator) {
-                cert_chain.push(cert);
+                certs.push(cert);
             }
         }
+        let cert_chain = [];
+        if (report_certs === "sha256") {
+            info.certificate_data = {};
+            for (let cert of certs) {
+                let fingerprint = cert.sha256Fingerprint.replace(/:/g, "").toLowerCase();
+                if (!known_certificates.has(fingerprint)) {
+                    info.certificate_data[fingerprint] = der_to_base64(cert);
+                    known_certificates.add(fingerprint);
+                }
+                cert_chain.push(fingerprint);
+            }
+        } else {
+            cert_chain = certs.map(der_to_base64);
+        }
         info.certificate_chain_length = cert_chain.length;
         info.certificate_chain = cert_chain;
+        info.certificate_chain_encoding = report_certs;
     }
 
     // Some values might be missing from the connection state, for example due
@@ -161,7 +226,10 @@ function collect_request_info(xhr, report_certs) {
 function scan_host(args, response_cb) {
 
     let host = args.host;
-    let report_certs = args.include_certificates === true;
+    let report_certs = null;
+    if (args.include_certificates === true) {
+        report_certs = args.certificate_fingerprints === true ? "sha256" : "base64";
+    }
 
     function load_handler(msg) {
         if (msg.target.readyState === 4) {
@@ -206,6 +274,8 @@ function scan_host(args, response_cb) {
             | Ci.nsIRequest.INHIBIT_PERSISTENT_CACHING
             | Ci.nsIRequest.VALIDATE_NEVER;
         request.channel.notificationCallbacks = new RedirectStopper();
+        if (request.channel instanceof Ci.nsITimedChannel)
+            request.channel.QueryInterface(Ci.nsITimedChannel).timingEnabled = true;
         request.addEventListener("load", load_handler, false);
         request.addEventListener("error", error_handler, false);
         request.addEventListener("abort", abort_handler, false);
@@ -218,6 +288,29 @@ function scan_host(args, response_cb) {
     }
 }
 
+function add_known_certificates(args, response_cb) {
+    for (let fingerprint of args.fingerprints) {
+        known_certificates.add(fingerprint);
+    }
+    response_cb(true, {known_certificates: known_certificates.size});
+}
+
+function trust_roots(args, response_cb) {
+    // Add root certificates that are trusted for TLS server authentication to the profile's certificate DB
+    let cert_db = Cc["@mozilla.org/security/x509certdb;1"].getService(Ci.nsIX509CertDB);
+    try {
+        for (let certificate of args.certificates) {
+            cert_db.addCertFromBase64(certificate, "C,,");
+        }
+    } catch (error) {
+        response_cb(false, {origin: "trust_roots", error: error.toString()});
+        return;
+    }
+    response_cb(true, {trusted_roots: args.certificates.length});
+}
+
 register_command("scan", scan_host);
+register_command("knowncerts", add_known_certificates);
+register_command("trustroots", trust_roots);
 
 run_loop();
\ No newline at end of file
@@ -11,12 +11,16 @@ const DEFAULT_TIMEOUT = 10000;
 // This is a global random ID that is sent with every message to the Python world
 const worker_id = Math.floor(Math.random() * 2**64);
 
+// Compact responses omit the original command. The Python world tracks commands by ID instead.
+// Enabled by the `hello` command.
+let compact_responses = false;
+
 
 Cu.import("resource://gre/modules/Services.jsm");
 Cu.import("resource://gre/modules/XPCOMUtils.jsm");
 Cu.import("resource://gre/modules/NetUtil.jsm");
 Cu.import("resource://gre/modules/AppConstants.jsm");
-Cu.importGlobalProperties(["XMLHttpRequest"]);
+Cu.importGlobalProperties(["XMLHttpRequest", "btoa"]);
 
 let custom_commands = [];
 
@@ -165,15 +169,18 @@ function Command(json_string) {
 // Even though it's a prototype method it will require bind when passed as callback.
 Command.prototype.send_response = function _report_result(success, result) {
     // Send a response back to the python world
-    print(JSON.stringify({
+    let response = {
         "id": this.id,
         "worker_id": worker_id,
-        "original_cmd": this.original_cmd,
         "success": success,
         "result": result,
         "command_time": this.start_time.getTime(),
         "response_time": new Date().getTime(),
-    }));
+    };
+    if (!compact_responses) {
+        response.original_cmd = this.original_cmd;
+    }
+    print(JSON.stringify(response));
 };
 
 Command.prototype.handle = function _handle() {
@@ -189,6 +196,12 @@ Command.prototype.handle = function _handle() {
             set_prefs(this.args.prefs);
             this.send_response(true, "ACK");
             break;
+        case "hello":
+            if (this.args && this.args.compact_responses) {
+                compact_responses = true;
+            }
+            this.send_response(true, {async_input: async_input, compact_responses: compact_responses});
+            break;
         case "quit":
             script_done = true;
             // Intentional fall-through
@@ -208,20 +221,87 @@ Command.prototype.handle = function _handle() {
 };
 
 
-// The main loop only reads and handles commands from stdin.
+// The main loop processes events while commands from stdin are handled as they arrive.
 let script_done = false;
+let async_input = false;
 let thread_manager = Cc["@mozilla.org/thread-manager;1"].getService(Ci.nsIThreadManager);
 let main_thread = thread_manager.mainThread;
 
-function run_loop() {
-    while (!script_done) {
-        let cmd = null;
-        try {
-            cmd = new Command(readline());
-            cmd.handle();
-        } catch (error) {
-            print(error);
+function handle_line(line) {
+    try {
+        let cmd = new Command(line);
+        cmd.handle();
+    } catch (error) {
+        print(error);
+    }
+}
+
+// Listener for the input stream pump that reads stdin on a background thread
+// and hands the data to the main thread, where it is split into command lines.
+let input_listener = {
+    buffer: "",
+    onStartRequest: function(request) {},
+    // The `context` argument was removed in Firefox 68, so the stream
+    // and count are always the last two arguments.
+    onDataAvailable: function() {
+        let count = arguments[arguments.length - 1];
+        let stream = arguments[arguments.length - 2];
+        this.buffer += NetUtil.readInputStreamToString(stream, count);
+        let lines = this.buffer.split("\n");
+        this.buffer = lines.pop();
+        for (let line of lines) {
+            if (line.length > 0) {
+                // Raw bytes were read, so decode UTF-8 per complete line.
+                handle_line(decodeURIComponent(escape(line)));
+            }
         }
+    },
+    onStopRequest: function(request) {
+        // stdin was closed by the Python world
+        script_done = true;
+    },
+    QueryInterface: generateQI([Ci.nsIStreamListener, Ci.nsIRequestObserver])
+};
+
+function start_async_input() {
+    // stdin is only accessible as a file on POSIX systems
+    let stdin_file = Cc["@mozilla.org/file/local;1"].createInstance(Ci.nsIFile);
+    stdin_file.initWithPath("/dev/stdin");
+    if (!stdin_file.exists()) {
+        return false;
+    }
+    let stream = Cc["@mozilla.org/network/file-input-stream;1"].createInstance(Ci.nsIFileInputStream);
+    stream.init(stdin_file, -1, 0, 0);
+    let pump = Cc["@mozilla.org/network/input-stream-pump;1"].createInstance(Ci.nsIInputStreamPump);
+    // Blocking streams are read on a stream transport thread. The init() signature
+    // lost its `streamPos` and `streamLen` arguments in Firefox 57.
+    try {
+        pump.init(stream, 0, 0, true);
+    } catch (error) {
+        pump.init(stream, -1, -1, 0, 0, true);
     }
+    pump.asyncRead(input_listener, null);
+    return true;
 }
 
+function run_loop() {
+    try {
+        async_input = start_async_input();
+    } catch (error) {
+        print("WARNING: unable to read stdin asynchronously: " + error);
+        async_input = false;
+    }
+
+    if (async_input) {
+        // Network callbacks and incoming commands are all just events
+        while (!script_done) {
+            main_thread.processNextEvent(true);
+        }
+    } else {
+        // Fallback where commands are read by blocking on stdin. Events
+        // are only processed when the Python world sends `wakeup` commands.
+        while (!script_done) {
+            handle_line(readline());
+        }
+    }
+}
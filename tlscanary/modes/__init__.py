@@ -2,14 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from . import agent
 from . import basemode
+from . import handshake
 from . import performance
+from . import prefmatrix
 from . import regression
 from . import log
 from . import scan
 from . import sourceupdate
 
-__all__ = ["log", "performance", "regression", "scan", "sourceupdate"]
+__all__ = ["agent", "handshake", "log", "performance", "prefmatrix", "regression", "scan", "sourceupdate"]
 
 
 def __subclasses_of(cls):
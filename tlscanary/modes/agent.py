@@ -0,0 +1,71 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import os
+import sys
+
+from .basemode import BaseMode
+import tlscanary.distributed as dist
+import tlscanary.worker_pool as wp
+
+
+logger = logging.getLogger(__name__)
+
+
+class AgentMode(BaseMode):
+    """
+    Mode that runs scans on behalf of a coordinating tlscanary instance
+    """
+
+    name = "agent"
+    help = "Serve scan requests from tlscanary instances started with --agents"
+
+    @classmethod
+    def setup_args(cls, parser):
+        group = parser.add_argument_group("agent configuration")
+        group.add_argument("-L", "--listen",
+                           help="Address to listen on for coordinators (default: 127.0.0.1:8765)",
+                           type=dist.parse_address,
+                           action="store",
+                           default=("127.0.0.1", 8765))
+        group.add_argument("-S", "--secret",
+                           help="Secret shared with coordinators, who pass it with --agent_secret "
+                                "(default: from TLSCANARY_AGENT_SECRET environment variable)",
+                           action="store",
+                           default=os.environ.get("TLSCANARY_AGENT_SECRET"))
+
+    def __init__(self, args, module_dir, tmp_dir):
+        super(AgentMode, self).__init__(args, module_dir, tmp_dir)
+        self.server = None
+
+    def setup(self):
+        global logger
+
+        if not self.args.secret:
+            logger.critical("Agents require a shared secret, use --secret or TLSCANARY_AGENT_SECRET")
+            sys.exit(5)
+        profile_dir = os.path.join(self.tmp_dir, "agent_profiles")
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        self.server = dist.AgentServer(self.get_test_candidate, profile_dir, self.args.secret,
+                                       protect_profile=self.protect_profile)
+
+    def run(self):
+        global logger
+
+        host, port = self.args.listen
+        logger.info("Agent listening on %s:%d" % (host, port))
+
+        async def serve():
+            server = await asyncio.start_server(self.server.handle_connection, host, port)
+            try:
+                # Serve until interrupted by Ctrl-C
+                while True:
+                    await asyncio.sleep(3600)
+            finally:
+                server.close()
+
+        wp.run_in_loop(serve())
@@ -12,8 +12,10 @@ import stat
 import sys
 import zipfile
 
+import tlscanary.distributed as dist
 import tlscanary.sources_db as sdb
 import tlscanary.worker_pool as wp
+import tlscanary.tools.autosize as autosize
 import tlscanary.tools.firefox_app as fa
 import tlscanary.tools.firefox_downloader as fd
 import tlscanary.tools.firefox_extractor as fe
@@ -24,6 +26,13 @@ import tlscanary.tools.xpcshell_worker as xw
 logger = logging.getLogger(__name__)
 
 
+def int_or_auto(arg):
+    """Argument type for settings that are either an int or `auto`"""
+    if arg == "auto":
+        return arg
+    return int(arg)
+
+
 class BaseMode(object):
     """
     Generic Test Mode
@@ -107,8 +116,9 @@ class BaseMode(object):
 
         group = parser.add_argument_group("worker configuration")
         group.add_argument("-j", "--parallel",
-                           help="Number of parallel worker instances (default: 4)",
-                           type=int,
+                           help="Number of parallel worker instances, or `auto` to pick from CPU cores, "
+                                "available memory and worker size (default: 4)",
+                           type=int_or_auto,
                            action="store",
                            default=4)
         group.add_argument("-m", "--timeout",
@@ -117,10 +127,61 @@ class BaseMode(object):
                            action="store",
                            default=10)
         group.add_argument("-n", "--requestsperworker",
-                           help="Number of requests per worker (default: 50)",
-                           type=int,
+                           help="Number of requests each worker keeps in flight, or `auto` to pick from CPU cores "
+                                "and number of workers (default: 50)",
+                           type=int_or_auto,
                            action="store",
                            default=50)
+        group.add_argument("--agents",
+                           help="Comma-separated list of `host:port` addresses of agents to distribute scans to",
+                           type=lambda arg: [dist.parse_address(address) for address in arg.split(",")],
+                           action="store",
+                           default=None)
+        group.add_argument("--agent_secret",
+                           help="Secret shared with the agents "
+                                "(default: from TLSCANARY_AGENT_SECRET environment variable)",
+                           action="store",
+                           default=os.environ.get("TLSCANARY_AGENT_SECRET"))
+        group.add_argument("--adaptive",
+                           help="Adapt requests in flight per worker to timeout rates and response times, "
+                                "starting at --requestsperworker",
+                           action="store_true",
+                           default=False)
+        group.add_argument("--spare_workers",
+                           help="Number of workers to keep spawned and configured ahead of time, "
+                                "so scans don't wait for worker start-up (default: 0)",
+                           type=int,
+                           action="store",
+                           default=0)
+        group.add_argument("--info_parallel",
+                           help="Number of workers for the final information extraction scan of "
+                                "regression mode (default: 2)",
+                           type=int,
+                           action="store",
+                           default=2)
+        group.add_argument("--info_requestsperworker",
+                           help="Number of requests each worker of the final information extraction scan "
+                                "keeps in flight (default: 5)",
+                           type=int,
+                           action="store",
+                           default=5)
+        group.add_argument("--base_cache_ttl",
+                           help="Hours for which regression mode reuses outcomes of baseline candidate scans "
+                                "from earlier runs with the same build, prefs, and profile. Only successful "
+                                "outcomes are reused. 0 disables the cache (default: 0)",
+                           type=float,
+                           action="store",
+                           default=0)
+        group.add_argument("--recycle_requests",
+                           help="Number of requests after which a persistent worker is recycled (default: 5000)",
+                           type=int,
+                           action="store",
+                           default=5000)
+        group.add_argument("--recycle_rss",
+                           help="Worker memory size in MB above which it is recycled (default: 1500)",
+                           type=int,
+                           action="store",
+                           default=1500)
         group.add_argument("-u", "--max_timeout",
                            help="Maximum timeout for worker requests (default: 20)",
                            type=float,
@@ -148,6 +209,7 @@ class BaseMode(object):
         self.mode = args.mode
         self.module_dir = module_dir
         self.tmp_dir = tmp_dir
+        self.worker_autosize = None
 
     def get_test_candidate(self, build):
         """
@@ -206,6 +268,7 @@ class BaseMode(object):
             logger.critical("Valid Firefox release identifiers are: %s" % ", ".join(fd.FirefoxDownloader.list()[0]))
             sys.exit(5)
 
+        candidate_app.build_spec = build
         logger.debug("Build candidate executable is `%s`" % candidate_app.exe)
         if candidate_app.platform != platform:
             logger.warning("Platform mismatch detected")
@@ -230,6 +293,24 @@ class BaseMode(object):
         result["platform"] = app.platform
         return result
 
+    def auto_size_workers(self, app):
+        """
+        Replace `auto` values of -j/--parallel and -n/--requestsperworker with values
+        picked for this machine and a probe worker of the given app. The measurements
+        are kept in .worker_autosize for the run log meta.
+        :param app: FirefoxApp to run workers with
+        :return: None
+        """
+        if self.args.parallel != "auto" and self.args.requestsperworker != "auto":
+            return
+
+        max_rss = None if self.args.recycle_rss is None else self.args.recycle_rss * 1024 * 1024
+        self.worker_autosize = autosize.auto_size(app, max_rss=max_rss)
+        if self.args.parallel == "auto":
+            self.args.parallel = self.worker_autosize["parallel"]
+        if self.args.requestsperworker == "auto":
+            self.args.requestsperworker = self.worker_autosize["requestsperworker"]
+
     def make_profile(self, profile_name, one_crl_env='production'):
         global logger
 
@@ -273,13 +354,17 @@ class BaseMode(object):
 
         logger.debug("Allow profile cache: %s" % self.args.cache)
         if not self.args.cache:
-            # make all files in profiles read-only to prevent caching
-            for root, dirs, files in os.walk(new_profile_dir, topdown=False):
-                for name in files:
-                    os.chmod(os.path.join(root, name), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            self.protect_profile(new_profile_dir)
 
         return new_profile_dir
 
+    @staticmethod
+    def protect_profile(profile_dir):
+        """Make all files in a profile read-only to prevent caching"""
+        for root, dirs, files in os.walk(profile_dir, topdown=False):
+            for name in files:
+                os.chmod(os.path.join(root, name), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
     @staticmethod
     def save_profile(profile_path, profile_name, log):
         global logger
@@ -303,9 +388,19 @@ class BaseMode(object):
             log.meta["profiles"] = []
         log.meta["profiles"].append({"name": profile_name, "log_part": log_part})
 
-    def run_test(self, app, url_list, profile=None, prefs=None, num_workers=None, n_per_worker=None, timeout=None,
-                 get_info=False, get_certs=False, return_only_errors=True, report_callback=None):
-
+    def iter_test(self, app, url_list, profile=None, prefs=None, num_workers=None, n_per_worker=None, timeout=None,
+                  get_certs=False, return_only_errors=True, report_callback=None, cert_db=None,
+                  event_callback=None):
+        """
+        Generator that yields ScanResult objects as soon as workers report them
+
+        :param app: FirefoxApp to scan with
+        :param url_list: iterable of (rank, host) tuples
+        :param return_only_errors: bool, skip results of successful connections
+        :param cert_db: optional CertDB that local workers store certificates in
+        :param event_callback: optional function that local workers report scan events to
+        :return: generator of ScanResult
+        """
         global logger
 
         # Default to values from args
@@ -316,30 +411,46 @@ class BaseMode(object):
         if timeout is None:
             timeout = self.args.timeout
 
+        if self.args.agents is not None:
+            results = dist.iter_scans(self.args.agents, app, list(url_list), profile=profile, prefs=prefs,
+                                      num_workers=num_workers, targets_per_worker=n_per_worker, timeout=timeout,
+                                      get_certs=get_certs, progress_callback=report_callback,
+                                      max_requests=self.args.recycle_requests, max_rss=self.args.recycle_rss,
+                                      adaptive=self.args.adaptive, read_only_profile=not self.args.cache,
+                                      spare_workers=self.args.spare_workers, secret=self.args.agent_secret)
+        else:
+            results = wp.iter_scans(app, list(url_list), profile=profile, prefs=prefs, num_workers=num_workers,
+                                    targets_per_worker=n_per_worker, timeout=timeout,
+                                    get_certs=get_certs, progress_callback=report_callback,
+                                    max_requests=self.args.recycle_requests, max_rss=self.args.recycle_rss,
+                                    adaptive=self.args.adaptive, cert_db=cert_db, event_callback=event_callback,
+                                    spare_workers=self.args.spare_workers)
+
         try:
-            results = wp.run_scans(app, list(url_list), profile=profile, prefs=prefs, num_workers=num_workers,
-                                   targets_per_worker=n_per_worker, timeout=timeout,
-                                   get_certs=get_certs, progress_callback=report_callback)
+            for result in results:
+                if return_only_errors and result.success:
+                    continue
+                yield result
 
         except KeyboardInterrupt:
             logger.critical('User abort')
             wp.stop()
             sys.exit(1)
 
+    def run_test(self, app, url_list, profile=None, prefs=None, num_workers=None, n_per_worker=None, timeout=None,
+                 get_info=False, get_certs=False, return_only_errors=True, report_callback=None,
+                 event_callback=None):
+
         run_results = set()
 
-        for host in results:
-            if return_only_errors:
-                if not results[host].success:
-                    if get_info:
-                        run_results.add((results[host].rank, host, results[host]))
-                    else:
-                        run_results.add((results[host].rank, host))
+        for result in self.iter_test(app, url_list, profile=profile, prefs=prefs, num_workers=num_workers,
+                                     n_per_worker=n_per_worker, timeout=timeout, get_certs=get_certs,
+                                     return_only_errors=return_only_errors, report_callback=report_callback,
+                                     event_callback=event_callback):
+            if get_info:
+                run_results.add((result.rank, result.host, result))
             else:
-                if get_info:
-                    run_results.add((results[host].rank, host, results[host]))
-                else:
-                    run_results.add((results[host].rank, host))
+                run_results.add((result.rank, result.host))
 
         return run_results
 
@@ -364,4 +475,4 @@ class BaseMode(object):
         Clean up steps required after a mode run.
         :return: None
         """
-        pass
+        wp.shutdown()
@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import stat
+import sys
+
+from .performance import PerformanceMode
+from tlscanary.tools import tls_farm
+import tlscanary.tools.xpcshell_worker as xw
+import tlscanary.worker_pool as wp
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the worker that adds the farm roots to a profile
+trust_timeout = 60
+
+
+def parse_key_types(arg):
+    """
+    Parse a comma-separated list of server key types
+
+    :param arg: str argument
+    :return: list of str key types
+    """
+    key_types = [key_type for key_type in arg.split(",") if key_type != ""]
+    for key_type in key_types:
+        if key_type not in tls_farm.key_generators:
+            raise argparse.ArgumentTypeError("Unsupported key type `%s`" % key_type)
+    return key_types
+
+
+def parse_chain_lengths(arg):
+    """
+    Parse a comma-separated list of certificate chain lengths
+
+    :param arg: str argument
+    :return: list of int chain lengths
+    """
+    try:
+        chain_lengths = [int(chain_length) for chain_length in arg.split(",") if chain_length != ""]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Chain lengths must be integer numbers")
+    for chain_length in chain_lengths:
+        if chain_length < 2:
+            raise argparse.ArgumentTypeError("Chain lengths include leaf and root and must be at least 2")
+    return chain_lengths
+
+
+class HandshakeMode(PerformanceMode):
+
+    name = "handshake"
+    help = "Benchmark TLS handshakes of two Firefox versions against a local TLS server farm"
+
+    @classmethod
+    def setup_args(cls, parser):
+        super(HandshakeMode, cls).setup_args(parser)
+
+        group = parser.add_argument_group(title="handshake benchmark",
+                                          description="The server farm is a threaded Python server, so its side of "
+                                                      "every handshake is bound by the Python GIL. With more than "
+                                                      "one worker, server load adds noise to the timings.")
+        group.add_argument("--key_types",
+                           help="Comma-separated list of server key types, any of {%s} (default: rsa2048,ecdsa256)"
+                                % ",".join(sorted(tls_farm.key_generators)),
+                           type=parse_key_types,
+                           default=["rsa2048", "ecdsa256"])
+        group.add_argument("--chain_lengths",
+                           help="Comma-separated list of certificate chain lengths, counting leaf and root "
+                                "(default: 2,3)",
+                           type=parse_chain_lengths,
+                           default=[2, 3])
+        group.add_argument("--farm_hosts",
+                           help="Number of host names per key type and chain length (default: 50)",
+                           type=int,
+                           default=50)
+
+    def __init__(self, args, module_dir, tmp_dir):
+        global logger
+
+        super(HandshakeMode, self).__init__(args, module_dir, tmp_dir)
+
+        # Define instance attributes for later use
+        self.farm = None
+
+    def setup(self):
+        global logger
+
+        if self.args.test is None:
+            logger.critical("Must specify test build for handshake benchmark")
+            sys.exit(5)
+        elif self.args.base is None:
+            logger.critical("Must specify base build for handshake benchmark")
+            sys.exit(5)
+        if self.args.agents is not None:
+            logger.critical("Handshake benchmarks can't be distributed to agents")
+            sys.exit(5)
+
+        self.test_app = self.get_test_candidate(self.args.test)
+        self.base_app = self.get_test_candidate(self.args.base)
+
+        self.test_metadata = self.collect_worker_info(self.test_app)
+        self.base_metadata = self.collect_worker_info(self.base_app)
+        self.auto_size_workers(self.test_app)
+
+        # Serve every host name from a local server with freshly generated certificates
+        self.farm = tls_farm.TLSServerFarm(os.path.join(self.tmp_dir, "tls_farm"), key_types=self.args.key_types,
+                                           chain_lengths=self.args.chain_lengths,
+                                           hosts_per_config=self.args.farm_hosts, timeout=self.args.timeout)
+        self.farm.start()
+        self.targets = self.farm.hosts()
+        self.sources = self.targets
+        logger.info("%d hosts in handshake benchmark set" % len(self.targets))
+
+        # Profiles keep their revocation data, so the run does not need network access
+        self.test_profile = self.make_profile("test_profile", "custom")
+        self.base_profile = self.make_profile("base_profile", "custom")
+        self.trust_farm_roots(self.test_app, self.test_profile)
+        self.trust_farm_roots(self.base_app, self.base_profile)
+
+        global_prefs = self.args.prefs if self.args.prefs is not None else []
+        self.args.prefs_test = self.farm.prefs() + global_prefs + \
+            (self.args.prefs_test if self.args.prefs_test is not None else [])
+        self.args.prefs_base = self.farm.prefs() + global_prefs + \
+            (self.args.prefs_base if self.args.prefs_base is not None else [])
+
+    def trust_farm_roots(self, app, profile):
+        """
+        Add the root certificates of the server farm to the certificate DB of a profile
+
+        :param app: FirefoxApp to run the worker with
+        :param profile: str profile directory
+        :return: None
+        """
+        global logger
+
+        logger.debug("Adding TLS server farm roots to profile `%s`" % profile)
+        for name in ("cert9.db", "key4.db"):
+            file_name = os.path.join(profile, name)
+            if os.path.isfile(file_name):
+                os.chmod(file_name, stat.S_IRUSR | stat.S_IWUSR)
+
+        worker = xw.AsyncXPCShellWorker(app, profile=profile)
+        cmd = xw.Command("trustroots", certificates=[base64.b64encode(der).decode("ascii")
+                                                     for der in self.farm.root_certificates()])
+
+        async def trust():
+            try:
+                if not await worker.spawn():
+                    return None
+                return await worker.request(cmd)
+            finally:
+                # Killing the worker could leave the certificate DB half-written
+                await worker.quit()
+
+        try:
+            response = wp.run_in_loop(asyncio.wait_for(trust(), trust_timeout))
+        except asyncio.TimeoutError:
+            logger.critical("Worker did not add TLS server farm roots to profile within %ds" % trust_timeout)
+            sys.exit(5)
+        except OSError as err:
+            logger.critical("Unable to run worker to add TLS server farm roots to profile: %s" % err)
+            sys.exit(5)
+        if response is None:
+            logger.critical("Worker failed to add TLS server farm roots to profile")
+            sys.exit(5)
+        if not response.success:
+            logger.critical("Failed to add TLS server farm roots to profile: %s" % response.result)
+            sys.exit(5)
+
+        if not self.args.cache:
+            self.protect_profile(profile)
+
+    def teardown(self):
+        if self.farm is not None:
+            self.farm.stop()
+            self.farm = None
+        super(HandshakeMode, self).teardown()
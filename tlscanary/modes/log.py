@@ -22,7 +22,7 @@ class LogMode(BaseMode):
 
     name = "log"
     help = "Query and maintain the run log database and create reports"
-    logging_modes = ["performance", "regression", "scan"]
+    logging_modes = ["handshake", "performance", "prefmatrix", "regression", "scan"]
 
     @classmethod
     def setup_args(cls, parser):
@@ -31,7 +31,7 @@ class LogMode(BaseMode):
 
         group.add_argument("-a", "--action",
                            help="Action to perform (default: list)",
-                           choices=["delete", "webreport", "json", "list",
+                           choices=["delete", "webreport", "json", "list", "perfreport",
                                     "addtag", "rmtag", "droptag"],
                            action="store",
                            default="list")
@@ -132,6 +132,14 @@ class LogMode(BaseMode):
                 sys.exit(5)
             report.generate("json", log_list, self.args.output)
 
+        elif self.args.action == "perfreport":
+            for log_name in sorted(log_list.keys()):
+                log = log_list[log_name]
+                if log.get_meta().get("mode") not in ("handshake", "performance") or not log.has_finished():
+                    logger.warning("Skipping log `%s` which is not a complete performance log" % log_name)
+                    continue
+                print("\n".join(report.timing_report(log)))
+
         elif self.args.action == "webreport":
             if self.args.output is None:
                 logger.critical("You must specify -o/--output for writing the HTML report")
@@ -247,7 +255,7 @@ class LogMode(BaseMode):
             mode = meta["mode"] if "mode" in meta else "unknown"
             if not log.is_compatible():
                 print("%s\t            \ttags=%-39s\tINCOMPATIBLE LOG FORMAT" % (log_name, "+".join(tags)))
-            elif mode == "regression" or mode == "performance":
+            elif mode in ("handshake", "performance", "regression"):
                 size = os.path.getsize((log.part("log.bz2")))
                 if size > 100*1024*1024:
                     logger.warning("Log `%s` contains %.1f MBytes of data. counting may take a while"
@@ -274,6 +282,15 @@ class LogMode(BaseMode):
                     meta["test_metadata"]["app_version"],
                     meta["test_metadata"]["branch"].capitalize(),
                     meta["test_metadata"]["nss_version"]))
+            elif mode == "prefmatrix":
+                print("%s\tlines=%-6d\ttags=%-39s\tFx %s %s / %s with %s" % (
+                    log_name,
+                    len(log),
+                    "+".join(tags),
+                    meta["test_metadata"]["app_version"],
+                    meta["test_metadata"]["branch"].capitalize(),
+                    meta["test_metadata"]["nss_version"],
+                    ", ".join(sorted(meta["pref_sets"].keys()))))
             else:
                 print("%s\tlines=%-6d\ttags=%-39s" % (
                     log_name,
@@ -2,17 +2,59 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from array import array
 import datetime
 import logging
+import math
 import pkg_resources as pkgr
 import sys
 
 from .regression import RegressionMode
 import tlscanary.runlog as rl
+from tlscanary.tools import autosize
+from tlscanary.tools import timing
+import tlscanary.worker_pool as wp
 
 
 logger = logging.getLogger(__name__)
 
+# Memory estimates for limiting the number of hosts: bytes of bookkeeping per
+# host, and bytes per float32 timing sample
+host_memory = 1024
+sample_memory = 4
+
+# Timing metrics: the TLS handshake from channel timing info, and the time between
+# command and response for workers that don't report timing info
+handshake_metric = "tls_handshake"
+response_metric = "response_time"
+
+# Fraction of available memory that a performance run may use for its data
+memory_budget = 0.5
+
+# Run log part holding the timing samples
+timings_part = "timings.bin"
+
+
+def new_samples(size):
+    """Return an array of `size` missing (NaN) timing samples"""
+    return array("d", [math.nan]) * size
+
+
+def column_means(samples):
+    """
+    Return the mean over all scans for every host, ignoring missing samples. This is a
+    linear loop over hosts in Python, not vectorized, because NumPy isn't a dependency.
+
+    :param samples: list of arrays of timing samples per scan, indexed alike
+    :return: array of means, NaN for hosts without samples
+    """
+    means = new_samples(len(samples[0]) if len(samples) > 0 else 0)
+    for i, column in enumerate(zip(*samples)):
+        values = [value for value in column if not math.isnan(value)]
+        if len(values) > 0:
+            means[i] = math.fsum(values) / len(values)
+    return means
+
 
 class PerformanceMode(RegressionMode):
 
@@ -26,23 +68,39 @@ class PerformanceMode(RegressionMode):
 
         # Define instance attributes for later use
         self.start_time = None
-        self.test_uri_set = None
-        self.base_uri_set = None
+        self.targets = None
         self.total_change = None
 
+    def max_hosts(self):
+        """
+        Return the number of hosts whose data fits into the memory budget, or None if unknown
+
+        :return: int or None
+        """
+        memory = autosize.available_memory()
+        if memory is None:
+            return None
+        # Two builds, each with handshake and response times
+        return int(memory * memory_budget / (host_memory + 4 * self.args.scans * sample_memory))
+
     def setup(self):
-        # Additional argument validation for hard-coded limits,
-        # because 1000 URIs x 20 scans per URI x 2 builds is a lot of data
-        # will investigate upper limit later
-        if self.args.limit > 1000:
-            logger.warning("Limiting performance tests to 1000 hosts.")
-            self.args.limit = 1000
-        if self.args.scans > 20:
-            logger.critical("Limiting performance test to 20 scans per URI list for now")
-            sys.exit(1)
+        global logger
+
         super(PerformanceMode, self).setup()
 
+        # Timings are kept in arrays that grow linearly with hosts and scans,
+        # so the number of hosts is only limited by memory
+        limit = len(self.sources) if self.args.limit is None else min(self.args.limit, len(self.sources))
+        max_hosts = self.max_hosts()
+        if max_hosts is not None and limit > max_hosts:
+            logger.warning("Limiting performance test to %d hosts to fit into available memory" % max_hosts)
+            limit = max_hosts
+        self.targets = sorted(self.sources.as_set(0, limit))
+        logger.info("%d hosts in performance test set" % len(self.targets))
+
     def run(self):
+        global logger
+
         # Perform the scan
         self.start_time = datetime.datetime.now()
 
@@ -54,6 +112,7 @@ class PerformanceMode(RegressionMode):
             "sources_size": len(self.sources),
             "test_metadata": self.test_metadata,
             "base_metadata": self.base_metadata,
+            "worker_autosize": self.worker_autosize,
             "run_start_time": datetime.datetime.utcnow().isoformat()
         }
 
@@ -61,56 +120,67 @@ class PerformanceMode(RegressionMode):
         log = rldb.new_log()
         log.start(meta=meta)
 
-        test_uri_sets = []
-        base_uri_sets = []
+        # Timings are streamed into columnar stores. Full responses of the first
+        # test scan are logged as they arrive and not kept.
+        stores = dict((metric, timing.SampleStore(self.targets, ["test", "base"], self.args.scans))
+                      for metric in (handshake_metric, response_metric))
+        # Successful scans per build, and how many of them had no handshake timing,
+        # e.g. because the connection was reused
+        successes = {"test": 0, "base": 0}
+        skipped = {"test": 0, "base": 0}
 
-        self.total_change = 0
-        test_speed_aggregate = 0
-        base_speed_aggregate = 0
+        def collect(build, scan, result):
+            speed = self.connection_speed(result)
+            stores[handshake_metric].add(build, scan, result.host, speed)
+            stores[response_metric].add(build, scan, result.host, self.response_time(result))
+            if result.success:
+                successes[build] += 1
+                if math.isnan(speed):
+                    skipped[build] += 1
+            if build == "test" and scan == 0:
+                log.log(result.as_dict())
 
-        for i in range(0, self.args.scans):
-            test_uri_sets.append(self.run_test(self.test_app, self.sources, profile=self.test_profile,
-                                               prefs=self.args.prefs_test, get_info=True,
-                                               get_certs=not self.args.remove_certs, return_only_errors=False))
-
-            base_uri_sets.append(self.run_test(self.base_app, self.sources, profile=self.base_profile,
-                                               prefs=self.args.prefs_base, get_info=True,
-                                               get_certs=not self.args.remove_certs, return_only_errors=False))
-
-        # extract connection speed from all scans
-        test_connections_all = []
-        for uri_set in test_uri_sets:
-            test_connections_all.append(self.extract_connection_speed(uri_set))
-
-        base_connections_all = []
-        for uri_set in base_uri_sets:
-            base_connections_all.append(self.extract_connection_speed(uri_set))
-
-        # collapse all scan data into one URI set
-        self.consolidate_connection_speed_info(test_uri_sets[0], test_connections_all)
-        self.consolidate_connection_speed_info(base_uri_sets[0], base_connections_all)
-
-        # the first URI set becomes our primary set
-        self.test_uri_set = test_uri_sets[0]
-        self.base_uri_set = base_uri_sets[0]
-
-        # new values to be inserted into response
-        for test_record in self.test_uri_set:
-            base_record = [d for d in self.base_uri_set if d[1] == test_record[1]][0]
-            test_response_time = float(test_record[2].response.connection_speed_average)
-            base_response_time = float(base_record[2].response.connection_speed_average)
-            test_speed_aggregate += test_response_time
-            base_speed_aggregate += base_response_time
-            pct_change = float((test_response_time - base_response_time) / base_response_time) * 100
-            test_record[2].response.connection_speed_change = int(pct_change)
-            # save the speed samples of the base record to the test record for now,
-            # in case we decide we want to include this in the report later
-            test_record[2].response.connection_speed_base_samples = base_record[2].response.connection_speed_samples
-
-        self.total_change = float((test_speed_aggregate - base_speed_aggregate) / base_speed_aggregate) * 100
-
-        for rank, host, result in self.test_uri_set:
-            log.log(result.as_dict())
+        if self.args.agents is not None:
+            self.run_alternating(collect, cert_db=rldb.cert_db)
+        else:
+            self.run_interleaved(collect, cert_db=rldb.cert_db)
+
+        # Both builds must be compared by the same metric
+        if all(skipped[build] < successes[build] for build in ("test", "base")):
+            metric = handshake_metric
+        else:
+            metric = response_metric
+            skipped = {"test": 0, "base": 0}
+            logger.warning("Not all builds report handshake timing, comparing response times instead")
+        for build in ("test", "base"):
+            if skipped[build] > 0:
+                logger.warning("%d successful %s scans have no handshake timing" % (skipped[build], build))
+        store = stores[metric]
+
+        test_means = column_means([store.column("test", i) for i in range(self.args.scans)])
+        base_means = column_means([store.column("base", i) for i in range(self.args.scans)])
+        test_medians = store.medians("test")
+        base_medians = store.medians("base")
+
+        valid_means = [(t, b) for t, b in zip(test_means, base_means) if not math.isnan(t) and not math.isnan(b)]
+        base_speed_aggregate = math.fsum(b for _, b in valid_means)
+        if base_speed_aggregate > 0:
+            test_speed_aggregate = math.fsum(t for t, _ in valid_means)
+            self.total_change = (test_speed_aggregate - base_speed_aggregate) / base_speed_aggregate * 100
+        else:
+            self.total_change = 0.0
+
+        logger.debug("Writing timing samples to `%s`" % log.part(timings_part))
+        with open(log.part(timings_part), "wb") as f:
+            store.write(f)
+        meta["timings_part"] = timings_part
+        meta["timing_metric"] = metric
+        meta["timing_summary"] = {
+            "test": timing.summarize(test_medians),
+            "base": timing.summarize(base_medians),
+            "change": timing.summarize(store.paired_changes("test", "base")),
+            "skipped": skipped
+        }
 
         meta["run_finish_time"] = datetime.datetime.utcnow().isoformat()
         meta["total_change"] = self.total_change
@@ -118,23 +188,73 @@ class PerformanceMode(RegressionMode):
         self.save_profile(self.base_profile, "base_profile", log)
         log.stop(meta=meta)
 
+    def run_alternating(self, result_callback, cert_db=None):
+        """
+        Scan all hosts with the test build, then with the base build, once per scan round
+
+        :param result_callback: function called with build name, scan round, and ScanResult
+        :param cert_db: optional CertDB for certificates of the first test scan
+        :return: None
+        """
+        global logger
+
+        for i in range(0, self.args.scans):
+            logger.info("Performance scan #%d of %d hosts" % (i + 1, len(self.targets)))
+            for result in self.iter_test(self.test_app, self.targets, profile=self.test_profile,
+                                         prefs=self.args.prefs_test, get_certs=i == 0 and not self.args.remove_certs,
+                                         return_only_errors=False, cert_db=cert_db if i == 0 else None):
+                result_callback("test", i, result)
+
+            for result in self.iter_test(self.base_app, self.targets, profile=self.base_profile,
+                                         prefs=self.args.prefs_base, return_only_errors=False):
+                result_callback("base", i, result)
+
+    def run_interleaved(self, result_callback, cert_db=None):
+        """
+        Scan every host with both builds in pairs of requests that are sent close
+        together in time, so that network drift affects both builds alike
+
+        :param result_callback: function called with build name, scan round, and ScanResult
+        :param cert_db: optional CertDB for certificates of the first test scan
+        :return: None
+        """
+        global logger
+
+        logger.info("Interleaved performance scan of %d hosts, %d rounds" % (len(self.targets), self.args.scans))
+        try:
+            wp.run_in_loop(wp.scan_pairs(
+                self.test_app, self.base_app, self.targets, result_callback, scans=self.args.scans,
+                test_profile=self.test_profile, test_prefs=self.args.prefs_test, base_profile=self.base_profile,
+                base_prefs=self.args.prefs_base, num_workers=self.args.parallel,
+                targets_per_worker=self.args.requestsperworker, timeout=self.args.timeout,
+                get_certs=not self.args.remove_certs, cert_db=cert_db, max_requests=self.args.recycle_requests,
+                max_rss=self.args.recycle_rss, spare_workers=self.args.spare_workers))
+
+        except KeyboardInterrupt:
+            logger.critical('User abort')
+            wp.stop()
+            sys.exit(1)
+
     @staticmethod
-    def extract_connection_speed(uri_set):
-        new_set = []
-        for record in uri_set:
-            new_set.append([
-                record[0],  # URI rank
-                record[2].response.response_time - record[2].response.command_time  # connection speed
-            ])
-        return new_set
-
-    def consolidate_connection_speed_info(self, uri_set, connection_sets):
-        for record in uri_set:
-            temp_speeds = []
-            speed_aggregate = 0
-            for connection_set in connection_sets:
-                speed = [d for d in connection_set if d[0] == record[0]][0][1]
-                speed_aggregate += speed
-                temp_speeds.append(speed)
-            record[2].response.connection_speed_average = speed_aggregate / self.args.scans
-            record[2].response.connection_speed_samples = str(temp_speeds).strip('[]')
+    def connection_speed(result):
+        """
+        Return the TLS handshake time of a scan in milliseconds
+
+        :param result: ScanResult
+        :return: float, NaN if the handshake was not completed or has no timing info,
+                 e.g. on a reused connection
+        """
+        durations = result.phase_durations()
+        if durations is None or durations["tls_handshake"] is None:
+            return math.nan
+        return durations["tls_handshake"]
+
+    @staticmethod
+    def response_time(result):
+        """
+        Return the time between command and response of a scan in milliseconds
+
+        :param result: ScanResult
+        :return: float
+        """
+        return result.response.response_time - result.response.command_time
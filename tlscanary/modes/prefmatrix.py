@@ -0,0 +1,236 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import datetime
+import logging
+import pkg_resources as pkgr
+import sys
+
+from .basemode import BaseMode
+import tlscanary.runlog as rl
+import tlscanary.sources_db as sdb
+import tlscanary.tools.progress as pr
+import tlscanary.worker_pool as wp
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_pref_set(arg):
+    """
+    Parse a pref set argument of the form `name=key;value,key;value`
+
+    :param arg: str argument
+    :return: (str name, list of str prefs)
+    """
+    name, sep, prefs = arg.partition("=")
+    if sep == "" or name == "":
+        raise argparse.ArgumentTypeError("Pref set must be of the form `name=key;value,key;value`")
+    prefs = [pref for pref in prefs.split(",") if pref != ""]
+    for pref in prefs:
+        if ";" not in pref:
+            raise argparse.ArgumentTypeError("Pref `%s` must be of the form `key;value`" % pref)
+    return name, prefs
+
+
+class PrefMatrixMode(BaseMode):
+
+    name = "prefmatrix"
+    help = "Scan hosts with one Firefox build under several pref configurations"
+
+    @classmethod
+    def setup_args(cls, parser):
+        super(PrefMatrixMode, cls).setup_args(parser)
+
+        group = parser.add_argument_group("pref matrix")
+        group.add_argument("-P", "--pref_set",
+                           help="Named pref configuration of the form `name=key;value,key;value`. "
+                                "Use one argument per configuration. Prefs from --prefs apply to all of them",
+                           type=parse_pref_set,
+                           action="append",
+                           default=None)
+
+    def __init__(self, args, module_dir, tmp_dir):
+        global logger
+
+        super(PrefMatrixMode, self).__init__(args, module_dir, tmp_dir)
+
+        # Define instance attributes for later use
+        self.start_time = None
+        self.test_profile = None
+        self.test_app = None
+        self.test_metadata = None
+        self.sources = None
+        self.pref_sets = None
+
+    def setup(self):
+        global logger
+
+        if self.args.test is None:
+            logger.critical("Must specify test build for pref matrix scan")
+            sys.exit(5)
+        elif self.args.base is not None:
+            logger.debug("Ignoring base build parameter")
+
+        if self.args.pref_set is None or len(self.args.pref_set) < 2:
+            logger.critical("Must specify at least two pref sets with --pref_set")
+            sys.exit(5)
+        names = [name for name, _ in self.args.pref_set]
+        if len(set(names)) != len(names):
+            logger.critical("Pref set names must be unique")
+            sys.exit(5)
+        global_prefs = self.args.prefs if self.args.prefs is not None else []
+        self.pref_sets = [(name, global_prefs + prefs) for name, prefs in self.args.pref_set]
+
+        # Download app and extract metadata
+        self.test_app = self.get_test_candidate(self.args.test)
+        self.test_metadata = self.collect_worker_info(self.test_app)
+        self.auto_size_workers(self.test_app)
+
+        # Create custom profile
+        self.test_profile = self.make_profile("test_profile", self.args.onecrl)
+
+        # Compile the set of hosts to test
+        db = sdb.SourcesDB(self.args)
+        logger.info("Reading `%s` host database" % self.args.source)
+        self.sources = db.read(self.args.source)
+        logger.info("%d hosts in test set" % len(self.sources))
+
+    def run(self):
+        global logger
+
+        logger.info("Testing Firefox %s %s with %d pref sets: %s" %
+                    (self.test_metadata["app_version"], self.test_metadata["branch"], len(self.pref_sets),
+                     ", ".join(name for name, _ in self.pref_sets)))
+
+        self.start_time = datetime.datetime.now()
+
+        meta = {
+            "tlscanary_version": pkgr.require("tlscanary")[0].version,
+            "mode": self.name,
+            "args": vars(self.args),
+            "argv": sys.argv,
+            "sources_size": len(self.sources),
+            "test_metadata": self.test_metadata,
+            "worker_autosize": self.worker_autosize,
+            "pref_sets": dict(self.pref_sets),
+            "run_start_time": datetime.datetime.utcnow().isoformat()
+        }
+
+        rldb = rl.RunLogDB(self.args)
+        log = rldb.new_log()
+        log.start(meta=meta)
+        progress = pr.ProgressTracker(total=len(self.sources) * len(self.pref_sets), unit="scans",
+                                      average=10*60.0)
+        outcome_counts = dict((name, {"ok": 0, "error": 0, "timeout": 0, "none": 0}) for name, _ in self.pref_sets)
+
+        limit = len(self.sources) if self.args.limit is None else self.args.limit
+
+        # Split work into 50 chunks to conserve memory, but make no chunk smaller than 1000 hosts
+        next_chunk = self.sources.iter_chunks(chunk_size=limit/50, min_chunk_size=1000)
+
+        try:
+            while True:
+                host_set_chunk = next_chunk(as_set=True)
+                if host_set_chunk is None:
+                    break
+
+                logger.info("Starting pref matrix scan of chunk of %d hosts" % len(host_set_chunk))
+
+                pending = {}
+
+                def collect(name, result):
+                    record = pending.setdefault(result.host, {"rank": result.rank, "results": {}})
+                    record["results"][name] = result
+                    if len(record["results"]) == len(self.pref_sets):
+                        log.log(self.matrix_record(result.host, pending.pop(result.host), outcome_counts))
+
+                self.scan_chunk(host_set_chunk, collect, report_callback=progress.log_completed,
+                                event_callback=progress.log_event, cert_db=rldb.cert_db)
+
+                # Hosts that did not yield a result with every pref set
+                for host, record in pending.items():
+                    log.log(self.matrix_record(host, record, outcome_counts))
+
+                # Log progress per chunk
+                logger.info("Progress: %s" % str(progress))
+
+        except KeyboardInterrupt:
+            logger.critical("Ctrl-C received")
+            progress.stop_reporting()
+            raise KeyboardInterrupt
+
+        finally:
+            progress.stop_reporting()
+
+        meta["run_finish_time"] = datetime.datetime.utcnow().isoformat()
+        meta["outcome_counts"] = outcome_counts
+        self.save_profile(self.test_profile, "test_profile", log)
+        log.stop(meta=meta)
+
+    def scan_chunk(self, host_set, result_callback, report_callback=None, event_callback=None, cert_db=None):
+        """
+        Scan a set of hosts once with every pref set
+
+        :param host_set: set of (rank, host) tuples
+        :param result_callback: function called with pref set name and ScanResult
+        :param report_callback: progress callback
+        :param event_callback: callback for scan events of local workers
+        :param cert_db: optional CertDB that local workers store certificates in
+        :return: None
+        """
+        global logger
+
+        get_certs = not self.args.remove_certs
+
+        if self.args.agents is not None:
+            # Agents scan one pref set at a time
+            for name, prefs in self.pref_sets:
+                for result in self.iter_test(self.test_app, host_set, profile=self.test_profile, prefs=prefs,
+                                             get_certs=get_certs, return_only_errors=False,
+                                             report_callback=report_callback):
+                    result_callback(name, result)
+            return
+
+        try:
+            wp.run_in_loop(wp.scan_matrix(
+                self.test_app, list(host_set), self.pref_sets, result_callback, num_workers=self.args.parallel,
+                profile=self.test_profile, targets_per_worker=self.args.requestsperworker,
+                timeout=self.args.timeout, get_certs=get_certs, progress_callback=report_callback,
+                max_requests=self.args.recycle_requests, max_rss=self.args.recycle_rss, adaptive=self.args.adaptive,
+                cert_db=cert_db, event_callback=event_callback,
+                spare_workers=self.args.spare_workers))
+
+        except KeyboardInterrupt:
+            logger.critical('User abort')
+            wp.stop()
+            sys.exit(1)
+
+    def matrix_record(self, host, record, outcome_counts):
+        """
+        Combine the results of a host into one log record with an outcome per pref set.
+        Responses are only kept for pref sets that did not connect successfully.
+
+        :param host: str host name
+        :param record: dict with rank and ScanResults by pref set name
+        :param outcome_counts: dict of outcome counters by pref set name to update
+        :return: dict log record
+        """
+        outcomes = {}
+        responses = {}
+        for name, _ in self.pref_sets:
+            result = record["results"].get(name)
+            outcome = result.outcome() if result is not None else "none"
+            outcomes[name] = outcome
+            outcome_counts[name][outcome] += 1
+            if result is not None and not result.success:
+                responses[name] = result.response.as_dict()
+        return {
+            "host": host,
+            "rank": record["rank"],
+            "success": all(outcome == "ok" for outcome in outcomes.values()),
+            "outcomes": outcomes,
+            "responses": responses
+        }
@@ -3,17 +3,26 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import hashlib
+import json
 import logging
+import os
 import pkg_resources as pkgr
 import sys
 
 from .basemode import BaseMode
 import tlscanary.runlog as rl
 import tlscanary.sources_db as sdb
+import tlscanary.tools.cache as cache
 import tlscanary.tools.progress as pr
+import tlscanary.tools.result_cache as rc
+import tlscanary.worker_pool as wp
 
 logger = logging.getLogger(__name__)
 
+# Outcomes of OneCRL sanity checks are cached for a month per build and OneCRL data
+one_crl_check_cache_timeout = 30 * 24 * 60 * 60
+
 
 class RegressionMode(BaseMode):
     name = "regression"
@@ -36,43 +45,91 @@ class RegressionMode(BaseMode):
         self.sources = None
         self.revoked_source = None
         self.custom_ocsp_pref = None
+        self.base_cache = None
+
+    def one_crl_check_id(self):
+        """
+        Return the cache ID of the OneCRL sanity check, derived from the build ID
+        of the test candidate, the OneCRL data in the test profile, the revoked
+        host set, and the prefs the check runs with
+
+        :return: str
+        """
+        check_hash = hashlib.sha256()
+        cert_storage = os.path.join(self.test_profile, "security_state", "data.safe.bin")
+        if os.path.isfile(cert_storage):
+            with open(cert_storage, "rb") as f:
+                check_hash.update(f.read())
+        else:
+            check_hash.update(b"none")
+        hosts = sorted(row["hostname"] for row in self.revoked_source)
+        prefs = self.custom_ocsp_pref if self.custom_ocsp_pref is not None else []
+        check_hash.update(json.dumps({"hosts": hosts, "prefs": prefs}).encode("utf-8"))
+        return "onecrl_check_%s_%s" % (self.test_app.application_ini.get("buildid"), check_hash.hexdigest())
 
     def one_crl_sanity_check(self):
         global logger
 
+        # Note: turn off OCSP for this test, to factor out that mechanism
+        self.custom_ocsp_pref = ["security.OCSP.enabled;0"]
+
+        # Profile that is missing OneCRL entries
+        self.altered_profile = self.make_profile("altered_profile", "none")
+
         # Query host(s) with a known revoked cert and examine the results
         # These hosts must be revoked via OCSP and/or OneCRL
         db = sdb.SourcesDB(self.args)
         self.revoked_source = db.read("revoked")
         logger.debug("%d host(s) in revoked test set" % len(self.revoked_source))
+
+        # Skip the check if it already ran for this build, OneCRL data, host set, and prefs
+        dc = cache.DiskCache(os.path.join(self.args.workdir, "onecrl_checks"), one_crl_check_cache_timeout,
+                             purge=True)
+        cache_id = self.one_crl_check_id()
+        if cache_id in dc:
+            with open(dc[cache_id]) as f:
+                outcome = json.load(f)
+            logger.info("Using cached outcome of OneCRL check from `%s`" % dc[cache_id])
+            test_count = outcome["test_errors"]
+            base_count = outcome["altered_errors"]
+        else:
+            test_count, base_count = self.run_one_crl_check()
+            # No errors at all hint at network trouble rather than at the build
+            if test_count > 0:
+                with open(dc[cache_id], "w") as f:
+                    json.dump({"test_errors": test_count, "altered_errors": base_count}, f)
+
+        logger.debug("Length of first OneCRL check, with revocation: %d" % test_count)
+        logger.debug("Length of second OneCRL check, without revocation: %d" % base_count)
+
+        # If our list of revoked sites are all blocked, and we can verify
+        # that they can be unblocked, this confirms that OneCRL is working
+        if test_count == len(self.revoked_source) and base_count == 0:
+            return True
+        else:
+            logger.warning("OneCRL check failed. This is expected, so continuing")
+            return True
+
+    def run_one_crl_check(self):
+        """
+        Scan hosts with revoked certificates with and without OneCRL data
+
+        :return: tuple of int number of error hosts with test profile and with altered profile
+        """
         next_chunk = self.revoked_source.iter_chunks(chunk_size=1/50, min_chunk_size=1000)
         host_set_chunk = next_chunk(as_set=True)
 
-        # Note: turn off OCSP for this test, to factor out that mechanism
-        self.custom_ocsp_pref = ["security.OCSP.enabled;0"]
-
         # First, use the test build and profile as-is
         # This should return errors, which means OneCRL is working
         test_result = self.run_test(self.test_app, url_list=host_set_chunk, profile=self.test_profile,
-                                    prefs=self.custom_ocsp_pref, num_workers=1, n_per_worker=1)
+                                    prefs=self.custom_ocsp_pref)
 
         # Second, use the test build with a profile that is missing OneCRL entries
         # This should NOT return errors, which means we've turned off protection
-        self.altered_profile = self.make_profile("altered_profile", "none")
-
         base_result = self.run_test(self.test_app, url_list=host_set_chunk, profile=self.altered_profile,
-                                    prefs=self.custom_ocsp_pref, num_workers=1, n_per_worker=1)
-
-        logger.debug("Length of first OneCRL check, with revocation: %d" % len(test_result))
-        logger.debug("Length of second OneCRL check, without revocation: %d" % len(base_result))
+                                    prefs=self.custom_ocsp_pref)
 
-        # If our list of revoked sites are all blocked, and we can verify
-        # that they can be unblocked, this confirms that OneCRL is working
-        if len(test_result) == len(self.revoked_source) and len(base_result) == 0:
-            return True
-        else:
-            logger.warning("OneCRL check failed. This is expected, so continuing")
-            return True
+        return len(test_result), len(base_result)
 
     def setup(self):
         global logger
@@ -99,6 +156,7 @@ class RegressionMode(BaseMode):
 
         self.test_metadata = self.collect_worker_info(self.test_app)
         self.base_metadata = self.collect_worker_info(self.base_app)
+        self.auto_size_workers(self.test_app)
 
         # Setup custom profiles
         self.test_profile = self.make_profile("test_profile", self.args.onecrl)
@@ -124,6 +182,12 @@ class RegressionMode(BaseMode):
 
         self.start_time = datetime.datetime.now()
 
+        # The cache is only opened here, because modes derived from this one don't scan for regressions
+        if self.args.base_cache_ttl > 0:
+            self.base_cache = rc.ResultCache(os.path.join(self.args.workdir, "base_results.sqlite"),
+                                             rc.config_key(self.base_app, self.args.prefs_base, self.base_profile),
+                                             maximum_age=self.args.base_cache_ttl * 60 * 60)
+
         meta = {
             "tlscanary_version": pkgr.require("tlscanary")[0].version,
             "mode": self.name,
@@ -132,13 +196,14 @@ class RegressionMode(BaseMode):
             "sources_size": len(self.sources),
             "test_metadata": self.test_metadata,
             "base_metadata": self.base_metadata,
+            "worker_autosize": self.worker_autosize,
             "run_start_time": datetime.datetime.utcnow().isoformat()
         }
 
         rldb = rl.RunLogDB(self.args)
         log = rldb.new_log()
         log.start(meta=meta)
-        progress = pr.ProgressTracker(total=len(self.sources), unit="hosts", average=30*60.0)
+        progress = pr.ProgressTracker(total=len(self.sources), unit="hosts", average=10*60.0)
 
         limit = len(self.sources) if self.args.limit is None else self.args.limit
 
@@ -153,15 +218,14 @@ class RegressionMode(BaseMode):
 
                 logger.info("Starting regression run on chunk of %d hosts" % len(host_set_chunk))
 
-                error_set = self.run_regression_passes(host_set_chunk, report_completed=progress.log_completed,
-                                                       report_overhead=progress.log_overhead)
+                # Results are committed to the log as they arrive
+                self.run_regression_passes(host_set_chunk, report_completed=progress.log_completed,
+                                           report_overhead=progress.log_overhead, report_event=progress.log_event,
+                                           result_callback=lambda result: log.log(result.as_dict()),
+                                           cert_db=rldb.cert_db)
                 # Log progress per chunk
                 logger.info("Progress: %s" % str(progress))
 
-                # Commit results to log
-                for rank, host, result in error_set:
-                    log.log(result.as_dict())
-
         except KeyboardInterrupt:
             logger.critical("Ctrl-C received")
             progress.stop_reporting()
@@ -171,12 +235,111 @@ class RegressionMode(BaseMode):
             progress.stop_reporting()
 
         meta["run_finish_time"] = datetime.datetime.utcnow().isoformat()
+        if self.base_cache is not None:
+            meta["base_cache"] = self.base_cache.stats()
+            logger.info("Baseline result cache had %d hits and %d misses"
+                        % (self.base_cache.hits, self.base_cache.misses))
         self.save_profile(self.test_profile, "test_profile", log)
         self.save_profile(self.base_profile, "base_profile", log)
         self.save_profile(self.altered_profile, "altered_profile", log)
         log.stop(meta=meta)
 
-    def run_regression_passes(self, host_set, report_completed=None, report_overhead=None):
+    def run_regression_passes(self, host_set, report_completed=None, report_overhead=None, report_event=None,
+                              result_callback=None, cert_db=None):
+        """
+        Narrow down a set of hosts to those that fail with the test candidate, but not with the
+        baseline candidate. ScanResults of the final information extraction pass are passed to
+        `result_callback` as they arrive instead of being kept.
+
+        Local workers confirm every host on its own as its results arrive. Hosts scanned by
+        agents are confirmed in passes over the whole set.
+
+        :param host_set: set of (rank, host) tuples
+        :param report_completed: progress callback for the initial test scan
+        :param report_overhead: progress callback for all other scans
+        :param report_event: callback for scan events of all scans
+        :param result_callback: function called with every final ScanResult
+        :param cert_db: optional CertDB for certificates of the final pass
+        :return: set of (rank, host) tuples of potential regressions
+        """
+        global logger
+
+        if self.args.agents is not None:
+            final_error_set = self.run_pass_barriers(host_set, report_completed=report_completed,
+                                                     report_overhead=report_overhead, report_event=report_event,
+                                                     result_callback=result_callback, cert_db=cert_db)
+        else:
+            try:
+                final_error_set = wp.run_in_loop(wp.confirm_regressions(
+                    self.test_app, self.base_app, list(host_set),
+                    result_callback if result_callback is not None else lambda _: None,
+                    test_profile=self.test_profile, test_prefs=self.args.prefs_test, base_profile=self.base_profile,
+                    base_prefs=self.args.prefs_base, scans=self.args.scans, num_workers=self.args.parallel,
+                    targets_per_worker=self.args.requestsperworker, timeout=self.args.timeout,
+                    max_timeout=self.args.max_timeout, get_certs=not self.args.remove_certs, cert_db=cert_db,
+                    info_workers=self.args.info_parallel, info_requests_per_worker=self.args.info_requestsperworker,
+                    progress_callback=report_completed, overhead_callback=report_overhead,
+                    max_requests=self.args.recycle_requests, max_rss=self.args.recycle_rss,
+                    adaptive=self.args.adaptive, event_callback=report_event, spare_workers=self.args.spare_workers,
+                    base_cache=self.base_cache))
+
+            except KeyboardInterrupt:
+                logger.critical('User abort')
+                wp.stop()
+                sys.exit(1)
+
+        if len(final_error_set) > 0:
+            logger.warning("%d potential regressions found: %s"
+                           % (len(final_error_set), ' '.join(["%d,%s" % (r, u) for r, u in final_error_set])))
+
+        return final_error_set
+
+    def run_base_test(self, host_set, num_workers, n_per_worker, timeout, report_callback=None,
+                      event_callback=None):
+        """
+        Scan hosts with the baseline candidate, taking fresh outcomes from the base result
+        cache instead of scanning if there is one
+
+        :param host_set: set of (rank, host) tuples
+        :return: set of (rank, host) tuples that failed with the baseline candidate
+        """
+        if self.base_cache is None:
+            return self.run_test(self.base_app, host_set, profile=self.base_profile, prefs=self.args.prefs_base,
+                                 num_workers=num_workers, n_per_worker=n_per_worker, timeout=timeout,
+                                 report_callback=report_callback, event_callback=event_callback)
+
+        base_error_set = set()
+        scan_set = set()
+        for rank, host in host_set:
+            success = self.base_cache.get(host)
+            if success is None:
+                scan_set.add((rank, host))
+            elif not success:
+                base_error_set.add((rank, host))
+        for result in self.iter_test(self.base_app, scan_set, profile=self.base_profile, prefs=self.args.prefs_base,
+                                     num_workers=num_workers, n_per_worker=n_per_worker, timeout=timeout,
+                                     return_only_errors=False, report_callback=report_callback,
+                                     event_callback=event_callback):
+            if result.success:
+                self.base_cache.put(result.host, True)
+            else:
+                base_error_set.add((result.rank, result.host))
+        return base_error_set
+
+    def run_pass_barriers(self, host_set, report_completed=None, report_overhead=None, report_event=None,
+                          result_callback=None, cert_db=None):
+        """
+        Variant of run_regression_passes() that scans the whole set of remaining hosts in
+        every pass, for scans that are distributed to agents.
+
+        :param host_set: set of (rank, host) tuples
+        :param report_completed: progress callback for the initial test scan
+        :param report_overhead: progress callback for all other scans
+        :param report_event: callback for scan events of all scans
+        :param result_callback: function called with every final ScanResult
+        :param cert_db: optional CertDB for certificates of the final pass
+        :return: set of (rank, host) tuples of potential regressions
+        """
         global logger
         # Compile set of error hosts in multiple scans
 
@@ -203,15 +366,14 @@ class RegressionMode(BaseMode):
             test_error_set = self.run_test(self.test_app, current_host_set, profile=self.test_profile,
                                            prefs=self.args.prefs_test, num_workers=num_workers,
                                            n_per_worker=requests_per_worker, timeout=timeout,
-                                           report_callback=report_callback_value)
+                                           report_callback=report_callback_value, event_callback=report_event)
             logger.info("Scan #%d with test candidate yielded %d error hosts"
                         % (current_scan, len(test_error_set)))
             logger.debug("Scan #%d test candidate errors: %s"
                          % (current_scan, ' '.join(["%d,%s" % (r, u) for r, u in test_error_set])))
-            base_error_set = self.run_test(self.base_app, test_error_set, profile=self.base_profile,
-                                           prefs=self.args.prefs_base, num_workers=num_workers,
-                                           n_per_worker=requests_per_worker, timeout=timeout,
-                                           report_callback=report_overhead)
+            base_error_set = self.run_base_test(test_error_set, num_workers=num_workers,
+                                                n_per_worker=requests_per_worker, timeout=timeout,
+                                                report_callback=report_overhead, event_callback=report_event)
             logger.info("Scan #%d with baseline candidate yielded %d error hosts"
                         % (current_scan, len(base_error_set)))
             logger.debug("Scan #%d baseline candidate errors: %s"
@@ -224,38 +386,41 @@ class RegressionMode(BaseMode):
                 break
             else:
                 # Slow down number of workers and scans with each pass
-                # to make results more precise
-                num_workers = max(1, int(num_workers * 0.75))
-                requests_per_worker = max(1, int(requests_per_worker * 0.75))
+                # to make results more precise. Adaptive workers throttle
+                # themselves when they see timeouts.
+                if not self.args.adaptive:
+                    num_workers = max(1, int(num_workers * 0.75))
+                    requests_per_worker = max(1, int(requests_per_worker * 0.75))
                 timeout = min(max_timeout, timeout * 1.25)
 
         last_error_set = current_host_set
 
         # Final pass, information extraction only:
-        # - Run error set from previous pass against the test candidate with minimal workers, requests
+        # - Run error set from previous pass against the test candidate with few workers, requests
         # - Have workers return extra runtime information, including certificates
 
         logger.debug("Extracting runtime information from %d hosts" % (len(last_error_set)))
-        final_error_set = self.run_test(self.test_app, last_error_set, profile=self.test_profile,
-                                        prefs=self.args.prefs_test, num_workers=1, n_per_worker=1,
-                                        get_info=True, get_certs=not self.args.remove_certs,
-                                        report_callback=report_overhead)
-
-        if len(final_error_set) > 0:
-            logger.warning("%d potential regressions found: %s"
-                           % (len(final_error_set), ' '.join(["%d,%s" % (r, u) for r, u, d in final_error_set])))
+        final_error_set = set()
+        for result in self.iter_test(self.test_app, last_error_set, profile=self.test_profile,
+                                     prefs=self.args.prefs_test, num_workers=self.args.info_parallel,
+                                     n_per_worker=self.args.info_requestsperworker,
+                                     get_certs=not self.args.remove_certs, report_callback=report_overhead,
+                                     cert_db=cert_db, event_callback=report_event):
+            final_error_set.add((result.rank, result.host))
+            if result_callback is not None:
+                result_callback(result)
 
         # Find out if the information extraction pass changed the results
         if self.args.debug:
-            # Final set includes additional result data, so filter that out before comparison
-            stripped_final_set = set()
-
-            for rank, host, data in final_error_set:
-                stripped_final_set.add((rank, host))
-
-            if stripped_final_set != last_error_set:
-                diff_set = last_error_set.difference(stripped_final_set)
+            if final_error_set != last_error_set:
+                diff_set = last_error_set.difference(final_error_set)
                 logger.debug("Number of hosts dropped out of final error set: %d" % len(diff_set))
                 logger.debug(diff_set)
 
         return final_error_set
+
+    def teardown(self):
+        if self.base_cache is not None:
+            self.base_cache.close()
+            self.base_cache = None
+        super(RegressionMode, self).teardown()
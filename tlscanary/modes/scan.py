@@ -47,6 +47,7 @@ class ScanMode(BaseMode):
         # Download app and extract metadata
         self.test_app = self.get_test_candidate(self.args.test)
         self.test_metadata = self.collect_worker_info(self.test_app)
+        self.auto_size_workers(self.test_app)
         logger.info("Testing Firefox %s %s scan run" %
                     (self.test_metadata["app_version"], self.test_metadata["branch"]))
 
@@ -74,13 +75,14 @@ class ScanMode(BaseMode):
             "argv": sys.argv,
             "sources_size": len(self.sources),
             "test_metadata": self.test_metadata,
+            "worker_autosize": self.worker_autosize,
             "run_start_time": datetime.datetime.utcnow().isoformat()
         }
 
         rldb = rl.RunLogDB(self.args)
         log = rldb.new_log()
         log.start(meta=meta)
-        progress = pr.ProgressTracker(total=len(self.sources), unit="hosts", average=30*60.0)
+        progress = pr.ProgressTracker(total=len(self.sources), unit="hosts", average=10*60.0)
 
         limit = len(self.sources) if self.args.limit is None else self.args.limit
 
@@ -95,17 +97,16 @@ class ScanMode(BaseMode):
 
                 logger.info("Starting scan of chunk of %d hosts" % len(host_set_chunk))
 
-                info_uri_set = self.run_test(self.test_app, host_set_chunk, profile=self.test_profile,
-                                             prefs=self.args.prefs, get_info=True,
-                                             get_certs=not self.args.remove_certs, return_only_errors=False,
-                                             report_callback=progress.log_completed)
+                # Commit results to log as they arrive
+                for result in self.iter_test(self.test_app, host_set_chunk, profile=self.test_profile,
+                                             prefs=self.args.prefs, get_certs=not self.args.remove_certs,
+                                             return_only_errors=False, report_callback=progress.log_completed,
+                                             cert_db=rldb.cert_db, event_callback=progress.log_event):
+                    log.log(result.as_dict())
+
                 # Log progress per chunk
                 logger.info("Progress: %s" % str(progress))
 
-                # Commit results to log
-                for rank, host, result in info_uri_set:
-                    log.log(result.as_dict())
-
         except KeyboardInterrupt:
             logger.critical("Ctrl-C received")
             progress.stop_reporting()
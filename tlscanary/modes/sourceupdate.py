@@ -56,6 +56,7 @@ class SourceUpdateMode(BaseMode):
         global logger
 
         self.app = self.get_test_candidate(self.args.base)
+        self.auto_size_workers(self.app)
         self.profile = self.make_profile("base_profile")
 
         tmp_zip_name = os.path.join(self.tmp_dir, "top.zip")
@@ -199,6 +200,7 @@ class SourceUpdateMode(BaseMode):
         self.db.write(final_src)
 
     def teardown(self):
+        super(SourceUpdateMode, self).teardown()
         # Free some memory
         self.db = None
         self.sources = None
@@ -10,6 +10,7 @@ import os
 import shutil
 
 from tlscanary.tools import cert
+from tlscanary.tools import timing
 
 
 logger = logging.getLogger(__name__)
@@ -150,12 +151,11 @@ def __extract_certificates(log, cert_dir):
             "response": log_line["response"]
         }
         cert_file = os.path.join(cert_dir, "%s.der" % result["host"])
-        if "certificate_chain" in result["response"]["result"]["info"] \
-                and result["response"]["result"]["info"]["certificate_chain"] is not None:
-            server_cert_string = "".join(map(chr, result["response"]["result"]["info"]["certificate_chain"][0]))
+        chain = cert.decode_chain(result["response"]["result"]["info"], cert_db=log.db.cert_db)
+        if chain is not None and chain[0] is not None:
             logger.debug("Writing certificate data for `%s` to `%s`" % (result["host"], cert_file))
-            with open(cert_file, "w") as f:
-                f.write(server_cert_string)
+            with open(cert_file, "wb") as f:
+                f.write(chain[0])
         else:
             logger.debug("No certificate data available for `%s`" % result["host"])
 
@@ -218,10 +218,15 @@ def collect_site_info(scan_result):
         "uri": scan_result["host"],
         "rank": scan_result["rank"]
     }
+    result = scan_result["response"]["result"]
+    if type(result) is dict and "info" in result:
+        phases = timing.phase_durations(result["info"].get("timing"))
+        if phases is not None:
+            site_info["phases"] = phases
     return site_info
 
 
-def collect_certificate_info(scan_result):
+def collect_certificate_info(scan_result, cert_db=None):
 
     result = scan_result["response"]["result"]
 
@@ -231,7 +236,7 @@ def collect_certificate_info(scan_result):
     status = result["info"]["ssl_status"]
 
     server_cert = status["serverCert"]
-    parsed_server_cert = cert.Cert(result["info"]["certificate_chain"][0])
+    parsed_server_cert = cert.Cert(cert.decode_chain(result["info"], cert_db=cert_db)[0])
 
     root_cert = server_cert
     chain_length = 1
@@ -268,14 +273,64 @@ def collect_certificate_info(scan_result):
     return cert_info
 
 
-def collect_scan_info(scan_result):
+def collect_scan_info(scan_result, cert_db=None):
     return {
         "site_info": collect_site_info(scan_result),
         "error": collect_error_info(scan_result),
-        "cert_info": collect_certificate_info(scan_result)
+        "cert_info": collect_certificate_info(scan_result, cert_db=cert_db)
     }
 
 
-def add_performance_info(log_data, scan_result):
-    log_data["site_info"]["connectionSpeedChange"] = scan_result["response"]["connection_speed_change"]
-    log_data["site_info"]["connectionSpeedSamples"] = scan_result["response"]["connection_speed_samples"]
+def add_performance_info(log_data, scan_result, store):
+    i = store.index[scan_result["host"]]
+    log_data["site_info"]["connectionSpeedSamples"] = store.samples("test", i)
+    log_data["site_info"]["connectionSpeedBaseSamples"] = store.samples("base", i)
+
+
+def read_timings(log):
+    """
+    Read the timing samples of a performance log
+
+    :param log: RunLog
+    :return: SampleStore or None if the log has no timing samples
+    """
+    meta = log.get_meta()
+    if "timings_part" not in meta or not os.path.isfile(log.part(meta["timings_part"])):
+        return None
+    with open(log.part(meta["timings_part"]), "rb") as f:
+        return timing.SampleStore.read(f)
+
+
+def timing_report(log):
+    """
+    Return lines of a text report on the timing distributions of a performance log.
+    Percentiles are given with their bootstrap confidence intervals.
+
+    :param log: RunLog
+    :return: list of str
+    """
+    meta = log.get_meta()
+    summary = meta.get("timing_summary")
+    if summary is None:
+        return ["%s: no timing data" % log.handle]
+
+    lines = ["%s: Fx %s %s vs Fx %s %s, %d%% confidence intervals"
+             % (log.handle, meta["test_metadata"]["app_version"], meta["test_metadata"]["branch"],
+                meta["base_metadata"]["app_version"], meta["base_metadata"]["branch"],
+                timing.confidence_level * 100)]
+    lines.append("metric: %s" % meta.get("timing_metric", "tls_handshake"))
+    skipped = summary.get("skipped")
+    if skipped is not None and (skipped["test"] > 0 or skipped["base"] > 0):
+        lines.append("skipped: %d test and %d base scans without handshake timing" % (skipped["test"], skipped["base"]))
+    lines.append("%-14s %7s" % ("", "hosts") + "".join(" %26s" % ("p%d" % p) for p in timing.percentiles))
+    for name, title, unit in (("test", "test (ms)", ""), ("base", "base (ms)", ""), ("change", "change", "%")):
+        row = summary[name]
+        cells = []
+        for p in timing.percentiles:
+            if row["p%d" % p] is None:
+                cells.append(" %26s" % "-")
+            else:
+                lower, upper = row["p%d_ci" % p]
+                cells.append(" %26s" % ("%.1f%s [%.1f, %.1f]" % (row["p%d" % p], unit, lower, upper)))
+        lines.append("%-14s %7d" % (title, row["count"]) + "".join(cells))
+    return lines
@@ -18,8 +18,12 @@ logger = logging.getLogger(__name__)
 class CertDB(object):
     """
     Class to efficiently store SSL certificates
+
+    Certificates are addressed by the SHA-256 hash of their DER data, which
+    is identical to their SHA-256 fingerprint. Hashes of certificates known
+    to be stored are kept in memory in the .known set. Hashes of certificates
+    that were seen as issuers in a chain are kept in the .issuers set.
     """
-    # TODO: CertDB needs testing
 
     def __init__(self, args):
         self.args = args
@@ -27,9 +31,17 @@ class CertDB(object):
         if not os.path.isdir(self.cert_dir):
             os.makedirs(self.cert_dir)
         self.hash_fs = hashfs.HashFS(self.cert_dir, depth=4, width=1, algorithm='sha256')
+        self.known = set()
+        self.issuers = set()
 
     def put(self, der_data):
-        if type(der_data) is str:
+        if type(der_data) is bytes:
+            hash_address = self.hash_fs.put(io.BytesIO(der_data), "der")
+            if hash_address.id not in self.known:
+                logger.debug("Wrote certificate data to `%s`" % hash_address.abspath)
+                self.known.add(hash_address.id)
+            return hash_address.id
+        elif type(der_data) is str:
             hash_address = self.hash_fs.put(io.StringIO(str(der_data)), "der")
             logger.debug("Wrote certificate data to `%s`" % hash_address.abspath)
             return hash_address.id
@@ -39,7 +51,24 @@ class CertDB(object):
             raise Exception("Unsupported argument type")
 
     def exists(self, hash_id):
-        return self.hash_fs.exists(hash_id)
+        if hash_id in self.known:
+            return True
+        if self.hash_fs.exists(hash_id):
+            self.known.add(hash_id)
+            return True
+        return False
+
+    def get(self, hash_id):
+        """
+        Return DER data of a stored certificate
+        :param hash_id: str with SHA-256 hash
+        :return: bytes or None
+        """
+        hash_address = self.hash_fs.get(hash_id)
+        if hash_address is None:
+            return None
+        with open(hash_address.abspath, "rb") as f:
+            return f.read()
 
     def get_abspath(self, hash_id):
         hash_address = self.hash_fs.get(hash_id)
@@ -0,0 +1,170 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import os
+import time
+
+from tlscanary.tools import xpcshell_worker as xw
+import tlscanary.worker_pool as wp
+
+
+logger = logging.getLogger(__name__)
+
+# Requests in flight per CPU core. Matches the traditional defaults of 4 workers
+# with 50 requests each on a four-core machine.
+requests_per_core = 50
+
+# Bounds for the number of requests each worker keeps in flight
+min_requests_per_worker = 10
+max_requests_per_worker = 200
+
+# Fraction of available memory that workers may use
+memory_budget = 0.75
+
+# Expected growth of a worker's memory footprint under load, relative to its size after start-up
+rss_growth = 4
+
+# Seconds to wait for the probe worker to start and answer
+probe_timeout = 30
+
+# Worker count and requests per worker when the probe worker fails
+default_workers = 4
+default_requests_per_worker = 50
+
+
+def cpu_count():
+    """
+    Return number of CPU cores available to this process
+
+    :return: int
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS and Windows
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """
+    Return memory in bytes that is available for new processes, or None if unknown
+
+    :return: int or None
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, IndexError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def probe_worker(app, timeout=None):
+    """
+    Spawn a worker and measure its start-up time and memory footprint
+
+    :param app: FirefoxApp to probe
+    :param timeout: float seconds to wait for the worker, defaults to `probe_timeout`
+    :return: (float start-up time in seconds, int RSS in bytes or None),
+             or (None, None) if the worker failed to start or answer
+    """
+    global logger
+
+    if timeout is None:
+        timeout = probe_timeout
+
+    async def probe():
+        start_time = time.time()
+        worker = xw.AsyncXPCShellWorker(app)
+        try:
+            if not await asyncio.wait_for(worker.spawn(), timeout):
+                return None, None
+            # The first answer marks the end of start-up
+            response = await asyncio.wait_for(worker.request(xw.Command("info")), timeout)
+            if response is None:
+                return None, None
+            return time.time() - start_time, worker.rss()
+        except asyncio.TimeoutError:
+            logger.warning("Probe worker did not answer within %ds" % timeout)
+            return None, None
+        except OSError as err:
+            logger.warning("Unable to run probe worker: %s" % err)
+            return None, None
+        finally:
+            await worker.quit()
+
+    startup_time, rss = wp.run_in_loop(probe())
+    if startup_time is None:
+        logger.warning("Probe worker failed")
+    else:
+        logger.debug("Probe worker started in %.2fs with RSS of %s bytes" % (startup_time, rss))
+    return startup_time, rss
+
+
+def choose(cpus, memory=None, worker_rss=None, max_rss=None):
+    """
+    Pick worker count and requests per worker for a machine
+
+    Every core gets a worker, unless workers would run out of memory. Each
+    worker is expected to grow up to its recycling ceiling `max_rss`, or to a
+    multiple of its start-up RSS if there is no ceiling. Requests in flight
+    are then spread across the workers.
+
+    :param cpus: int number of CPU cores
+    :param memory: int available memory in bytes or None if unknown
+    :param worker_rss: int start-up RSS of a worker in bytes or None if unknown
+    :param max_rss: int RSS in bytes at which workers are recycled or None
+    :return: (int workers, int requests per worker)
+    """
+    num_workers = max(1, cpus)
+
+    worker_memory = max_rss
+    if worker_rss is not None:
+        worker_memory = worker_rss * rss_growth if max_rss is None else min(max_rss, worker_rss * rss_growth)
+    if memory is not None and worker_memory is not None and worker_memory > 0:
+        num_workers = max(1, min(num_workers, int(memory * memory_budget / worker_memory)))
+
+    requests_per_worker = (requests_per_core * max(1, cpus)) // num_workers
+    requests_per_worker = max(min_requests_per_worker, min(max_requests_per_worker, requests_per_worker))
+
+    return num_workers, requests_per_worker
+
+
+def auto_size(app, max_rss=None):
+    """
+    Probe a worker and the machine and pick worker count and requests per worker
+
+    :param app: FirefoxApp to run workers with
+    :param max_rss: int RSS in bytes at which workers are recycled or None
+    :return: dict with measurements and picked values
+    """
+    global logger
+
+    cpus = cpu_count()
+    memory = available_memory()
+    startup_time, worker_rss = probe_worker(app)
+    if startup_time is None:
+        # Without a working probe worker, keep the defaults of -j and -n
+        num_workers, requests_per_worker = default_workers, default_requests_per_worker
+        logger.warning("Falling back to %d workers with %d requests each" % (num_workers, requests_per_worker))
+    else:
+        num_workers, requests_per_worker = choose(cpus, memory=memory, worker_rss=worker_rss, max_rss=max_rss)
+    logger.info("Auto-sized to %d workers with %d requests each for %d cores and %s MB of available memory"
+                % (num_workers, requests_per_worker, cpus, "unknown" if memory is None else memory // 1024 // 1024))
+
+    return {
+        "cpu_count": cpus,
+        "available_memory": memory,
+        "worker_startup_time": startup_time,
+        "worker_rss": worker_rss,
+        "parallel": num_workers,
+        "requestsperworker": requests_per_worker
+    }
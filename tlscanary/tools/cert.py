@@ -4,12 +4,38 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+
 from cryptography import x509
 from cryptography.hazmat import backends
 from cryptography.hazmat.primitives import serialization
 from cryptography.x509.oid import ExtensionOID
 
 
+def decode_chain(info, cert_db=None):
+    """
+    Extract the certificate chain from the info object of a scan response
+
+    Current workers send chain elements as base64-encoded DER strings, or as
+    SHA-256 fingerprints of certificates that are kept in a CertDB.
+    Older logs have the server certificate as list of int bytes, followed by
+    chain elements that can't be decoded and are returned as None.
+
+    :param info: dict
+    :param cert_db: CertDB for resolving fingerprints
+    :return: list of bytes or None, or None if there is no chain
+    """
+    chain = info.get("certificate_chain")
+    if chain is None:
+        return None
+    encoding = info.get("certificate_chain_encoding")
+    if encoding == "base64":
+        return [base64.b64decode(element) for element in chain]
+    if encoding == "sha256":
+        return [cert_db.get(element) if cert_db is not None else None for element in chain]
+    return [bytes(element) if type(element) is list else None for element in chain]
+
+
 class Cert(object):
     """Class for handling X509 certificates"""
 
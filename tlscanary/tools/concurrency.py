@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import deque
+import logging
+import math
+
+from tlscanary.tools import timing
+
+
+logger = logging.getLogger(__name__)
+
+
+class AIMDController(object):
+    """
+    Additive-increase/multiplicative-decrease controller for the number of
+    requests a worker keeps in flight.
+
+    Outcomes of answered requests are recorded with .record(). After every
+    window's worth of outcomes, the window grows by `increase` if the network
+    looked healthy, or shrinks by factor `decrease` if the timeout rate rose
+    above its baseline or response times came too close to the timeout.
+
+    Host lists always contain some dead hosts that time out no matter how many
+    requests are in flight, so timeouts are compared to a baseline rate. The
+    baseline is measured over the first rounds and follows the timeout rate of
+    later healthy rounds.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, increase=1.0, decrease=0.5,
+                 timeout=10, max_timeout_increase=0.05, baseline_rounds=3, baseline_weight=0.1,
+                 slow_fraction=0.5, history=1000):
+        """
+        Constructor for AIMDController
+
+        :param initial: int initial window size
+        :param minimum: int smallest window size
+        :param maximum: int largest window size, defaults to four times the initial size
+        :param increase: float additive window increase per healthy round
+        :param decrease: float multiplicative window decrease per congested round
+        :param timeout: float request timeout in seconds
+        :param max_timeout_increase: float rise of the timeout rate over its baseline that signals congestion
+        :param baseline_rounds: int number of rounds that the initial timeout baseline is measured over
+        :param baseline_weight: float weight of a healthy round's timeout rate in the updated baseline
+        :param slow_fraction: float fraction of the timeout that the 90th percentile
+               of response times may reach before signalling congestion
+        :param history: int number of recent outcomes kept for statistics
+        """
+        self.minimum = minimum
+        self.maximum = 4 * initial if maximum is None else maximum
+        self.window = float(max(minimum, min(self.maximum, initial)))
+        self.increase = increase
+        self.decrease = decrease
+        self.timeout = timeout
+        self.max_timeout_increase = max_timeout_increase
+        self.baseline_rounds = baseline_rounds
+        self.baseline_weight = baseline_weight
+        self.baseline = None
+        self.baseline_outcomes = 0
+        self.baseline_timeouts = 0
+        self.rounds = 0
+        self.slow_fraction = slow_fraction
+        self.samples = deque(maxlen=history)
+        self.round_outcomes = 0
+        self.round_timeouts = 0
+        self.round_times = []
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def limit(self):
+        """Current number of requests to keep in flight"""
+        return max(self.minimum, int(self.window))
+
+    def record(self, outcome, elapsed):
+        """
+        Record the outcome of a request.
+
+        :param outcome: str, one of "ok", "error" or "timeout"
+        :param elapsed: float response time in seconds
+        :return: None
+        """
+        self.samples.append((outcome, elapsed))
+        self.round_outcomes += 1
+        if outcome == "timeout":
+            self.round_timeouts += 1
+        else:
+            self.round_times.append(elapsed)
+
+        # A round spans one window's worth of requests
+        if self.round_outcomes >= self.limit:
+            self.__adjust()
+
+    def __adjust(self):
+        global logger
+
+        timeout_rate = float(self.round_timeouts) / self.round_outcomes
+        slow_p90 = timing.percentile(sorted(self.round_times), 90)
+        congested = not math.isnan(slow_p90) and slow_p90 > self.slow_fraction * self.timeout
+
+        self.rounds += 1
+        if self.rounds <= self.baseline_rounds:
+            # Timeouts of the first rounds are the baseline, not a signal
+            self.baseline_outcomes += self.round_outcomes
+            self.baseline_timeouts += self.round_timeouts
+            if self.rounds == self.baseline_rounds:
+                self.baseline = float(self.baseline_timeouts) / self.baseline_outcomes
+        else:
+            congested = congested or timeout_rate > self.baseline + self.max_timeout_increase
+            if not congested:
+                self.baseline += self.baseline_weight * (timeout_rate - self.baseline)
+
+        old_limit = self.limit
+        if congested:
+            self.window = max(self.minimum, self.window * self.decrease)
+            self.decreases += 1
+        else:
+            self.window = min(self.maximum, self.window + self.increase)
+            self.increases += 1
+        if self.limit != old_limit:
+            logger.debug("Adjusted request window from %d to %d (%.1f%% timeouts, p90 %s)"
+                         % (old_limit, self.limit, 100.0 * timeout_rate,
+                            "--" if math.isnan(slow_p90) else "%.2fs" % slow_p90))
+
+        self.round_outcomes = 0
+        self.round_timeouts = 0
+        self.round_times = []
+
+    def stats(self):
+        """
+        Return statistics over recent outcomes
+
+        :return: dict
+        """
+        times = sorted(elapsed for outcome, elapsed in self.samples if outcome != "timeout")
+        total = len(self.samples)
+        stats = {
+            "window": self.limit,
+            "timeout_baseline": self.baseline,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "timeout_rate": 0.0 if total == 0 else
+            float(len([s for s in self.samples if s[0] == "timeout"])) / total,
+            "error_rate": 0.0 if total == 0 else
+            float(len([s for s in self.samples if s[0] == "error"])) / total
+        }
+        for p in timing.percentiles:
+            value = timing.percentile(times, p)
+            stats["p%d" % p] = None if math.isnan(value) else value
+        return stats
@@ -108,3 +108,7 @@ class FirefoxApp(object):
 
         # Field for optional package origin metadata (must be provided externally)
         self.package_origin = None
+
+        # Field for the build reference the app was obtained from, as passed to
+        # --test or --base. Used by agents to obtain the same build (must be provided externally).
+        self.build_spec = None
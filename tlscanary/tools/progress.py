@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import bisect
 import logging
 import threading
 import time
@@ -13,12 +14,19 @@ logger = logging.getLogger(__name__)
 class ProgressTracker(object):
     """Class that implements progress tracking"""
 
+    # Scan events that are counted by .log_event()
+    events = ("dispatched", "ok", "error", "timeout", "retry", "lost")
+
     def __init__(self, total, unit=None, percent=True, speed=True, eta=True, average=30*60.0):
         """
         Constructor for a ProcessLogger
 
         The class keeps track of completed and overhead calculations, and
         can estimate current progress speed and time of completion (ETA).
+        Log entries older than the averaging window are pruned.
+
+        Optionally, it counts scan events to report requests in flight,
+        timeouts, errors and retries.
 
         :param total: int total calculations required for completion
         :param unit: str for unit used for speed
@@ -36,6 +44,7 @@ class ProgressTracker(object):
         self.show_eta = eta
         self.average_window = average
         self.log = []
+        self.counters = dict((event, 0) for event in self.events)
         self.write_lock = threading.Lock()
         self.start_time = time.time()
         self.logger_thread = None
@@ -49,7 +58,7 @@ class ProgressTracker(object):
         """
         self.write_lock.acquire()
         try:
-            self.log.append((time.time(), completed, 0))
+            self.__append((time.time(), completed, 0))
             self.completed += completed
         finally:
             self.write_lock.release()
@@ -62,11 +71,52 @@ class ProgressTracker(object):
         """
         self.write_lock.acquire()
         try:
-            self.log.append((time.time(), 0, overhead))
+            self.__append((time.time(), 0, overhead))
             self.overhead += overhead
         finally:
             self.write_lock.release()
 
+    def log_event(self, event, count=1):
+        """
+        Count a scan event as reported by the worker pool
+
+        "dispatched" is counted when a request is sent to a worker. Every request
+        ends with one of "ok", "error", "timeout", "retry" (the worker crashed and
+        the host is rescanned), or "lost" (the host is given up on).
+
+        :param event: str event name
+        :param count: int number of events
+        :return: None
+        """
+        self.write_lock.acquire()
+        try:
+            self.counters[event] += count
+        finally:
+            self.write_lock.release()
+
+    def in_flight(self):
+        """
+        Return number of requests that were dispatched, but not answered yet
+
+        :return: int
+        """
+        return self.counters["dispatched"] - sum(self.counters[event] for event in self.events[1:])
+
+    def __append(self, entry):
+        """
+        Append entry to log and prune entries that are no longer needed for the averaging window.
+        Must be called with write lock held.
+
+        :param entry: (float time, int completed, int overhead)
+        :return: None
+        """
+        self.log.append(entry)
+        # Entries from before the averaging window are never read again
+        obsolete = bisect.bisect_left(self.log, (entry[0] - self.average_window,))
+        # Prune in batches to keep the amortized cost low
+        if obsolete > 1000:
+            del self.log[:obsolete]
+
     def log_window(self, window):
         """
         Return current averaging window
@@ -75,14 +125,13 @@ class ProgressTracker(object):
         :return: list of (time, int completed, int overhead)
         """
         earliest_time = time.time() - window
-        latest_entry = len(self.log)
-        earliest_entry = latest_entry
-        for i in range(latest_entry - 1, -1, -1):
-            if self.log[i][0] >= earliest_time:
-                earliest_entry = i
-            else:
-                break
-        return self.log[earliest_entry:latest_entry]
+        self.write_lock.acquire()
+        try:
+            # Log entries are ordered by time
+            earliest_entry = bisect.bisect_left(self.log, (earliest_time,))
+            return self.log[earliest_entry:]
+        finally:
+            self.write_lock.release()
 
     @staticmethod
     def __window_parameters(log_window):
@@ -138,7 +187,7 @@ class ProgressTracker(object):
                 s += ", --%s/s gross" % self.unit
             if self.show_eta:
                 s += ", ETA --"
-            return s
+            return s + self.__event_summary()
 
         # Get values for current averaging window
         win_span, win_completed, win_overhead = self.__window_parameters(log_window)
@@ -179,7 +228,18 @@ class ProgressTracker(object):
                 s += ", ETA %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(gross_eta))
             else:
                 s += ", ETA --"
-        return s
+        return s + self.__event_summary()
+
+    def __event_summary(self):
+        """
+        Return string representation of event counters, if there are any
+
+        :return: str
+        """
+        if self.counters["dispatched"] == 0:
+            return ""
+        return ", %d in flight, %d timeouts, %d errors, %d retries" \
+            % (self.in_flight(), self.counters["timeout"], self.counters["error"], self.counters["retry"])
 
     def start_reporting(self, interval, first_interval=None):
         """
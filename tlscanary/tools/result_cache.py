@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Number of stored results after which they are committed to disk
+commit_interval = 1000
+
+
+def config_key(app, prefs=None, profile=None):
+    """
+    Return a key that identifies a scan configuration: the build, its prefs, and the
+    contents of its profile, which include OneCRL data.
+
+    :param app: FirefoxApp
+    :param prefs: list of pref strings or None
+    :param profile: str profile directory or None
+    :return: str hex digest
+    """
+    h = hashlib.sha256()
+    h.update(("%s\n%s\n" % (app.application_ini.get("buildid"), app.application_ini.get("version"))).encode("utf-8"))
+    for pref in sorted(prefs) if prefs is not None else []:
+        h.update(("pref %s\n" % pref).encode("utf-8"))
+    if profile is not None:
+        for root, dirs, files in os.walk(profile):
+            dirs.sort()
+            for name in sorted(files):
+                file_name = os.path.join(root, name)
+                h.update(("file %s\n" % os.path.relpath(file_name, profile)).encode("utf-8"))
+                with open(file_name, "rb") as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """
+    On-disk cache of scan outcomes per host for a single scan configuration
+
+    Only outcomes of earlier runs are returned, so a run never confirms a host
+    with its own results. Outcomes older than `maximum_age` seconds are ignored
+    and purged.
+    """
+
+    def __init__(self, db_file, config, maximum_age=6*60*60):
+        global logger
+        self.db_file = os.path.abspath(db_file)
+        self.config = config
+        self.maximum_age = maximum_age
+        self.opened = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.__uncommitted = 0
+        logger.debug("Opening result cache `%s` for configuration `%s`" % (self.db_file, config))
+        self.db = sqlite3.connect(self.db_file)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                        "(config TEXT, host TEXT, success INTEGER, time REAL, PRIMARY KEY (config, host))")
+        self.db.execute("DELETE FROM results WHERE time < ?", (self.opened - maximum_age,))
+        self.db.commit()
+
+    def get(self, host):
+        """
+        Return the cached outcome of a host
+
+        :param host: str host name
+        :return: bool success, or None if there is no fresh outcome from an earlier run
+        """
+        row = self.db.execute("SELECT success FROM results WHERE config = ? AND host = ? AND time >= ? AND time < ?",
+                              (self.config, host, time.time() - self.maximum_age, self.opened)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(row[0])
+
+    def put(self, host, success):
+        """
+        Store the outcome of a host
+
+        :param host: str host name
+        :param success: bool
+        """
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                        (self.config, host, int(success), time.time()))
+        self.stores += 1
+        self.__uncommitted += 1
+        if self.__uncommitted >= commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.__uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def stats(self):
+        """
+        Return cache statistics for run log meta data
+
+        :return: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            "maximum_age": self.maximum_age,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": float(self.hits) / lookups if lookups > 0 else None
+        }
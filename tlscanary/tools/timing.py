@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from array import array
+import json
+import logging
+import math
+import random
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+# Percentiles reported for timing distributions
+percentiles = (50, 90, 99)
+
+# Connection phases derived from channel timing info: name, start and end timestamp
+phases = (
+    ("dns", "domain_lookup_start", "domain_lookup_end"),
+    ("tcp_connect", "connect_start", "secure_connection_start"),
+    ("tls_handshake", "secure_connection_start", "connect_end"),
+    ("first_byte", "request_start", "response_start")
+)
+
+# Bootstrap settings. Large sets are subsampled for each bootstrap round,
+# and the resulting intervals are scaled down to the size of the full set.
+bootstrap_rounds = 200
+bootstrap_sample_limit = 5000
+confidence_level = 0.95
+
+
+class SampleStore(object):
+    """
+    Columnar store of timing samples in milliseconds
+
+    There is one float32 array per build and scan, indexed by the position of
+    the host in the host list. Missing samples are NaN.
+
+    Aggregations run a linear loop over hosts in Python. They are not vectorized,
+    because the store sticks to the stdlib `array` module rather than NumPy.
+    """
+
+    def __init__(self, hosts, builds, scans):
+        """
+        :param hosts: list of (rank, host) tuples
+        :param builds: list of str build names
+        :param scans: int number of scans per build
+        """
+        self.hosts = list(hosts)
+        self.builds = list(builds)
+        self.scans = scans
+        self.index = dict((host, i) for i, (_, host) in enumerate(self.hosts))
+        self.columns = dict(((build, scan), array("f", [math.nan]) * len(self.hosts))
+                            for build in self.builds for scan in range(scans))
+
+    def add(self, build, scan, host, value):
+        self.columns[(build, scan)][self.index[host]] = value
+
+    def column(self, build, scan):
+        return self.columns[(build, scan)]
+
+    def samples(self, build, i):
+        """Return list of valid samples of the host at position `i` for a build"""
+        return [value for value in (self.columns[(build, scan)][i] for scan in range(self.scans))
+                if not math.isnan(value)]
+
+    def medians(self, build):
+        """
+        Return the median sample of every host for a build
+
+        :param build: str build name
+        :return: array of float, NaN for hosts without samples
+        """
+        result = array("d", [math.nan]) * len(self.hosts)
+        for i, column in enumerate(zip(*[self.columns[(build, scan)] for scan in range(self.scans)])):
+            values = sorted(value for value in column if not math.isnan(value))
+            if len(values) > 0:
+                result[i] = percentile(values, 50)
+        return result
+
+    def paired_changes(self, test, base):
+        """
+        Return the median per-host change in percent between two builds, computed from
+        samples of the same scan round only. With interleaved scans, both samples of a
+        round were taken at about the same time, so network drift between rounds cancels out.
+
+        :param test: str build name
+        :param base: str build name to compare against
+        :return: array of float, NaN for hosts without a complete pair
+        """
+        result = array("d", [math.nan]) * len(self.hosts)
+        pairs = [(self.columns[(test, scan)], self.columns[(base, scan)]) for scan in range(self.scans)]
+        for i in range(len(self.hosts)):
+            changes = sorted((test_column[i] - base_column[i]) / base_column[i] * 100.0
+                             for test_column, base_column in pairs
+                             if not math.isnan(test_column[i]) and not math.isnan(base_column[i])
+                             and base_column[i] > 0)
+            if len(changes) > 0:
+                result[i] = percentile(changes, 50)
+        return result
+
+    def write(self, f):
+        """
+        Write the store to a binary file object: a JSON header line followed by
+        the raw arrays in build and scan order.
+        """
+        header = {"hosts": self.hosts, "builds": self.builds, "scans": self.scans, "byteorder": sys.byteorder}
+        f.write(("%s\n" % json.dumps(header)).encode("utf-8"))
+        for build in self.builds:
+            for scan in range(self.scans):
+                self.columns[(build, scan)].tofile(f)
+
+    @classmethod
+    def read(cls, f):
+        """Read a store written by .write() from a binary file object"""
+        header = json.loads(f.readline().decode("utf-8"))
+        store = cls([tuple(host) for host in header["hosts"]], header["builds"], header["scans"])
+        for build in store.builds:
+            for scan in range(store.scans):
+                column = array("f")
+                column.fromfile(f, len(store.hosts))
+                if header["byteorder"] != sys.byteorder:
+                    column.byteswap()
+                store.columns[(build, scan)] = column
+        return store
+
+
+def phase_durations(timing_info):
+    """
+    Return the duration of every connection phase from the channel timing info of a scan
+
+    :param timing_info: dict of timestamps in milliseconds as reported by the worker, or None
+    :return: dict of float milliseconds by phase name, None for phases that were not
+             completed, or None if there is no timing info
+    """
+    if timing_info is None:
+        return None
+    durations = {}
+    for name, start, end in phases:
+        start, end = timing_info.get(start), timing_info.get(end)
+        durations[name] = end - start if start is not None and end is not None else None
+    return durations
+
+
+def percentile(sorted_values, p):
+    """
+    Return the `p`th percentile of sorted values, interpolating linearly
+
+    :param sorted_values: sorted list of floats
+    :param p: float percentile between 0 and 100
+    :return: float, NaN for empty lists
+    """
+    if len(sorted_values) == 0:
+        return math.nan
+    position = (len(sorted_values) - 1) * p / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def bootstrap_ci(values, p, rounds=None, rng=None):
+    """
+    Return a bootstrap confidence interval of the `p`th percentile of values. Sets
+    larger than `bootstrap_sample_limit` are resampled at that size, and the
+    interval is scaled to the full set (m-out-of-n bootstrap).
+
+    :param values: list of floats
+    :param p: float percentile between 0 and 100
+    :param rounds: int number of bootstrap rounds
+    :param rng: optional random.Random instance
+    :return: (float lower bound, float upper bound)
+    """
+    if len(values) == 0:
+        return math.nan, math.nan
+    if rounds is None:
+        rounds = bootstrap_rounds
+    if rng is None:
+        rng = random.Random(0)
+    size = min(len(values), bootstrap_sample_limit)
+    estimates = sorted(percentile(sorted(rng.choices(values, k=size)), p) for _ in range(rounds))
+    alpha = (1 - confidence_level) / 2 * 100
+    lower, upper = percentile(estimates, alpha), percentile(estimates, 100 - alpha)
+    if size < len(values):
+        # The spread of estimates shrinks with the square root of the sample size,
+        # so intervals of subsamples are too wide by sqrt(n / size)
+        estimate = percentile(sorted(values), p)
+        scale = math.sqrt(size / len(values))
+        lower, upper = estimate + (lower - estimate) * scale, estimate + (upper - estimate) * scale
+    return lower, upper
+
+
+def summarize(values, rng=None):
+    """
+    Summarize a distribution of timings with percentiles and their bootstrap confidence intervals
+
+    :param values: iterable of floats, NaN values are skipped
+    :param rng: optional random.Random instance
+    :return: dict
+    """
+    values = sorted(value for value in values if not math.isnan(value))
+    summary = {"count": len(values), "mean": math.fsum(values) / len(values) if len(values) > 0 else None}
+    for p in percentiles:
+        value = percentile(values, p)
+        lower, upper = bootstrap_ci(values, p, rng=rng)
+        summary["p%d" % p] = None if math.isnan(value) else value
+        summary["p%d_ci" % p] = None if math.isnan(lower) else [lower, upper]
+    return summary
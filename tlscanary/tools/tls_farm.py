@@ -0,0 +1,257 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import logging
+import os
+import socketserver
+import ssl
+from threading import Thread
+
+from cryptography import x509
+from cryptography.hazmat import backends
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID
+from cryptography.x509.oid import NameOID
+
+
+logger = logging.getLogger(__name__)
+
+# Supported key types and functions generating a private key for them
+key_generators = {
+    "rsa2048": lambda: rsa.generate_private_key(65537, 2048, backends.default_backend()),
+    "rsa3072": lambda: rsa.generate_private_key(65537, 3072, backends.default_backend()),
+    "rsa4096": lambda: rsa.generate_private_key(65537, 4096, backends.default_backend()),
+    "ecdsa256": lambda: ec.generate_private_key(ec.SECP256R1(), backends.default_backend()),
+    "ecdsa384": lambda: ec.generate_private_key(ec.SECP384R1(), backends.default_backend())
+}
+
+# Validity of generated certificates in days
+certificate_lifetime = 30
+
+# Prefs that make Firefox resolve farm hosts locally and do a full handshake for every request
+farm_prefs = [
+    "network.dns.disableIPv6;true",
+    "network.proxy.type;0",
+    "security.OCSP.enabled;0",
+    "security.ssl.disable_session_identifiers;true"
+]
+
+
+def make_certificate(subject, key, issuer=None, issuer_key=None, ca=False, names=None):
+    """
+    Create a certificate signed with SHA-256
+
+    :param subject: str common name of the subject
+    :param key: private key of the subject
+    :param issuer: x509.Certificate of the issuer, None for self-signed certificates
+    :param issuer_key: private key of the issuer
+    :param ca: bool, create a CA certificate
+    :param names: list of str DNS names for the subject alternative name extension
+    :return: x509.Certificate
+    """
+    subject_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject),
+                              x509.NameAttribute(NameOID.ORGANIZATION_NAME, "TLS Canary server farm")])
+    issuer_name = subject_name if issuer is None else issuer.subject
+    now = datetime.datetime.utcnow()
+    builder = x509.CertificateBuilder() \
+        .subject_name(subject_name) \
+        .issuer_name(issuer_name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=certificate_lifetime)) \
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True) \
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+    if issuer is not None:
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer.public_key()), critical=False)
+    if ca:
+        builder = builder.add_extension(
+            x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=False,
+                          data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+                          encipher_only=False, decipher_only=False), critical=True)
+    else:
+        builder = builder.add_extension(
+            x509.KeyUsage(digital_signature=True, content_commitment=False,
+                          key_encipherment=isinstance(key, rsa.RSAPrivateKey), data_encipherment=False,
+                          key_agreement=False, key_cert_sign=False, crl_sign=False,
+                          encipher_only=False, decipher_only=False), critical=True)
+        builder = builder.add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+    if names is not None:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(name) for name in names]),
+                                        critical=False)
+    return builder.sign(issuer_key if issuer_key is not None else key, hashes.SHA256(), backends.default_backend())
+
+
+def pem(certificate):
+    return certificate.public_bytes(serialization.Encoding.PEM)
+
+
+class FarmHandler(socketserver.BaseRequestHandler):
+    """Completes the TLS handshake and answers any request with an empty page"""
+
+    def handle(self):
+        try:
+            with self.server.default_context.wrap_socket(self.request, server_side=True) as tls:
+                tls.settimeout(self.server.client_timeout)
+                request = b""
+                while b"\r\n\r\n" not in request:
+                    data = tls.recv(4096)
+                    if len(data) == 0:
+                        return
+                    request += data
+                tls.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except (OSError, ssl.SSLError) as err:
+            logger.debug("TLS server farm connection failed: %s" % err)
+
+
+class FarmServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Threaded server. All handshakes share the Python GIL, which limits server-side concurrency."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TLSServerFarm(object):
+    """
+    Local HTTPS server that serves many host names from a single port
+
+    For every combination of key type and chain length, there is a chain of
+    CA certificates below a root of that key type, and a set of host names
+    with their own leaf certificates. The server picks the certificate chain
+    by the SNI name of the client. Chain lengths count the leaf and root
+    certificates, so the shortest chain has a length of 2.
+    """
+
+    def __init__(self, directory, key_types=("ecdsa256",), chain_lengths=(2,), hosts_per_config=10,
+                 domain="tlscanary.test", timeout=10):
+        """
+        :param directory: str directory for certificate and key files
+        :param key_types: list of str key types of the certificates, see tls_farm.key_generators
+        :param chain_lengths: list of int chain lengths
+        :param hosts_per_config: int number of host names per key type and chain length
+        :param domain: str parent domain of the host names
+        :param timeout: float seconds the server waits for clients
+        """
+        self.directory = os.path.abspath(directory)
+        self.key_types = list(key_types)
+        self.chain_lengths = list(chain_lengths)
+        self.hosts_per_config = hosts_per_config
+        self.domain = domain
+        self.timeout = timeout
+        self.roots = {}
+        self.names = []
+        self.configs = {}
+        self.__contexts = {}
+        self.__server = None
+        self.__thread = None
+
+        for key_type in self.key_types:
+            if key_type not in key_generators:
+                raise ValueError("Unsupported key type `%s`" % key_type)
+        for chain_length in self.chain_lengths:
+            if chain_length < 2:
+                raise ValueError("Chain length must be at least 2, not %d" % chain_length)
+
+    def generate(self):
+        """Generate certificates and TLS contexts for all host names"""
+        global logger
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for key_type in self.key_types:
+            logger.debug("Generating `%s` certificates for TLS server farm" % key_type)
+            root_key = key_generators[key_type]()
+            root = make_certificate("TLS Canary %s root" % key_type, root_key, ca=True)
+            self.roots[key_type] = root
+            leaf_key = key_generators[key_type]()
+            key_file = os.path.join(self.directory, "%s.key" % key_type)
+            with open(key_file, "wb") as f:
+                f.write(leaf_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                               serialization.NoEncryption()))
+
+            for chain_length in self.chain_lengths:
+                # Issue intermediates below the root until the chain has the requested length
+                issuer, issuer_key = root, root_key
+                intermediates = []
+                for depth in range(chain_length - 2):
+                    key = key_generators[key_type]()
+                    issuer = make_certificate("TLS Canary %s intermediate %d" % (key_type, depth + 1), key,
+                                              issuer=issuer, issuer_key=issuer_key, ca=True)
+                    issuer_key = key
+                    intermediates.insert(0, issuer)
+
+                for i in range(self.hosts_per_config):
+                    name = "%s-c%d-%d.%s" % (key_type, chain_length, i, self.domain)
+                    leaf = make_certificate(name, leaf_key, issuer=issuer, issuer_key=issuer_key, names=[name])
+                    chain_file = os.path.join(self.directory, "%s.pem" % name)
+                    with open(chain_file, "wb") as f:
+                        for certificate in [leaf] + intermediates:
+                            f.write(pem(certificate))
+                    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                    context.load_cert_chain(chain_file, key_file)
+                    # Without tickets, every connection does a full handshake
+                    context.options |= ssl.OP_NO_TICKET
+                    context.num_tickets = 0
+                    self.__contexts[name] = context
+                    self.configs[name] = (key_type, chain_length)
+                    self.names.append(name)
+
+    def start(self):
+        """
+        Start serving on a free port of the IPv4 loopback interface
+
+        :return: int port number
+        """
+        global logger
+
+        if len(self.names) == 0:
+            self.generate()
+
+        self.__server = FarmServer(("127.0.0.1", 0), FarmHandler)
+        self.__server.client_timeout = self.timeout
+        self.__server.default_context = self.__contexts[self.names[0]]
+        self.__server.default_context.sni_callback = self.__select_context
+        self.__thread = Thread(target=self.__server.serve_forever, name="TLSServerFarm")
+        self.__thread.daemon = True
+        self.__thread.start()
+        logger.info("TLS server farm serving %d host names on port %d" % (len(self.names), self.port))
+        return self.port
+
+    def __select_context(self, tls, server_name, default_context):
+        if server_name in self.__contexts:
+            tls.context = self.__contexts[server_name]
+        return None
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__thread.join()
+            self.__server = None
+            self.__thread = None
+
+    @property
+    def port(self):
+        return self.__server.server_address[1] if self.__server is not None else None
+
+    def hosts(self):
+        """
+        Return the scan targets of the farm, with the port attached to the host names
+
+        :return: list of (rank, host) tuples
+        """
+        return [(rank + 1, "%s:%d" % (name, self.port)) for rank, name in enumerate(self.names)]
+
+    def root_certificates(self):
+        """Return list of DER-encoded root certificates that clients must trust"""
+        return [root.public_bytes(serialization.Encoding.DER) for root in self.roots.values()]
+
+    def prefs(self):
+        """Return list of Firefox prefs that direct all farm host names to the local server"""
+        return farm_prefs + ["network.dns.localDomains;%s" % ",".join(self.names)]
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmark per-chunk scan latency with and without pre-spawned spare workers
+
+Usage: python -m tlscanary.tools.worker_benchmark [options] FIREFOX_DIR
+
+Hosts are scanned in chunks, just like scan and regression modes do. Without
+spare workers, every chunk waits for its workers to start up. With spare
+workers, workers are spawned ahead of time and kept from one chunk to the next.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+import tlscanary.sources_db as sdb
+import tlscanary.tools.firefox_app as fa
+import tlscanary.worker_pool as wp
+
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark_chunks(app, chunks, spare_workers=0, **kwargs):
+    """
+    Scan chunks of targets one after the other and measure the latency of each chunk
+
+    :param app: FirefoxApp to scan with
+    :param chunks: list of lists of (rank, host) tuples
+    :param spare_workers: int number of spare workers, passed to worker_pool.run_scans()
+    :param kwargs: further arguments for worker_pool.run_scans()
+    :return: list of float seconds per chunk
+    """
+    latencies = []
+    try:
+        for chunk in chunks:
+            start_time = time.time()
+            wp.run_scans(app, chunk, spare_workers=spare_workers, **kwargs)
+            latencies.append(time.time() - start_time)
+    finally:
+        wp.shutdown()
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="worker_benchmark", description=__doc__.strip().split("\n")[0])
+    parser.add_argument("app_dir", help="Firefox build directory")
+    parser.add_argument("-w", "--workdir", help="tlscanary working directory with custom host databases",
+                        default=None)
+    parser.add_argument("-s", "--source", help="Host database to take hosts from (default: database default)",
+                        default=None)
+    parser.add_argument("-k", "--chunks", help="Number of chunks (default: 5)", type=int, default=5)
+    parser.add_argument("-z", "--chunk_size", help="Hosts per chunk (default: 200)", type=int, default=200)
+    parser.add_argument("-j", "--parallel", help="Number of workers (default: 4)", type=int, default=4)
+    parser.add_argument("-n", "--requestsperworker", help="Requests in flight per worker (default: 50)",
+                        type=int, default=50)
+    parser.add_argument("-m", "--timeout", help="Request timeout (default: 10)", type=float, default=10)
+    parser.add_argument("--spare_workers", help="Spare workers for the warm run (default: same as -j)",
+                        type=int, default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    db = sdb.SourcesDB(args if args.workdir is not None else None)
+    sources = db.read(args.source if args.source is not None else db.default)
+    targets = sorted(sources.as_set())[:args.chunks * args.chunk_size]
+    chunks = [targets[i:i + args.chunk_size] for i in range(0, len(targets), args.chunk_size)]
+    spare_workers = args.parallel if args.spare_workers is None else args.spare_workers
+
+    app = fa.FirefoxApp(args.app_dir)
+    options = {"num_workers": args.parallel, "targets_per_worker": args.requestsperworker, "timeout": args.timeout}
+    cold = benchmark_chunks(app, chunks, spare_workers=0, **options)
+    warm = benchmark_chunks(app, chunks, spare_workers=spare_workers, **options)
+
+    print("chunk  hosts  cold (s)  warm (s)")
+    for i, chunk in enumerate(chunks):
+        print("%5d  %5d  %8.2f  %8.2f" % (i + 1, len(chunk), cold[i], warm[i]))
+    print("total         %8.2f  %8.2f" % (sum(cold), sum(warm)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
 import json
 import logging
 import os
@@ -12,32 +13,67 @@ from threading import Thread
 logger = logging.getLogger(__name__)
 module_dir = os.path.realpath(os.path.join(os.path.split(__file__)[0], os.path.pardir))
 
+# Commands handled by worker_common.js itself. They yield a single response,
+# while custom commands like `scan` are ACKed first and answered later.
+single_response_modes = ("hello", "info", "useprofile", "setprefs", "quit", "wakeup")
+
+# Maximum length of a single worker message. Scan results with certificate
+# chains can be several hundred kilobytes long.
+max_message_size = 32 * 1024 * 1024
+
+
+def parse_worker_output(worker, line):
+    """Parse a line of worker output. The convention is that all worker
+       output that parses as JSON is a response, else it is interpreted
+       as a JavaScript error or warning. Returns None for the latter.
+    """
+    global logger
+
+    line = line.decode("utf-8").strip()
+    try:
+        response = Response(line)
+        logger.debug("Received worker message: %s" % line)
+        return response
+    except ValueError:
+        if line.startswith("JavaScript error:"):
+            logger.error("JS error from worker %s: %s" % (worker, line))
+        elif line.startswith("JavaScript warning:"):
+            logger.warning("JS warning from worker %s: %s" % (worker, line))
+        else:
+            logger.critical("Invalid output from worker %s: %s" % (worker, line))
+        return None
+
 
 def read_from_worker(worker, response_queue):
-    """Reader thread that reads messages from the worker.
-       The convention is that all worker output that parses
-       as JSON is routed to the response queue, else it is
-       interpreted as a JavaScript error or warning.
+    """Reader thread that reads messages from the worker
+       and routes responses to the response queue.
     """
     global logger
 
     logger.debug('Reader thread started for worker %s' % worker)
     for line in iter(worker.stdout.readline, b''):
-        line = line.decode("utf-8").strip()
-        try:
-            response_queue.put(Response(line))
-            logger.debug("Received worker message: %s" % line)
-        except ValueError:
-            if line.startswith("JavaScript error:"):
-                logger.error("JS error from worker %s: %s" % (worker, line))
-            elif line.startswith("JavaScript warning:"):
-                logger.warning("JS warning from worker %s: %s" % (worker, line))
-            else:
-                logger.critical("Invalid output from worker %s: %s" % (worker, line))
+        response = parse_worker_output(worker, line)
+        if response is not None:
+            response_queue.put(response)
     logger.debug('Reader thread finished for worker %s' % worker)
     worker.stdout.close()
 
 
+def worker_command_line(app, head_script, script):
+    return [app.exe, '-xpcshell', "-g", app.gredir, "-a", app.browser, "-f", head_script, script]
+
+
+def process_rss(pid):
+    """Return the resident set size of a process in bytes. Returns None
+       on platforms without a /proc filesystem."""
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            rss_pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+
 class XPCShellWorker(object):
     """XPCShell worker implementing an asynchronous, JSON-based message system"""
 
@@ -63,7 +99,7 @@ class XPCShellWorker(object):
         """Spawn the worker process and its dedicated reader thread"""
         global logger, module_dir
 
-        cmd = [self.__app.exe, '-xpcshell', "-g", self.__app.gredir, "-a", self.__app.browser, "-f", self.__head_script, self.__script]
+        cmd = worker_command_line(self.__app, self.__head_script, self.__script)
         logger.debug("Executing worker shell command `%s`" % ' '.join(cmd))
 
         self.__worker_thread = subprocess.Popen(
@@ -119,6 +155,12 @@ class XPCShellWorker(object):
             return False
         return self.__worker_thread.poll() is None
 
+    def rss(self):
+        """Return the resident set size of the worker process in bytes, or None if unknown"""
+        if not self.is_running():
+            return None
+        return process_rss(self.__worker_thread.pid)
+
     def send(self, cmd):
         """Send a command message to the worker"""
         global logger
@@ -153,6 +195,239 @@ class XPCShellWorker(object):
         return self.__response_queue.get()
 
 
+class WorkerError(Exception):
+    """Raised for commands that can't be answered, because the worker quit"""
+    pass
+
+
+class PendingCommand(object):
+    """Futures for the ACK and the final response of a command sent to an AsyncXPCShellWorker"""
+
+    def __init__(self, cmd, loop):
+        self.cmd = cmd
+        self.ack = loop.create_future()
+        self.result = loop.create_future()
+
+    def resolve(self, response):
+        """Route a response to the matching future. Returns True if the command is finished."""
+        if response.original_cmd is None:
+            # Compact responses only carry the command ID
+            response.original_cmd = self.cmd.as_dict()
+        if response.result == "ACK" and self.cmd.mode not in single_response_modes:
+            if not self.ack.done():
+                self.ack.set_result(response)
+            return False
+        if not self.ack.done():
+            self.ack.set_result(response)
+        if not self.result.done():
+            self.result.set_result(response)
+        return True
+
+    def fail(self, error):
+        for future in (self.ack, self.result):
+            if not future.done():
+                future.set_exception(error)
+                # Mark as retrieved, because nobody might be waiting for it anymore
+                future.exception()
+
+
+class AsyncXPCShellWorker(object):
+    """XPCShell worker driven by asyncio subprocess streams. Every command
+       sent through .send() is tracked by its ID, so responses can be awaited
+       individually instead of polling a shared response queue.
+    """
+
+    def __init__(self, app, script=None, head_script=None, profile=None, prefs=None):
+        global module_dir
+
+        self.__app = app
+        if script is None:
+            self.__script = os.path.join(module_dir, "js", "scan_worker.js")
+        else:
+            self.__script = script
+        if head_script is None:
+            self.__head_script = os.path.join(module_dir, "js", "worker_common.js")
+        else:
+            self.__head_script = head_script
+        self.__profile = profile
+        self.__prefs = prefs
+        self.__process = None
+        self.__reader_task = None
+        self.__pending = {}
+        self.__next_id = 1
+        self.async_input = False
+        self.compact_responses = False
+
+    async def spawn(self):
+        """Spawn the worker process and its reader task, then apply profile and prefs"""
+        global logger
+
+        cmd = worker_command_line(self.__app, self.__head_script, self.__script)
+        logger.debug("Executing worker shell command `%s`" % ' '.join(cmd))
+
+        self.__process = await asyncio.create_subprocess_exec(
+            *cmd,
+            cwd=self.__app.browser,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            limit=max_message_size)
+        self.__reader_task = asyncio.ensure_future(self.__read_responses())
+
+        # Workers that read stdin asynchronously process network events on their own.
+        # Others only do so when nudged by `wakeup` commands.
+        # Workers that agree to compact responses don't echo commands back, because
+        # pending commands are looked up by ID anyway.
+        response = await self.request(Command("hello", compact_responses=True))
+        if response is None:
+            logger.error("Worker did not respond to greeting")
+            return False
+        self.async_input = response.success and response.result.get("async_input") is True
+        self.compact_responses = response.success and response.result.get("compact_responses") is True
+        logger.debug("Worker reads commands %s" % ("asynchronously" if self.async_input else "blocking"))
+        logger.debug("Worker sends %s responses" % ("compact" if self.compact_responses else "verbose"))
+
+        if self.__profile is not None:
+            logger.debug("Changing worker profile to `%s`" % self.__profile)
+            response = await self.request(Command("useprofile", path=self.__profile))
+            if response is None or response.result != "ACK":
+                logger.error("Worker failed to set profile `%s`" % self.__profile)
+                return False
+
+        if self.__prefs is not None:
+            logger.debug("Setting worker prefs to `%s`" % self.__prefs)
+            response = await self.request(Command("setprefs", prefs=self.__prefs))
+            if response is None or response.result != "ACK":
+                logger.error("Worker failed to set prefs `%s`" % self.__prefs)
+                return False
+
+        return True
+
+    async def __read_responses(self):
+        global logger
+
+        logger.debug("Reader task started for worker %s" % self)
+        while True:
+            try:
+                line = await self.__process.stdout.readline()
+            except ValueError as error:
+                # Message exceeded the stream limit. The stream is unusable afterwards.
+                logger.critical("Oversized output from worker %s: %s" % (self, error))
+                break
+            if line == b"":
+                break
+            response = parse_worker_output(self, line)
+            if response is None:
+                continue
+            pending = self.__pending.get(response.id)
+            if pending is None:
+                logger.debug("Ignoring response to untracked command %s" % response.id)
+            elif pending.resolve(response):
+                del self.__pending[response.id]
+        logger.debug("Reader task finished for worker %s" % self)
+
+        # Nothing will answer the remaining commands
+        pending_commands = self.__pending
+        self.__pending = {}
+        for pending in pending_commands.values():
+            pending.fail(WorkerError("Worker quit before answering `%s` command" % pending.cmd.mode))
+
+    async def send(self, cmd, track=True):
+        """Send a command message to the worker. Returns a PendingCommand if the
+           command is tracked, True if it is untracked, or None if sending failed."""
+        global logger
+
+        if self.__reader_task is None or self.__reader_task.done():
+            # Nothing would ever answer, e.g. because the worker crashed
+            logger.debug("Worker is gone. Message `%s` wasn't heard." % cmd)
+            return None
+
+        pending = None
+        if track:
+            if cmd.id is None:
+                cmd.id = self.__next_id
+                self.__next_id += 1
+            pending = PendingCommand(cmd, asyncio.get_event_loop())
+            self.__pending[cmd.id] = pending
+
+        cmd_string = str(cmd)
+        logger.debug("Sending worker message: `%s`" % cmd_string)
+        try:
+            self.__process.stdin.write((cmd_string + "\n").encode("utf-8"))
+            await self.__process.stdin.drain()
+        except (IOError, AttributeError):
+            logger.debug("Can't write to worker. Message `%s` wasn't heard." % cmd_string)
+            if track:
+                self.forget(cmd)
+            return None
+
+        return pending if track else True
+
+    async def request(self, cmd):
+        """Send a command and wait for its final response. Returns None on failure."""
+        pending = await self.send(cmd)
+        if pending is None:
+            return None
+        try:
+            return await pending.result
+        except WorkerError:
+            return None
+
+    def forget(self, cmd):
+        """Stop tracking a command, e.g. after timing out on it"""
+        self.__pending.pop(cmd.id, None)
+
+    def pending_count(self):
+        """Return the number of commands that were not finally answered, yet"""
+        return len(self.__pending)
+
+    def is_running(self):
+        """Check whether the worker is still fully running"""
+        if self.__process is None:
+            return False
+        return self.__process.returncode is None and not self.__reader_task.done()
+
+    def rss(self):
+        """Return the resident set size of the worker process in bytes, or None if unknown"""
+        if not self.is_running():
+            return None
+        return process_rss(self.__process.pid)
+
+    def terminate(self):
+        """Signal the worker process to quit"""
+        if self.__process is not None and self.__process.returncode is None:
+            try:
+                self.__process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def kill(self):
+        """Kill the worker process"""
+        if self.__process is not None and self.__process.returncode is None:
+            try:
+                self.__process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def quit(self, timeout=5):
+        """Ask the worker to quit and wait for it to exit, killing it if it doesn't"""
+        global logger
+
+        if self.__process is None:
+            return
+        if self.is_running():
+            await self.send(Command("quit"), track=False)
+            # Closing stdin ends the worker's input pump
+            self.__process.stdin.close()
+        try:
+            await asyncio.wait_for(self.__process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.debug("Worker %s did not quit in time. Killing it." % self)
+            self.kill()
+            await self.__process.wait()
+        await self.__reader_task
+
+
 class Command(object):
 
     def __init__(self, mode, id=None, **kwargs):
@@ -162,6 +437,22 @@ class Command(object):
         self.__mode = mode
         self.__args = kwargs
 
+    @property
+    def id(self):
+        return self.__id
+
+    @id.setter
+    def id(self, value):
+        self.__id = value
+
+    @property
+    def mode(self):
+        return self.__mode
+
+    @property
+    def args(self):
+        return self.__args
+
     def as_dict(self):
         return {"id": self.__id, "mode": self.__mode, "args": self.__args}
 
@@ -195,7 +486,8 @@ class Response(object):
             self.command_time = message["command_time"]
         if "response_time" in message:
             self.response_time = message["response_time"]
-        if len(message) != 7:
+        # Compact responses lack the original command
+        if len(message) != (7 if self.original_cmd is not None else 6):
             logger.error("Worker response has unexpected format: %s" % message_string)
 
     def as_dict(self):
@@ -2,39 +2,260 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
+import base64
+from collections import deque
+import json
 import logging
-import time
-from worq.pool.thread import WorkerPool
-from worq import get_broker, get_queue, TaskSpace
+import random
+import sys
 
+from tlscanary.tools import cleanup
+from tlscanary.tools import concurrency
+from tlscanary.tools import timing
 from tlscanary.tools import xpcshell_worker as xw
 
 
 logger = logging.getLogger(__name__)
-ts = TaskSpace(__name__)
-pool = None
+live_workers = set()
 
+# Event loop that is kept across scans, so spare workers survive from one scan to the next
+event_loop = None
+spare_pool = None
 
-def init(worq_url):
-    global ts
-    broker = get_broker(worq_url)
-    broker.expose(ts)
-    return broker
+# Number of times a host is re-dispatched after losing its worker
+max_retries = 3
 
+# Maximum number of known certificate fingerprints sent to a new worker
+max_known_certificates = 10000
 
-def start_pool(worq_url, num_workers=1, **kw):
-    broker = init(worq_url)
-    new_pool = WorkerPool(broker, workers=num_workers)
-    new_pool.start(**kw)
-    return new_pool
+# Share of worker slots that scan with the base build in regression scans
+base_worker_share = 0.25
+
+# Factor by which the timeout of a host grows with every regression rescan
+timeout_escalation = 1.25
 
 
 def stop():
-    global logger, pool
-    logger.debug("Stopping worker pool %s" % pool)
-    if pool is not None:
-        pool.stop()
-        pool = None
+    """Kill all worker processes that are still alive, e.g. after a user abort"""
+    global logger, live_workers
+    logger.debug("Stopping %d live workers" % len(live_workers))
+    for worker in list(live_workers):
+        worker.xpcw.kill()
+    live_workers.clear()
+
+
+def new_event_loop():
+    """Return a fresh event loop that is able to drive subprocesses"""
+    if sys.platform == "win32":
+        # Subprocesses require the proactor loop on Windows prior to Python 3.8
+        loop = asyncio.ProactorEventLoop()
+    else:
+        loop = asyncio.new_event_loop()
+    # The child watcher on POSIX systems needs a current event loop
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def get_event_loop():
+    """Return the event loop that scans run on, creating it if necessary"""
+    global event_loop
+    if event_loop is None or event_loop.is_closed():
+        event_loop = new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    return event_loop
+
+
+def close_event_loop():
+    """Close the scan event loop after an abort. Spare workers are gone with it."""
+    global event_loop, spare_pool
+    spare_pool = None
+    if event_loop is not None:
+        asyncio.set_event_loop(None)
+        event_loop.close()
+        event_loop = None
+
+
+def shutdown():
+    """Quit spare workers and close the scan event loop"""
+    global event_loop, spare_pool
+    if spare_pool is not None and event_loop is not None and not event_loop.is_closed():
+        event_loop.run_until_complete(spare_pool.close())
+    close_event_loop()
+
+
+class WorkerCleanUp(cleanup.CleanUp):
+    """Kill workers that are still around when the process terminates"""
+    @staticmethod
+    def at_exit():
+        stop()
+
+
+class PersistentWorker(object):
+    """
+    Wrapper around an AsyncXPCShellWorker that is configured once and then
+    serves many scan requests until it is recycled after a maximum number
+    of requests or when its memory footprint exceeds a ceiling.
+    """
+
+    def __init__(self, app, profile=None, prefs=None, max_requests=None, max_rss=None, cert_db=None):
+        self.app = app
+        self.profile = profile
+        self.prefs = prefs
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.cert_db = cert_db
+        self.requests = 0
+        self.xpcw = xw.AsyncXPCShellWorker(app, profile=profile, prefs=prefs)
+        self.wakeup_pump = None
+        # Set when the worker may have sent certificate data that was never stored
+        self.lost_certificates = False
+
+    async def start(self):
+        global logger, live_workers
+        live_workers.add(self)
+        if not await self.xpcw.spawn():
+            return False
+        if self.cert_db is not None:
+            # Spare the worker from sending issuer certificates that are stored already.
+            # Leaf certificates are left out, because they are rarely shared among hosts.
+            known_issuers = [fingerprint for fingerprint in self.cert_db.issuers if fingerprint in self.cert_db.known]
+            if len(known_issuers) > 0:
+                response = await self.xpcw.request(xw.Command("knowncerts",
+                                                              fingerprints=known_issuers[:max_known_certificates]))
+                if response is None or not response.success:
+                    logger.warning("Worker failed to accept known certificates")
+        if not self.xpcw.async_input:
+            self.wakeup_pump = asyncio.ensure_future(self.__pump_wakeups())
+        return True
+
+    async def stop(self):
+        global logger, live_workers
+        logger.debug("Stopping persistent worker after %d requests" % self.requests)
+        if self.wakeup_pump is not None:
+            self.wakeup_pump.cancel()
+        await self.xpcw.quit()
+        live_workers.discard(self)
+
+    async def __pump_wakeups(self):
+        """
+        Nudge a worker that blocks on reading stdin periodically while it has
+        requests pending, so it processes network events.
+        """
+        wakeup_cmd = xw.Command("wakeup")
+        while self.xpcw.is_running():
+            if self.xpcw.pending_count() > 0:
+                if await self.xpcw.send(wakeup_cmd, track=False) is None:
+                    break
+            await asyncio.sleep(0.1)
+
+    def needs_recycling(self):
+        global logger
+        if not self.xpcw.is_running():
+            return True
+        if self.lost_certificates:
+            # The worker believes it delivered certificates that were never stored
+            logger.debug("Recycling worker after losing certificate data")
+            return True
+        if self.max_requests is not None and self.requests >= self.max_requests:
+            logger.debug("Recycling worker after %d requests" % self.requests)
+            return True
+        if self.max_rss is not None:
+            rss = self.xpcw.rss()
+            if rss is not None and rss > self.max_rss * 1024 * 1024:
+                logger.debug("Recycling worker with RSS of %d MB" % (rss / 1024 / 1024))
+                return True
+        return False
+
+
+class SparePool(object):
+    """
+    Pool of spare PersistentWorkers that are spawned and configured ahead of
+    time, so worker start-up is not on the critical path of a scan. Up to `size`
+    spares are kept for every combination of app, profile and prefs. Handing
+    out a spare triggers a background refill. Healthy workers are returned to
+    the pool at the end of a scan, so the next scan can start with them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.spares = {}
+        self.refills = {}
+
+    @staticmethod
+    def config(app, profile, prefs, cert_db):
+        return app.exe, profile, None if prefs is None else tuple(prefs), id(cert_db)
+
+    async def get(self, app, profile=None, prefs=None, max_requests=None, max_rss=None, cert_db=None):
+        """Return a started worker, or None if none could be started"""
+        config = self.config(app, profile, prefs, cert_db)
+        spares = self.spares.setdefault(config, deque())
+        worker = None
+        while worker is None and len(spares) > 0:
+            worker = spares.popleft()
+            if not worker.xpcw.is_running():
+                await worker.stop()
+                worker = None
+        if worker is None:
+            worker = PersistentWorker(app, profile=profile, prefs=prefs, cert_db=cert_db)
+            if not await worker.start():
+                await worker.stop()
+                return None
+        worker.max_requests = max_requests
+        worker.max_rss = max_rss
+        self.refill(config, app, profile, prefs, cert_db)
+        return worker
+
+    async def put(self, worker):
+        """Return a worker to the pool, or stop it if it is not fit for reuse"""
+        config = self.config(worker.app, worker.profile, worker.prefs, worker.cert_db)
+        spares = self.spares.setdefault(config, deque())
+        if len(spares) < self.size and worker.xpcw.pending_count() == 0 and not worker.needs_recycling():
+            spares.append(worker)
+        else:
+            await worker.stop()
+
+    def refill(self, config, app, profile, prefs, cert_db):
+        task = self.refills.get(config)
+        if task is None or task.done():
+            self.refills[config] = asyncio.ensure_future(self.__refill(config, app, profile, prefs, cert_db))
+
+    async def __refill(self, config, app, profile, prefs, cert_db):
+        global logger
+
+        spares = self.spares[config]
+        while len(spares) < self.size:
+            worker = PersistentWorker(app, profile=profile, prefs=prefs, cert_db=cert_db)
+            try:
+                started = await worker.start()
+            except asyncio.CancelledError:
+                # Pool is closing
+                await worker.stop()
+                raise
+            if not started:
+                logger.warning("Unable to start spare worker")
+                await worker.stop()
+                break
+            spares.append(worker)
+            logger.debug("Spare pool holds %d workers" % len(spares))
+
+    async def close(self):
+        """Quit all spare workers"""
+        for task in self.refills.values():
+            task.cancel()
+        await asyncio.gather(*self.refills.values(), return_exceptions=True)
+        self.refills = {}
+        await asyncio.gather(*[worker.stop() for spares in self.spares.values() for worker in spares])
+        self.spares = {}
+
+
+def get_spare_pool(size):
+    """Return the spare pool of the scan event loop, resized to `size`"""
+    global spare_pool
+    if spare_pool is None:
+        spare_pool = SparePool(size)
+    spare_pool.size = size
+    return spare_pool
 
 
 class ScanResult(object):
@@ -72,6 +293,33 @@ class ScanResult(object):
         # Else, the request had some sort of issue
         return False
 
+    def outcome(self):
+        """Classify the result as "ok", "error", or "timeout" for concurrency control"""
+        if self.success:
+            return "ok"
+        if type(self.response.result) is dict \
+                and self.response.result.get("origin") in ("timeout_handler", "abort_handler"):
+            return "timeout"
+        return "error"
+
+    @classmethod
+    def from_dict(cls, result_dict):
+        """Restore a ScanResult from the output of .as_dict()"""
+        return cls(xw.Response(json.dumps(result_dict["response"])))
+
+    def elapsed(self):
+        """Return the time in seconds the worker took to answer the request"""
+        return (self.response.response_time - self.response.command_time) / 1000.0
+
+    def phase_durations(self):
+        """
+        Return connection phase durations in milliseconds as measured by the channel, or None
+        if the worker did not report timing info
+        """
+        if type(self.response.result) is not dict or "info" not in self.response.result:
+            return None
+        return timing.phase_durations(self.response.result["info"].get("timing"))
+
     def as_dict(self):
         return {
             "response": self.response.as_dict(),
@@ -81,125 +329,792 @@ class ScanResult(object):
         }
 
 
-@ts.task
-def scan_urls(app, target_list, profile=None, prefs=None, get_certs=False, timeout=10):
+class TargetQueue(object):
+    """
+    Target source that is fed while a scan is running. Worker slots wait for
+    new targets until the queue is closed.
+    """
+
+    def __init__(self):
+        self.targets = deque()
+        self.closed = False
+        self.waiters = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.targets) == 0:
+            raise StopIteration
+        return self.targets.popleft()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def put(self, target, first=False):
+        """Add a target to the end of the queue, or to its front if `first` is set"""
+        if first:
+            self.targets.appendleft(target)
+        else:
+            self.targets.append(target)
+        self.__wake()
+
+    def close(self):
+        """Signal that no more targets will be added"""
+        self.closed = True
+        self.__wake()
+
+    def exhausted(self):
+        return self.closed and len(self.targets) == 0
+
+    async def wait(self):
+        """Wait until a target is available or the queue is closed"""
+        if len(self.targets) > 0 or self.closed:
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        await waiter
+
+    def __wake(self):
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+
+
+def store_certificates(cert_db, result):
+    """
+    Move DER data of newly seen certificates from a scan result into the CertDB,
+    so the result only references its certificate chain by SHA-256 fingerprints.
+    """
     global logger
 
-    logger.debug("scan_urls task called with %s" % repr(target_list))
-
-    # Spawn a worker instance
-    xpcw = xw.XPCShellWorker(app, profile=profile, prefs=prefs)
-    xpcw.spawn()
-
-    # Enqueue all host scans for this worker instance
-    wakeup_cmd = xw.Command("wakeup")
-    cmd_count = 0
-    for rank, host in target_list:
-        scan_cmd = xw.Command("scan", host=host, rank=rank, include_certificates=get_certs, timeout=timeout)
-        xpcw.send(scan_cmd)
-        if cmd_count % 10 == 0:
-            xpcw.send(wakeup_cmd)
-        cmd_count += 1
-
-    # Fetch results from queue, until all results are in or until the last
-    # scan must have into timeout. Note that ACKs come in strict sequence of
-    # their respective commands.
-    results = {}
-    timeout_time = time.time() + timeout + 1
-    while time.time() < timeout_time:
-        for response in xpcw.receive():
-            if response.result == "ACK":
-                # Reset timeout when scan commands are ACKed.
-                if response.original_cmd["mode"] == "scan":
-                    timeout_time = time.time() + timeout + 1
-                # Ignore other ACKs.
+    if type(result) is not dict or "info" not in result:
+        return
+    cert_data = result["info"].pop("certificate_data", None)
+    if cert_data is None:
+        return
+    for fingerprint, data in cert_data.items():
+        if not cert_db.exists(fingerprint):
+            if cert_db.put(base64.b64decode(data)) != fingerprint:
+                logger.warning("Certificate data does not match its fingerprint `%s`" % fingerprint)
+    chain = result["info"].get("certificate_chain")
+    if chain is not None:
+        cert_db.issuers.update(chain[1:])
+
+
+async def scan_host(worker, rank, host, get_certs=False, timeout=10, sent_callback=None):
+    """
+    Scan a single host. Returns a ScanResult, or None if the worker did not answer in time.
+    Raises WorkerError if the worker quit before answering.
+
+    If the worker has a CertDB, certificates are negotiated by fingerprint.
+    The optional `sent_callback` is called once the request was sent to the worker.
+    """
+    global logger
+
+    fingerprints = get_certs and worker.cert_db is not None
+    cmd = xw.Command("scan", host=host, rank=rank, include_certificates=get_certs,
+                     certificate_fingerprints=fingerprints, timeout=timeout)
+    pending = await worker.xpcw.send(cmd)
+    if pending is None:
+        raise xw.WorkerError("Unable to send scan of `%s` to worker" % host)
+    if sent_callback is not None:
+        sent_callback()
+
+    try:
+        # The request timeout starts when the worker ACKs the command
+        await asyncio.wait_for(pending.ack, timeout + 1)
+        response = await asyncio.wait_for(pending.result, timeout + 1)
+    except asyncio.TimeoutError:
+        logger.debug("Worker did not answer scan of `%s` in time" % host)
+        worker.xpcw.forget(cmd)
+        if fingerprints:
+            worker.lost_certificates = True
+        return None
+
+    if worker.cert_db is not None:
+        store_certificates(worker.cert_db, response.result)
+
+    return ScanResult(response)
+
+
+async def __run_slot(targets, result_callback, app, profile=None, prefs=None, window=50, get_certs=False, timeout=10,
+                     max_requests=None, max_rss=None, controller=None, retries=max_retries, cert_db=None,
+                     event_callback=None, pool=None, drop_callback=None):
+    """
+    Work off targets with a persistent worker, keeping up to `window` requests
+    in flight. Every answered request is immediately replaced by the next one,
+    so a single slow host does not stall the others. The target iterator is
+    shared among all slots.
+
+    If an AIMDController is given, it determines the window size instead.
+    `result_callback` is called with every ScanResult as it arrives.
+    Certificates are stored in `cert_db` if one is given.
+
+    When the worker crashes, it is respawned with the same profile and prefs,
+    and the hosts that were in flight are dispatched again one at a time, up
+    to `retries` times each.
+
+    The optional `event_callback` is called with the name of every scan event,
+    see ProgressTracker.log_event().
+
+    If a SparePool is given, workers are taken from it and returned to it.
+
+    `targets` may be a TargetQueue that is fed while the slot is running. The
+    slot then only starts its worker when the first target arrives and keeps
+    waiting for targets until the queue is closed.
+
+    Targets are (rank, host) tuples, or (rank, host, options) tuples where the
+    options dict overrides `timeout` and `get_certs` for that host, and may
+    hold a `sent_callback` for scan_host(). The optional
+    `drop_callback` is called with every target that yields no result.
+    """
+    global logger
+
+    def report(event):
+        if event_callback is not None:
+            event_callback(event)
+
+    def drop(target):
+        if drop_callback is not None:
+            drop_callback(target)
+
+    worker = None
+    in_flight = {}
+    requeued = deque()
+    crashes = {}
+    targets_left = True
+    feed = targets if isinstance(targets, TargetQueue) else None
+    try:
+        while targets_left or len(requeued) > 0 or len(in_flight) > 0:
+            if worker is None and len(requeued) == 0 and feed is not None:
+                # Only spawn a worker once there is work for it
+                await feed.wait()
+                if feed.exhausted():
+                    break
+            # A worker is only replaced once all its requests are answered
+            if worker is not None and len(in_flight) == 0 and worker.needs_recycling():
+                if not worker.xpcw.is_running():
+                    logger.warning("Worker crashed after %d requests. Respawning it" % worker.requests)
+                await worker.stop()
+                worker = None
+            if worker is None:
+                if pool is not None:
+                    worker = await pool.get(app, profile=profile, prefs=prefs,
+                                            max_requests=max_requests, max_rss=max_rss, cert_db=cert_db)
+                else:
+                    worker = PersistentWorker(app, profile=profile, prefs=prefs,
+                                              max_requests=max_requests, max_rss=max_rss, cert_db=cert_db)
+                    if not await worker.start():
+                        await worker.stop()
+                        worker = None
+                if worker is None:
+                    logger.error("Unable to start worker")
+                    if len(requeued) > 0:
+                        logger.warning("Dropping %d hosts that lost their worker" % len(requeued))
+                        for target in requeued:
+                            drop(target)
+                    # Leave the remaining targets to the other slots
+                    break
+
+            # Refill the window
+            can_dispatch = len(in_flight) == 0 or not worker.needs_recycling()
+            if controller is not None:
+                window = controller.limit
+            while can_dispatch and len(in_flight) < window:
+                if len(requeued) > 0:
+                    # Rescan lost hosts one by one, so a host that crashes the
+                    # worker does not take down the others again
+                    if len(in_flight) > 0:
+                        break
+                    target = requeued.popleft()
+                elif targets_left:
+                    target = next(targets, None)
+                    if target is None:
+                        # A queue that is still open may deliver more targets
+                        targets_left = feed is not None and not feed.closed
+                        break
+                else:
+                    break
+                rank, host = target[:2]
+                options = target[2] if len(target) > 2 else {}
+                in_flight[asyncio.ensure_future(scan_host(worker, rank, host,
+                                                          get_certs=options.get("get_certs", get_certs),
+                                                          timeout=options.get("timeout", timeout),
+                                                          sent_callback=options.get("sent_callback")))] = target
+                worker.requests += 1
+                report("dispatched")
+                if max_requests is not None and worker.requests >= max_requests:
+                    break
+
+            wait_for = set(in_flight)
+            new_targets = None
+            if feed is not None and targets_left and len(requeued) == 0 and len(in_flight) < window:
+                # Wake up for targets that arrive while requests are in flight
+                new_targets = asyncio.ensure_future(feed.wait())
+                wait_for.add(new_targets)
+            if len(wait_for) == 0:
+                continue
+            done, _ = await asyncio.wait(wait_for, return_when=asyncio.FIRST_COMPLETED)
+            if new_targets is not None:
+                new_targets.cancel()
+                done.discard(new_targets)
+            for task in done:
+                target = in_flight.pop(task)
+                host = target[1]
+                try:
+                    result = task.result()
+                except xw.WorkerError:
+                    crashes[host] = crashes.get(host, 0) + 1
+                    if crashes[host] > retries:
+                        logger.warning("Giving up on `%s` after losing %d workers" % (host, crashes[host]))
+                        report("lost")
+                        drop(target)
+                    else:
+                        requeued.append(target)
+                        report("retry")
+                    continue
+                report("timeout" if result is None else result.outcome())
+                if controller is not None:
+                    if result is None:
+                        controller.record("timeout", target[2].get("timeout", timeout) if len(target) > 2 else timeout)
+                    else:
+                        controller.record(result.outcome(), result.elapsed())
+                if result is not None:
+                    result_callback(result)
+                else:
+                    drop(target)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if worker is not None:
+            if pool is not None:
+                await pool.put(worker)
+            else:
+                await worker.stop()
+        if controller is not None:
+            logger.debug("Concurrency stats for worker slot: %s" % controller.stats())
+
+
+async def scan_stream(app, target_list, result_callback, profile=None, prefs=None, num_workers=4,
+                      targets_per_worker=50, get_certs=False, timeout=10, progress_callback=None,
+                      max_requests=None, max_rss=None, adaptive=False, retries=max_retries, cert_db=None,
+                      event_callback=None, spare_workers=0):
+    """
+    Coroutine that scans all targets with `num_workers` workers in parallel,
+    each keeping `targets_per_worker` requests in flight. If `adaptive` is set,
+    every worker adjusts its number of requests in flight, starting from
+    `targets_per_worker`. Hosts that were in flight when their worker crashed
+    are scanned again up to `retries` times. If a CertDB is given, certificate
+    chains are stored there and results reference them by SHA-256 fingerprint.
+
+    `progress_callback` is called with 1 for every result and for every host
+    that is dropped without one, so progress reaches the total. `event_callback`
+    is called with the name of every scan event, see ProgressTracker.log_event().
+
+    With `spare_workers` set, up to that many configured workers are kept
+    ready in a SparePool, and workers are kept for the next scan.
+
+    `target_list` may also be a TargetQueue that is fed while the scan runs.
+
+    Results are not kept, but passed to `result_callback` as they arrive.
+    Returns the number of results.
+    """
+    global logger
+
+    result_count = 0
+    fed = isinstance(target_list, TargetQueue)
+
+    def on_result(result):
+        nonlocal result_count
+        result_count += 1
+        result_callback(result)
+        if progress_callback is not None:
+            progress_callback(1)
+
+    def on_drop(target):
+        if progress_callback is not None:
+            progress_callback(1)
+
+    pool = get_spare_pool(spare_workers) if spare_workers > 0 else None
+    targets = iter(target_list)
+    if fed:
+        num_slots = num_workers
+    else:
+        num_slots = min(num_workers, (len(target_list) + targets_per_worker - 1) // targets_per_worker)
+    await asyncio.gather(*[__run_slot(targets, on_result, app, profile=profile, prefs=prefs,
+                                      window=targets_per_worker, get_certs=get_certs, timeout=timeout,
+                                      max_requests=max_requests, max_rss=max_rss, retries=retries, cert_db=cert_db,
+                                      event_callback=event_callback, pool=pool, drop_callback=on_drop,
+                                      controller=concurrency.AIMDController(targets_per_worker, timeout=timeout)
+                                      if adaptive else None)
+                           for _ in range(num_slots)])
+
+    if not fed:
+        # Hosts that were left when all workers failed to start
+        for target in targets:
+            on_drop(target)
+    if not fed and result_count < len(target_list):
+        logger.warning("Workers dropped results, yielded %d instead of %d" % (result_count, len(target_list)))
+
+    return result_count
+
+
+async def confirm_regressions(test_app, base_app, target_list, result_callback, test_profile=None, test_prefs=None,
+                              base_profile=None, base_prefs=None, scans=3, num_workers=4, targets_per_worker=50,
+                              timeout=10, max_timeout=20, get_certs=False, cert_db=None, info_workers=2,
+                              info_requests_per_worker=5, progress_callback=None,
+                              overhead_callback=None, max_requests=None, max_rss=None, adaptive=False,
+                              retries=max_retries, event_callback=None, spare_workers=0, base_cache=None):
+    """
+    Coroutine that narrows targets down to hosts that fail with the test build,
+    but not with the base build. Every host moves through its own sequence of
+    scans as its results arrive:
+
+        test #1 -> base #1 -> test #2 -> base #2 -> ... -> base #scans -> info
+
+    A host drops out as soon as the test build connects to it or the base build
+    fails it, so no host waits for the slowest host of its pass. Every rescan
+    raises the host's timeout by `timeout_escalation`, up to `max_timeout`. The
+    final info scan of confirmed hosts collects certificates if `get_certs` is
+    set. It runs on up to `info_workers` slots of its own with a low concurrency
+    of `info_requests_per_worker`, so its results are not skewed by the bulk scans.
+
+    All stages share the budget of `num_workers` slots with at least one slot
+    each. With fewer than three workers, every slot serves all stages in turn
+    instead. Test and info workers are configured alike, so info slots take
+    warm test workers from the SparePool if `spare_workers` is set.
+
+    If a ResultCache is given as `base_cache`, base scans are skipped for hosts
+    with a fresh cached outcome. Only base successes are stored there, because
+    a transient base failure must not keep a host from being checked again.
+
+    `progress_callback` is called with 1 for every result of the first test scan
+    and for every host dropped before it, `overhead_callback` for every other result. `result_callback` is called with
+    the info ScanResult of every potential regression.
+
+    Returns a set of (rank, host) tuples of potential regressions.
+    """
+    global logger
+
+    queues = {"test": TargetQueue(), "base": TargetQueue(), "info": TargetQueue()}
+    scan_counts = {}
+    stats = {"fixed": 0, "base_errors": 0, "dropped": 0, "cached": 0}
+    regressions = set()
+    unscanned = set(host for _, host in target_list)
+    hosts_left = len(target_list)
+    dead_stages = set()
+
+    def host_timeout(scan):
+        return min(max_timeout, timeout * timeout_escalation ** (scan - 1))
+
+    def finish():
+        nonlocal hosts_left
+        hosts_left -= 1
+        if hosts_left == 0:
+            for queue in queues.values():
+                queue.close()
+
+    def send(stage, target, first=False):
+        if stage in dead_stages:
+            on_drop(target)
+        else:
+            queues[stage].put(target, first=first)
+
+    def count(first_scan):
+        callback = progress_callback if first_scan else overhead_callback
+        if callback is not None:
+            callback(1)
+
+    def on_test_result(result):
+        scan = scan_counts.get(result.host, 1)
+        count(scan == 1)
+        unscanned.discard(result.host)
+        if result.success:
+            stats["fixed"] += 1
+            scan_counts.pop(result.host, None)
+            finish()
+        else:
+            cached = base_cache.get(result.host) if base_cache is not None else None
+            if cached is not None:
+                stats["cached"] += 1
+                base_outcome(result.rank, result.host, cached)
+            else:
+                send("base", (result.rank, result.host, {"timeout": host_timeout(scan)}), first=True)
+
+    def on_base_result(result):
+        count(False)
+        if base_cache is not None and result.success:
+            base_cache.put(result.host, True)
+        base_outcome(result.rank, result.host, result.success)
+
+    def base_outcome(rank, host, success):
+        scan = scan_counts.get(host, 1)
+        if not success:
+            stats["base_errors"] += 1
+            scan_counts.pop(host, None)
+            finish()
+        elif scan < scans:
+            scan_counts[host] = scan + 1
+            send("test", (rank, host, {"timeout": host_timeout(scan + 1)}), first=True)
+        else:
+            scan_counts.pop(host, None)
+            send("info", (rank, host, {"timeout": timeout, "get_certs": get_certs}))
+
+    def on_info_result(result):
+        count(False)
+        if not result.success:
+            regressions.add((result.rank, result.host))
+            result_callback(result)
+        finish()
+
+    def on_drop(target):
+        stats["dropped"] += 1
+        scan_counts.pop(target[1], None)
+        if target[1] in unscanned:
+            # The host won't get a first test result
+            unscanned.discard(target[1])
+            count(True)
+        finish()
+
+    for target in target_list:
+        queues["test"].put(target)
+    if hosts_left == 0:
+        for queue in queues.values():
+            queue.close()
+
+    pool = get_spare_pool(spare_workers) if spare_workers > 0 else None
+    stage_configs = {
+        "test": (on_test_result, test_app, test_profile, test_prefs, targets_per_worker, adaptive),
+        "base": (on_base_result, base_app, base_profile, base_prefs, targets_per_worker, adaptive),
+        "info": (on_info_result, test_app, test_profile, test_prefs, max(1, info_requests_per_worker), False)
+    }
+
+    def lose_stage(stage):
+        logger.error("Lost all %s scan workers" % stage)
+        dead_stages.add(stage)
+        for target in queues[stage]:
+            on_drop(target)
+
+    async def run_stage(stage, targets):
+        on_result, app, profile, prefs, window, adaptive_window = stage_configs[stage]
+        await __run_slot(targets, on_result, app, profile=profile, prefs=prefs, window=window,
+                         timeout=timeout, max_requests=max_requests, max_rss=max_rss, retries=retries,
+                         cert_db=cert_db if stage != "base" else None, event_callback=event_callback,
+                         pool=pool, drop_callback=on_drop,
+                         controller=concurrency.AIMDController(window, timeout=timeout) if adaptive_window else None)
+
+    async def stage_slot(stage):
+        await run_stage(stage, queues[stage])
+        slots_left[stage] -= 1
+        if slots_left[stage] == 0 and not queues[stage].exhausted():
+            # No worker left to scan these hosts
+            lose_stage(stage)
+
+    async def shared_slot():
+        # The stages take turns, each working off all hosts that are waiting for it
+        while not all(queue.exhausted() for queue in queues.values()):
+            idle = True
+            for stage in ("test", "base", "info"):
+                if len(queues[stage]) == 0 or stage in dead_stages:
+                    continue
+                idle = False
+                batch = iter(list(queues[stage]))
+                await run_stage(stage, batch)
+                left = list(batch)
+                if len(left) > 0:
+                    # The slot failed to start a worker for this stage
+                    for target in left:
+                        on_drop(target)
+                    lose_stage(stage)
+            if idle:
+                waiters = [asyncio.ensure_future(queue.wait()) for queue in queues.values()]
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+
+    if num_workers < 3:
+        # Too few workers for a slot per stage
+        await asyncio.gather(*[shared_slot() for _ in range(max(1, num_workers))])
+    else:
+        num_base_slots = max(1, int(num_workers * base_worker_share))
+        num_info_slots = max(1, min(info_workers, (num_workers - num_base_slots) // 2))
+        num_test_slots = num_workers - num_base_slots - num_info_slots
+        slots_left = {"test": num_test_slots, "base": num_base_slots, "info": num_info_slots}
+        await asyncio.gather(*[stage_slot("test") for _ in range(num_test_slots)],
+                             *[stage_slot("base") for _ in range(num_base_slots)],
+                             *[stage_slot("info") for _ in range(num_info_slots)])
+
+    logger.debug("Regression scan of %d hosts: %d work with test build, %d fail with base build, "
+                 "%d yielded no result, %d potential regressions, %d base scans taken from cache"
+                 % (len(target_list), stats["fixed"], stats["base_errors"], stats["dropped"], len(regressions),
+                    stats["cached"]))
+
+    return regressions
+
+
+async def scan_matrix(app, target_list, pref_sets, result_callback, num_workers=4, **kwargs):
+    """
+    Coroutine that scans all targets once per pref set, with all pref sets
+    running concurrently. Each pref set gets its own workers, which share the
+    budget of `num_workers`. Further arguments are passed to scan_stream().
+
+    :param app: FirefoxApp to scan with
+    :param target_list: list of (rank, host) tuples
+    :param pref_sets: list of (name, prefs) tuples
+    :param result_callback: function called with name of the pref set and ScanResult
+    :param num_workers: int number of workers shared by all pref sets
+    :return: dict of number of results by pref set name
+    """
+    workers_per_set = max(1, num_workers // max(1, len(pref_sets)))
+
+    def make_callback(name):
+        return lambda result: result_callback(name, result)
+
+    counts = await asyncio.gather(*[scan_stream(app, target_list, make_callback(name), prefs=prefs,
+                                                num_workers=workers_per_set, **kwargs)
+                                    for name, prefs in pref_sets])
+    return dict(zip([name for name, _ in pref_sets], counts))
+
+
+async def scan_pairs(test_app, base_app, target_list, result_callback, scans=1, test_profile=None, test_prefs=None,
+                     base_profile=None, base_prefs=None, num_workers=4, targets_per_worker=50, timeout=10,
+                     get_certs=False, cert_db=None, progress_callback=None, max_requests=None, max_rss=None,
+                     retries=max_retries, event_callback=None, spare_workers=0, rng=None):
+    """
+    Coroutine that scans every host `scans` times with both builds, in pairs of
+    one test and one base request that are sent close together in time, so
+    network drift affects both builds alike. Hosts are visited in a new random
+    order every round, and the build that goes first is picked at random for
+    every pair. The request of the second build is only queued once the
+    request of the first build was sent to its worker.
+
+    Test and base workers run side by side, each build with half of the
+    `num_workers` budget. At most as many pairs are in flight as the workers of
+    one build keep requests in flight, which keeps both builds in lock-step.
+    A host never has more than one pair in flight.
+
+    `result_callback` is called with the build name ("test" or "base"), the
+    round, and the ScanResult. If `get_certs` is set, certificates are only
+    requested in the first test round. `progress_callback` is called with 1
+    for every result and for every scan that is dropped without one.
+
+    Returns the number of results.
+    """
+    global logger
+
+    if rng is None:
+        rng = random.Random()
+    builds = ("test", "base")
+    queues = dict((build, TargetQueue()) for build in builds)
+    workers_per_build = max(1, num_workers // 2)
+    window = workers_per_build * targets_per_worker
+    dead_builds = set()
+
+    # Every round visits the hosts in a new random order
+    schedule = deque()
+    for scan in range(scans):
+        hosts = list(target_list)
+        rng.shuffle(hosts)
+        schedule.extend((scan, rank, host) for rank, host in hosts)
+    deferred = deque()
+    in_flight = {}
+    result_count = 0
+
+    def next_pair():
+        # Hosts with a pair in flight have to wait for it to complete
+        for _ in range(len(deferred)):
+            pair = deferred.popleft()
+            if pair[2] not in in_flight:
+                return pair
+            deferred.append(pair)
+        while len(schedule) > 0:
+            pair = schedule.popleft()
+            if pair[2] not in in_flight:
+                return pair
+            deferred.append(pair)
+        return None
+
+    def release():
+        while len(in_flight) < window:
+            pair = next_pair()
+            if pair is None:
+                break
+            scan, rank, host = pair
+            order = list(set(builds) - dead_builds)
+            if len(order) == 0:
                 continue
-            # Else we know this is the result of a scan command.
-            result = ScanResult(response)
-            results[result.host] = result
-        if len(results) >= len(target_list):
-            break
-        if xpcw.send(wakeup_cmd):
-            time.sleep(0.1)
+            rng.shuffle(order)
+            requests = deque()
+            for i, build in enumerate(order):
+                options = {"get_certs": get_certs and build == "test" and scan == 0}
+                if i < len(order) - 1:
+                    options["sent_callback"] = lambda host=host: send_next(host)
+                requests.append((build, (rank, host, options)))
+            in_flight[host] = (scan, set(order), requests)
+            send_next(host, follow_up=False)
+        if len(in_flight) == 0 and len(schedule) == 0 and len(deferred) == 0:
+            for queue in queues.values():
+                queue.close()
+
+    def send_next(host, follow_up=True):
+        # Follow-up requests of a pair go to the front of the queue, so they are sent right away
+        if host not in in_flight or len(in_flight[host][2]) == 0:
+            return
+        build, target = in_flight[host][2].popleft()
+        if build in dead_builds:
+            drop(build, host)
         else:
-            break
+            queues[build].put(target, first=follow_up)
 
-    if len(results) < len(target_list):
-        logger.warning("Worker task dropped results, yielded %d instead of %d" % (len(results), len(target_list)))
+    def done(build, host):
+        scan, pending, _ = in_flight[host]
+        pending.discard(build)
+        if len(pending) == 0:
+            del in_flight[host]
+            release()
+        else:
+            # A request that was dropped before it was sent still lets the next one go
+            send_next(host)
 
-    # Wind down the worker
-    xpcw.send(xw.Command("quit"))
-    xpcw.terminate()
+    def make_result_callback(build):
+        def on_result(result):
+            nonlocal result_count
+            result_count += 1
+            result_callback(build, in_flight[result.host][0], result)
+            if progress_callback is not None:
+                progress_callback(1)
+            done(build, result.host)
+        return on_result
 
-    logger.debug("Worker task finished, returning %d results" % len(results))
+    def drop(build, host):
+        if progress_callback is not None:
+            progress_callback(1)
+        done(build, host)
 
-    return results
+    def make_drop_callback(build):
+        return lambda target: drop(build, target[1])
+
+    pool = get_spare_pool(spare_workers) if spare_workers > 0 else None
+    slots_left = dict((build, workers_per_build) for build in builds)
+
+    async def build_slot(build, app, profile, prefs):
+        await __run_slot(queues[build], make_result_callback(build), app, profile=profile, prefs=prefs,
+                         window=targets_per_worker, timeout=timeout, max_requests=max_requests, max_rss=max_rss,
+                         retries=retries, cert_db=cert_db if build == "test" else None,
+                         event_callback=event_callback, pool=pool, drop_callback=make_drop_callback(build))
+        slots_left[build] -= 1
+        if slots_left[build] == 0 and not queues[build].exhausted():
+            # No worker left to scan these hosts
+            logger.error("Lost all %s scan workers" % build)
+            dead_builds.add(build)
+            for target in queues[build]:
+                drop(build, target[1])
 
+    release()
+    await asyncio.gather(*[build_slot("test", test_app, test_profile, test_prefs) for _ in range(workers_per_build)],
+                         *[build_slot("base", base_app, base_profile, base_prefs) for _ in range(workers_per_build)])
 
-@ts.task
-def collect(result_dicts):
-    combined_results = {}
-    for result in result_dicts:
-        combined_results.update(result)
-    return combined_results
+    return result_count
 
 
-def __as_chunks(flat_list, chunk_size):
-    for i in range(0, len(flat_list), chunk_size):
-        yield flat_list[i:i + chunk_size]
+async def scan_hosts(app, target_list, **kwargs):
+    """Coroutine variant of scan_stream() that returns a dict of all ScanResults by host"""
+    results = {}
+
+    def collect(result):
+        results[result.host] = result
 
+    await scan_stream(app, target_list, collect, **kwargs)
+    return results
 
-# CAVE: run_scans is not re-entrant due to use of global variables.
-def run_scans(app, target_list, profile=None, prefs=None, num_workers=4, targets_per_worker=50, worq_url="memory://",
-              get_certs=False, timeout=10, progress_callback=None):
-    global logger, pool
 
-    pool = start_pool(worq_url, timeout=1, num_workers=num_workers)
+def run_in_loop(coroutine):
+    """Run a scan coroutine on the scan event loop and wind down workers on Ctrl-C"""
+    global logger
 
-    chunks = __as_chunks(target_list, targets_per_worker)
+    loop = get_event_loop()
+    main_task = loop.create_task(coroutine)
     try:
-        queue = get_queue(worq_url, target=__name__)
+        return loop.run_until_complete(main_task)
+
+    except KeyboardInterrupt:
+        logger.critical("Ctrl-C received. Winding down workers...")
+        main_task.cancel()
+        try:
+            loop.run_until_complete(main_task)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            pass
+        stop()
+        close_event_loop()
+        logger.debug("Signaled workers to quit")
+        raise KeyboardInterrupt
+
+
+def iter_in_loop(make_coroutine):
+    """
+    Generator that runs a streaming scan coroutine on the scan event loop and
+    yields its results as they arrive. `make_coroutine` is called with the
+    result callback to pass to the coroutine. The loop only runs while the
+    consumer waits for the next result.
+    """
+    global logger
 
-        # Enqueue tasks to be executed in parallel
-        scan_results = [queue.scan_urls(app, targets, profile=profile, prefs=prefs,
-                                        get_certs=get_certs, timeout=timeout)
-                        for targets in chunks]
-        result = queue.collect(scan_results)
+    loop = get_event_loop()
+    ready = deque()
+    available = asyncio.Event()
 
-        queue_len = len(queue)
-        logged_len = 0  # Required to correct for "overlogging" due to chunking
+    def on_result(result):
+        ready.append(result)
+        available.set()
 
+    main_task = loop.create_task(make_coroutine(on_result))
+    main_task.add_done_callback(lambda _: available.set())
+    aborted = False
+    try:
         while True:
-            finished = result.wait(timeout=10)
-            current_queue_len = len(queue)
-            chunks_done = queue_len - current_queue_len
-            logger.debug("After queue wait: %d old - %d new = %d done" % (queue_len, current_queue_len, chunks_done))
-            queue_len = current_queue_len
-            # Check finished first to ensure that the final chunk is not logged,
-            # because the final chunk might not have the full chunk size.
-            if finished:
+            while len(ready) > 0:
+                yield ready.popleft()
+            if main_task.done():
                 break
-            if progress_callback is not None and chunks_done > 0:
-                # We must assume the maximum chunk size here to calculate the number of results
-                progress_callback(chunks_done * targets_per_worker)
-                logged_len += chunks_done * targets_per_worker
+            available.clear()
+            loop.run_until_complete(available.wait())
+        main_task.result()
 
     except KeyboardInterrupt:
         logger.critical("Ctrl-C received. Winding down workers...")
         stop()
+        aborted = True
         logger.debug("Signaled workers to quit")
         raise KeyboardInterrupt
 
     finally:
-        stop()
+        # Also reached when the consumer stops iterating early
+        if not main_task.done():
+            main_task.cancel()
+            try:
+                loop.run_until_complete(main_task)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                pass
+        if aborted:
+            close_event_loop()
+
+
+def iter_scans(app, target_list, **kwargs):
+    """
+    Generator that yields ScanResult objects as they complete. Takes the
+    same arguments as run_scans().
+    """
+    return iter_in_loop(lambda result_callback: scan_stream(app, target_list, result_callback, **kwargs))
 
-    # Log the results of the final chunk
-    if progress_callback is not None:
-        actual_len = len(result.value)
-        logger.debug("Chunkwise logging reported on %d results, actually received %d" % (logged_len, actual_len))
-        len_correction = actual_len - logged_len
-        if len_correction != 0:
-            logger.debug("Logging correction for %d results" % len_correction)
-            progress_callback(len_correction)
 
-    return result.value
+def run_scans(app, target_list, profile=None, prefs=None, num_workers=4, targets_per_worker=50,
+              get_certs=False, timeout=10, progress_callback=None, max_requests=None, max_rss=None,
+              adaptive=False, retries=max_retries, cert_db=None, event_callback=None, spare_workers=0):
+    return run_in_loop(scan_hosts(app, target_list, profile=profile, prefs=prefs,
+                                  num_workers=num_workers, targets_per_worker=targets_per_worker,
+                                  get_certs=get_certs, timeout=timeout, progress_callback=progress_callback,
+                                  max_requests=max_requests, max_rss=max_rss, adaptive=adaptive,
+                                  retries=retries, cert_db=cert_db, event_callback=event_callback,
+                                  spare_workers=spare_workers))